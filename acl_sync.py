@@ -0,0 +1,149 @@
+# Sharing of the Drive files of an assignment with its teachers.
+# When the teachers of an assignment change, the change (the users to add and
+# to remove) is computed once, and applied in the background to all the files
+# of the assignment: the master and student notebooks, which are owned by the
+# assignment owner and shared in read mode, and the homework and feedback
+# files of each student, which are owned by the student and shared in write
+# mode.  Each file owner is handled by a worker thread, with the owner's
+# credentials, using batched Drive requests.
+# The sync is run as a job (see jobs.py).  The progress is recorded in the
+# acl_sync table, including the owners already handled, so that a sync that
+# was interrupted (e.g., by a restart) or failed is resumed where it stopped
+# when the job is run again.
+
+import datetime
+import json
+import traceback
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from .common import db
+from .jobs import job_kind, enqueue_job, FAILED
+from .models import get_user_email, get_assignment_teachers, build_drive_service, read_drive_credentials
+from .settings import ACL_SYNC_WORKERS
+from .util import share_drive_files, unshare_drive_files
+
+# Maximum number of error messages recorded for a sync.
+MAX_ERRORS = 100
+ASSIGNMENT_GROUP = "assignment"
+
+
+def start_acl_sync(assignment_id, add_users, remove_users, user=None):
+    """Starts sharing the files of an assignment with add_users, and
+    unsharing them from remove_users.  Returns the acl_sync id."""
+    sync_id = db.acl_sync.insert(
+        assignment_id=assignment_id,
+        owner=user or get_user_email(),
+        add_users=json.dumps(sorted(add_users)),
+        remove_users=json.dumps(sorted(remove_users)),
+        done_groups="[]",
+        errors="[]",
+    )
+    enqueue_job("acl_sync", dict(sync_id=sync_id), idempotency_key=_job_key(sync_id))
+    return sync_id
+
+
+def _job_key(sync_id):
+    return "acl_sync:{}".format(sync_id)
+
+
+def _file_groups(assignment, owner):
+    """Returns the files of an assignment, as a list of
+    (key, file owner, sharing mode, file ids) tuples."""
+    groups = [(ASSIGNMENT_GROUP, owner, "reader",
+               [f for f in (assignment.master_id_drive, assignment.student_id_drive) if f])]
+    feedback = {}
+    for g in db((db.grade.assignment_id == assignment.id) & (db.grade.drive_id != None)).select(
+            db.grade.homework_id, db.grade.drive_id):
+        feedback.setdefault(g.homework_id, []).append(g.drive_id)
+    for h in db(db.homework.assignment_id == assignment.id).select(
+            db.homework.id, db.homework.student, db.homework.drive_id):
+        file_ids = ([h.drive_id] if h.drive_id else []) + feedback.get(h.id, [])
+        groups.append((h.student, h.student, "writer", file_ids))
+    return [g for g in groups if g[3]]
+
+
+def _sync_files(user, credentials_json, mode, file_ids, add_users, remove_users):
+    """Updates the sharing of files owned by user.  Runs in a worker thread,
+    without db.  Returns the list of (file_id, user, exception) failures."""
+    if credentials_json is None:
+        raise ValueError("No credentials for {}".format(user))
+    drive_service = build_drive_service(user=user, credentials_json=credentials_json)
+    shares = [(file_id, u, mode) for file_id in file_ids for u in add_users]
+    failures = [(file_id, u, e) for file_id, u, _, e in share_drive_files(drive_service, shares)]
+    failures.extend(unshare_drive_files(drive_service, file_ids, remove_users))
+    return failures
+
+
+@job_kind("acl_sync")
+def run_acl_sync(sync_id):
+    """Applies a sync to the files not done yet."""
+    sync = db.acl_sync[sync_id]
+    assignment = db.assignment[sync.assignment_id]
+    if assignment is None:
+        sync.update_record(is_done=True)
+        return
+    # The change is checked against the current teachers, in case they
+    # have changed again since the sync was started.
+    teachers = set(get_assignment_teachers(assignment.id)) | {assignment.owner}
+    add_users = [u for u in json.loads(sync.add_users) if u in teachers]
+    remove_users = [u for u in json.loads(sync.remove_users) if u not in teachers]
+    done_groups = set(json.loads(sync.done_groups or "[]"))
+    errors = json.loads(sync.errors or "[]")
+    groups = _file_groups(assignment, assignment.owner)
+    if sync.total is None:
+        sync.update_record(total=sum(len(g[3]) for g in groups))
+    groups = [g for g in groups if g[0] not in done_groups]
+    credentials = {g[1]: read_drive_credentials(g[1]) for g in groups}
+    completed, failed = sync.completed or 0, sync.failed or 0
+    db.commit()
+    with ThreadPoolExecutor(max_workers=ACL_SYNC_WORKERS) as executor:
+        futures = {}
+        for key, user, mode, file_ids in groups:
+            future = executor.submit(_sync_files, user, credentials.get(user), mode,
+                                     file_ids, add_users, remove_users)
+            futures[future] = (key, file_ids)
+        for future in as_completed(futures):
+            key, file_ids = futures[future]
+            try:
+                failures = future.result()
+                failed_files = set(file_id for file_id, _, _ in failures)
+                messages = ["Could not update the sharing of {} for {}: {}".format(
+                    file_id, user or "all users", e) for file_id, user, e in failures]
+            except Exception as e:
+                traceback.print_exc()
+                failed_files = set(file_ids)
+                messages = ["Could not update the sharing of the files of {}: {}".format(key, e)]
+            completed += len(file_ids) - len(failed_files)
+            failed += len(failed_files)
+            errors = (errors + messages)[:MAX_ERRORS]
+            done_groups.add(key)
+            db(db.acl_sync.id == sync_id).update(
+                completed=completed, failed=failed, errors=json.dumps(errors),
+                done_groups=json.dumps(sorted(done_groups)),
+                updated_on=datetime.datetime.utcnow())
+            db.commit()
+    db(db.acl_sync.id == sync_id).update(is_done=True, updated_on=datetime.datetime.utcnow())
+
+
+def acl_sync_progress(assignment_id):
+    """Returns the progress of the last sync of an assignment, or None."""
+    sync = db(db.acl_sync.assignment_id == assignment_id).select(
+        orderby=~db.acl_sync.id, limitby=(0, 1)).first()
+    if sync is None:
+        return None
+    errors = json.loads(sync.errors or "[]")
+    is_done = sync.is_done
+    if not is_done and not db((db.job.kind == "acl_sync") &
+                              (db.job.idempotency_key == _job_key(sync.id)) &
+                              (db.job.status == FAILED)).isempty():
+        # The job has given up.
+        is_done = True
+        errors.append("The sharing could not be completed.")
+    return dict(
+        total=sync.total,
+        completed=sync.completed,
+        failed=sync.failed,
+        is_done=is_done,
+        errors=errors,
+    )
@@ -9,9 +9,11 @@ from .components.vueform import VueForm
 
 from .constants import *
 from .common import db, session, auth, Field, gcs
-from .util import random_id, long_random_id, upload_to_drive, share_drive_file, unshare_drive_file
+from .util import random_id, long_random_id, upload_to_drive
 from .common import url_signer
 from .models import get_assignment_teachers, set_assignment_teachers, get_user_email, build_drive_service
+from .assignment_copy import copy_assignment_notebooks
+from .acl_sync import start_acl_sync
 from .util import normalize_email_list
 from .settings import MAX_GRADES_24H, GCS_BUCKET
 from .private.private_settings import TESTER_EMAILS, AI_EMAILS
@@ -109,21 +111,12 @@ class AssignmentFormEdit(AssignmentForm):
         num_ai_feedbacks = 2 if (email in TESTER_EMAILS or email.endswith("@ucsc.edu")) else 0
         validated_values["ai_feedback"] = num_ai_feedbacks
         assignment.update_record(**validated_values)
-        # Updates the instructors on the master notebook.
+        # Updates the instructors on the notebooks, and on the homework and
+        # feedback files, in the background.
         remove_instructors = set(old_instructors) - set(new_instructors)
         add_instructors = set(new_instructors) - set(old_instructors)
-        # Shares the notebooks with the new users. 
-        drive_service = build_drive_service()
-        if assignment.master_id_drive is not None:
-            for u in add_instructors:
-                share_drive_file(drive_service, assignment.master_id_drive, u, "reader")
-            for u in remove_instructors:
-                unshare_drive_file(drive_service, assignment.master_id_drive, u)
-        if assignment.student_id_drive is not None:
-            for u in add_instructors:
-                share_drive_file(drive_service, assignment.student_id_drive, u, "reader")
-            for u in remove_instructors:
-                unshare_drive_file(drive_service, assignment.student_id_drive, u)        
+        if add_instructors or remove_instructors:
+            start_acl_sync(record_id, add_instructors, remove_instructors)
         return dict(redirect_url=URL(self.redirect_url, record_id))
 
 
@@ -163,26 +156,7 @@ class AssignmentFormCreate(AssignmentFormEdit):
         set_assignment_teachers(new_id, new_instructors)
         # Copies the notebooks if needed.
         if self.duplicated_assignment is not None:
-            assignment = db.assignment[new_id]
-            tas = get_assignment_teachers(assignment.id, exclude=assignment.owner)
-            drive_service = build_drive_service()
-            master_json = gcs.read(GCS_BUCKET, self.duplicated_assignment.master_id_gcs)
-            student_json = gcs.read(GCS_BUCKET, self.duplicated_assignment.student_id_gcs)
-            master_id_gcs = long_random_id() + ".json"
-            student_id_gcs = long_random_id() + ".json"
-            gcs.write(GCS_BUCKET, master_id_gcs, master_json, type="application/json")
-            gcs.write(GCS_BUCKET, student_id_gcs, student_json, type="application/json")
-            assignment.master_id_gcs = master_id_gcs
-            assignment.student_id_gcs = student_id_gcs
-            date_string = datetime.datetime.utcnow().isoformat()
-            master_file_name = "{}, version: {}".format(assignment.name, date_string)
-            student_file_name = "{}, version: {}".format(assignment.name, date_string)
-            assignment.master_id_drive = upload_to_drive(
-                drive_service, master_json, master_file_name,
-                read_share=tas, id=assignment.master_id_drive)
-            assignment.student_id_drive = upload_to_drive(
-                drive_service, student_json, student_file_name,
-                read_share=tas, id=assignment.student_id_drive)            
-            assignment.update_record()
+            copy_assignment_notebooks(self.duplicated_assignment, db.assignment[new_id])
         return dict(redirect_url=URL(self.redirect_url, new_id))
 
+
@@ -81,7 +81,11 @@ class StudentGradesGrid(Grid):
         # Now creates the results.
         rows = [header]
         for r in result_rows:
-            row_notebook = A(SPAN(I(_class="fa fa-file"), " View"), _class="button is-success", _target="_blank", _href=COLAB_BASE + r["grade"]["drive_id"])
+            if r["grade"]["drive_id"]:
+                row_notebook = A(SPAN(I(_class="fa fa-file"), " View"), _class="button is-success", _target="_blank", _href=COLAB_BASE + r["grade"]["drive_id"])
+            else:
+                # The feedback is being copied to Drive.
+                row_notebook = SPAN(I(_class="fa fa-spinner fa-spin"), " Preparing")
             cells=[
                 dict(html=I(_class="fa fa-check").xml() if r["grade"]["is_valid"]
                 else I(_class="fa fa-warning is-danger").xml()),
@@ -0,0 +1,173 @@
+# Copies of assignments, one at a time or a whole course at once.
+# The notebooks of an assignment are copied in GCS by GCS itself (rewrite),
+# and uploaded to Drive, where the copies are shared with the teachers.
+# Course copies run in the background, as jobs (see jobs.py): the assignments
+# are created by the job, which owns a db connection, while their notebooks
+# are copied by a bounded pool of threads that do not use the db.  The
+# progress is recorded in the course_copy table, which the browser polls.
+
+import datetime
+import json
+import traceback
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from .common import db, gcs, notebook_cache
+from .jobs import job_kind, enqueue_job, FAILED
+from .models import (get_user_email, get_assignment_teachers, set_assignment_teachers,
+                     build_drive_service, read_drive_credentials, copy_gcs_object)
+from .settings import GCS_BUCKET, COURSE_COPY_WORKERS
+from .util import long_random_id, upload_to_drive
+
+
+def _read_notebook(id_gcs, digest):
+    data, _ = notebook_cache.get_or_load(digest, lambda: gcs.read(GCS_BUCKET, id_gcs))
+    return data.decode('utf-8')
+
+
+def copy_notebooks(source, name, tas, user, credentials_json):
+    """Copies the notebooks of the source assignment, naming the Drive copies
+    after name and sharing them with the tas.  Returns the assignment fields
+    of the copies.  The db is not used, so this can run in any thread."""
+    fields = dict(
+        master_id_gcs=long_random_id() + ".json",
+        student_id_gcs=long_random_id() + ".json",
+        master_digest=source.master_digest,
+        student_digest=source.student_digest,
+    )
+    copy_gcs_object(GCS_BUCKET, source.master_id_gcs, fields['master_id_gcs'])
+    copy_gcs_object(GCS_BUCKET, source.student_id_gcs, fields['student_id_gcs'])
+    # The Drive copies need the notebooks, which are usually in the cache.
+    master_json = _read_notebook(source.master_id_gcs, source.master_digest)
+    student_json = _read_notebook(source.student_id_gcs, source.student_digest)
+    date_string = datetime.datetime.utcnow().isoformat()
+    file_name = "{}, version: {}".format(name, date_string)
+    # The two uploads are done concurrently.  Drive services cannot be shared
+    # across threads, so each thread builds its own from the credentials.
+    def upload(notebook_json):
+        drive_service = build_drive_service(user=user, credentials_json=credentials_json)
+        return upload_to_drive(drive_service, notebook_json, file_name, read_share=tas)
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        master_upload = executor.submit(upload, master_json)
+        student_upload = executor.submit(upload, student_json)
+        fields['master_id_drive'] = master_upload.result()
+        fields['student_id_drive'] = student_upload.result()
+    return fields
+
+
+def copy_assignment_notebooks(source, assignment, user=None):
+    """Copies the notebooks of the source assignment to the assignment."""
+    if source.master_id_gcs is None:
+        return
+    user = user or get_user_email()
+    tas = get_assignment_teachers(assignment.id, exclude=assignment.owner)
+    assignment.update_record(**copy_notebooks(
+        source, assignment.name, tas, user, read_drive_credentials(user)))
+
+
+def start_course_copy(assignment_ids, shift, user=None):
+    """Starts copying the assignments in the background, shifting their dates
+    by shift (a timedelta).  Returns the id of the course_copy row that
+    records the progress."""
+    user = user or get_user_email()
+    copy_id = db.course_copy.insert(owner=user, total=len(assignment_ids), new_ids="[]",
+                                    errors="[]")
+    enqueue_job("course_copy", dict(copy_id=copy_id, assignment_ids=assignment_ids,
+                                    shift_seconds=shift.total_seconds(), user=user),
+                idempotency_key=_job_key(copy_id))
+    return copy_id
+
+
+def _job_key(copy_id):
+    return "course_copy:{}".format(copy_id)
+
+
+# A copy is not retried, as it would create the assignments again.
+@job_kind("course_copy", max_attempts=1)
+def run_course_copy(copy_id, assignment_ids, shift_seconds, user):
+    """Creates the new assignments, and copies their notebooks with at most
+    COURSE_COPY_WORKERS assignments at a time."""
+    shift = datetime.timedelta(seconds=shift_seconds)
+    new_ids, errors = [], []
+    completed, failed = 0, 0
+    try:
+        credentials_json = read_drive_credentials(user)
+        with ThreadPoolExecutor(max_workers=COURSE_COPY_WORKERS) as executor:
+            copies = {}
+            for assignment_id in assignment_ids:
+                source = db.assignment[assignment_id]
+                new_id, teachers = _insert_copy(source, shift, user)
+                new_ids.append(new_id)
+                if source.master_id_gcs is None:
+                    # There are no notebooks to copy.
+                    completed += 1
+                    continue
+                tas = [t for t in teachers if t != user]
+                future = executor.submit(copy_notebooks, source, source.name, tas,
+                                         user, credentials_json)
+                copies[future] = (source, new_id)
+            db(db.course_copy.id == copy_id).update(new_ids=json.dumps(new_ids),
+                                                    completed=completed)
+            db.commit()
+            for future in as_completed(copies):
+                source, new_id = copies[future]
+                try:
+                    db(db.assignment.id == new_id).update(**future.result())
+                    completed += 1
+                except Exception as e:
+                    traceback.print_exc()
+                    failed += 1
+                    errors.append("{}: {}".format(source.name, e))
+                db(db.course_copy.id == copy_id).update(
+                    completed=completed, failed=failed, errors=json.dumps(errors))
+                db.commit()
+        db(db.course_copy.id == copy_id).update(is_done=True)
+        db.commit()
+    except:
+        traceback.print_exc()
+        db.rollback()
+        errors.append("The copy could not be completed.")
+        db(db.course_copy.id == copy_id).update(is_done=True, errors=json.dumps(errors))
+
+
+def _insert_copy(source, shift, user):
+    """Inserts the copy of an assignment, with the dates shifted, and the same
+    teachers.  Returns the new id, and the teachers."""
+    new_id = db.assignment.insert(
+        owner=user,
+        name=source.name,
+        domain_restriction=source.domain_restriction,
+        available_from=source.available_from + shift,
+        submission_deadline=source.submission_deadline + shift,
+        available_until=source.available_until + shift,
+        max_submissions_in_24h_period=source.max_submissions_in_24h_period,
+        ai_feedback=source.ai_feedback,
+        max_points=source.max_points,
+        test_ids=source.test_ids,
+    )
+    teachers = sorted(set(get_assignment_teachers(source.id)) | {user})
+    set_assignment_teachers(new_id, teachers)
+    return new_id, teachers
+
+
+def course_copy_progress(copy_id):
+    """Returns the progress of a course copy, for the owner."""
+    row = db.course_copy[copy_id]
+    if row is None or row.owner != get_user_email():
+        return None
+    errors = json.loads(row.errors or "[]")
+    is_done = row.is_done
+    if not is_done and not db((db.job.kind == "course_copy") &
+                              (db.job.idempotency_key == _job_key(row.id)) &
+                              (db.job.status == FAILED)).isempty():
+        # The job was interrupted, and is not run again.
+        is_done = True
+        errors.append("The copy could not be completed.")
+    return dict(
+        total=row.total,
+        completed=row.completed,
+        failed=row.failed,
+        is_done=is_done,
+        new_ids=json.loads(row.new_ids or "[]"),
+        errors=errors,
+    )
@@ -0,0 +1,69 @@
+# Bounded pool of worker threads, used to do work (GCS writes, enqueueing of
+# requests, ...) after a request has returned.
+# The number of jobs that can be pending is bounded: when the pool is full,
+# submit blocks until a job completes, so that a burst of requests slows down
+# rather than piling up an unbounded amount of work in memory.
+
+import threading
+import traceback
+
+from concurrent.futures import ThreadPoolExecutor
+
+
+class BackgroundPool(object):
+
+    def __init__(self, max_workers=4, max_pending=32):
+        """
+        Args:
+            max_workers: number of worker threads.
+            max_pending: maximum number of jobs, running or queued.
+        """
+        self.max_workers = max_workers
+        self.max_pending = max(max_pending, max_workers)
+        self._slots = threading.BoundedSemaphore(self.max_pending)
+        self._executor = ThreadPoolExecutor(max_workers=max_workers,
+                                            thread_name_prefix="background")
+
+    def submit(self, fn, *args, **kwargs):
+        """Runs fn(*args, **kwargs) in a worker thread, and returns its future.
+        Exceptions raised by fn are printed, and can be obtained from the
+        future; fn should take care of recording its own failures."""
+        self._slots.acquire()
+        try:
+            future = self._executor.submit(self._run, fn, *args, **kwargs)
+        except:
+            self._slots.release()
+            raise
+        return future
+
+    def _run(self, fn, *args, **kwargs):
+        try:
+            return fn(*args, **kwargs)
+        except Exception:
+            traceback.print_exc()
+            raise
+        finally:
+            self._slots.release()
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
+
+
+def test_background_pool():
+    pool = BackgroundPool(max_workers=2, max_pending=3)
+    lock = threading.Lock()
+    results = []
+    def work(i):
+        with lock:
+            results.append(i)
+        return i * i
+    futures = [pool.submit(work, i) for i in range(20)]
+    assert [f.result() for f in futures] == [i * i for i in range(20)]
+    assert sorted(results) == list(range(20))
+    # Failures are reported through the future, and free their slot.
+    def fail():
+        raise ValueError("failed")
+    for _ in range(5):
+        assert isinstance(pool.submit(fail).exception(), ValueError)
+    assert pool.submit(work, 3).result() == 9
+    pool.shutdown()
@@ -19,6 +19,9 @@ from . import settings
 from .settings import APP_FOLDER, IS_TEST
 
 from .google_scoped_login import GoogleScopedLogin, MyAuthEnforcerGoogleScoped
+from .notebook_cache import NotebookCache, ParsedNotebookCache
+from .background import BackgroundPool
+from .drive_service import DriveServicePool
 
 # #######################################################
 # implement custom loggers form settings.LOGGERS
@@ -233,3 +236,16 @@ url_signer = URLSigner(session)
 flash = Flash()
 json_key_path = os.path.join(APP_FOLDER, "private/notebookgrader-gcs.json")
 gcs = nqgcs.NQGCS(json_key_path=json_key_path)
+notebook_cache = NotebookCache(
+    max_bytes=settings.NOTEBOOK_CACHE_MAX_BYTES,
+    folder=settings.NOTEBOOK_CACHE_FOLDER,
+    max_disk_bytes=settings.NOTEBOOK_CACHE_MAX_DISK_BYTES,
+)
+master_notebook_cache = ParsedNotebookCache(max_entries=settings.MASTER_NOTEBOOK_CACHE_SIZE)
+# Grading skeletons are never modified, so they are shared without copies.
+grading_skeleton_cache = ParsedNotebookCache(max_entries=settings.MASTER_NOTEBOOK_CACHE_SIZE,
+                                             view=lambda skeleton: skeleton)
+drive_service_pool = DriveServicePool(max_entries=settings.DRIVE_SERVICE_CACHE_SIZE,
+                                      ttl=settings.DRIVE_SERVICE_TTL)
+background_pool = BackgroundPool(max_workers=settings.BACKGROUND_WORKERS,
+                                 max_pending=settings.BACKGROUND_MAX_PENDING)
@@ -33,7 +33,7 @@ from pydal import Field
 from yatl.helpers import A, BUTTON, SPAN
 from .common import db, session, T, cache, auth, logger, authenticated, unauthenticated
 from py4web.utils.form import Form, FormStyleBulma
-from .models import get_user_email, is_admin, build_drive_service
+from .models import get_user_email, is_admin, build_drive_service, read_stored_notebook
 from .settings import APP_FOLDER, COLAB_BASE, GCS_BUCKET, GCS_SUBMISSIONS_BUCKET
 
 from .common import url_signer, gcs
@@ -85,7 +85,7 @@ def admin_share(source=None, id=None):
         redirect(URL('index'))
     if source == "submission" and id is not None:
         # Reads the file from gcs.
-        notebook_json = gcs.read(GCS_SUBMISSIONS_BUCKET, id)
+        notebook_json = read_stored_notebook(id)
         admin = get_user_email()
         print("Building credentials for:", admin)
         drive_service = build_drive_service(user=admin)
@@ -0,0 +1,136 @@
+# Cache of Google Drive services.
+# Building a Drive service parses the Drive discovery document, and sets up
+# credentials and an http transport; doing this on every request is costly.
+# The pool keeps the services of the most recently active users.  Services
+# are built from the discovery document shipped with googleapiclient, read
+# once, and the http transports are reused across services.
+# The credentials of a service are refreshed by google-auth when they
+# expire; the refreshed tokens are written back as soon as they are
+# refreshed, so that they can be used by later requests and by other
+# processes even once the service has left the pool.
+
+import json
+import threading
+import time
+
+from collections import OrderedDict
+
+import google_auth_httplib2
+import httplib2
+from googleapiclient.discovery import build_from_document
+from googleapiclient.discovery_cache import get_static_doc
+
+from .google_scoped_login import GoogleScopedLogin
+
+
+def credentials_from_json(credentials_json):
+    return GoogleScopedLogin.credentials_from_dict(json.loads(credentials_json))
+
+
+def credentials_to_json(creds):
+    credentials_dict = GoogleScopedLogin.credentials_to_dict(creds)
+    if creds.expiry is not None:
+        # Lets google-auth refresh the token before it expires, rather than
+        # after a request has failed.
+        credentials_dict['expiry'] = creds.expiry.isoformat()
+    return json.dumps(credentials_dict)
+
+
+class _Entry(object):
+
+    def __init__(self, credentials_json, creds, service):
+        self.credentials_json = credentials_json # As stored in the db.
+        self.creds = creds
+        self.service = service
+        self.created = time.time()
+        self.save_credentials = None # From the latest get.
+        refresh = creds.refresh
+        def refresh_and_save(request):
+            refresh(request)
+            self.save()
+        creds.refresh = refresh_and_save
+
+    def save(self):
+        """Writes back the credentials, if they have been refreshed."""
+        refreshed_json = credentials_to_json(self.creds)
+        if refreshed_json == self.credentials_json or self.save_credentials is None:
+            return
+        try:
+            self.save_credentials(refreshed_json)
+        except Exception as e:
+            print("Could not save the refreshed credentials:", e)
+            return
+        self.credentials_json = refreshed_json
+
+
+class DriveServicePool(object):
+    """LRU cache of Drive services, keyed by user and thread, as services
+    (and their http transports) cannot be shared across threads."""
+
+    def __init__(self, max_entries=256, ttl=30 * 60):
+        """
+        Args:
+            max_entries: maximum number of cached services.
+            ttl: time, in seconds, after which a service is built anew.
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._discovery_document = None
+
+    def get(self, user, credentials_json, save_credentials=None):
+        """Returns a Drive service for a user.
+        Args:
+            user: the user email.
+            credentials_json: the credentials of the user, as stored.
+            save_credentials: function called with the new credentials json
+                when the credentials have been refreshed.
+        A cached service is used only if it was built from the same stored
+        credentials, so a new login of the user is always picked up."""
+        key = (user, threading.get_ident())
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is not None and entry.credentials_json == credentials_json:
+            # Writes back the tokens refreshed while there was no way to save them.
+            entry.save_credentials = save_credentials
+            entry.save()
+            if time.time() - entry.created < self.ttl:
+                with self._lock:
+                    if key in self._entries:
+                        self._entries.move_to_end(key)
+                return entry.service
+            credentials_json = entry.credentials_json
+        creds = credentials_from_json(credentials_json)
+        http = google_auth_httplib2.AuthorizedHttp(creds, http=self._transport())
+        service = build_from_document(self._document(), http=http)
+        entry = _Entry(credentials_json, creds, service)
+        entry.save_credentials = save_credentials
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return service
+
+    def invalidate(self, user):
+        """Removes the services of a user, e.g., if the credentials are revoked."""
+        with self._lock:
+            for key in [k for k in self._entries if k[0] == user]:
+                del self._entries[key]
+
+    def _transport(self):
+        """Returns the http transport of this thread, shared by all the
+        services of the thread so its connections are reused."""
+        http = getattr(self._local, 'http', None)
+        if http is None:
+            http = self._local.http = httplib2.Http()
+        return http
+
+    def _document(self):
+        # The document is kept as a string: building a service annotates the
+        # parsed document, so a parsed one could not be shared across threads.
+        if self._discovery_document is None:
+            self._discovery_document = get_static_doc('drive', 'v3')
+        return self._discovery_document
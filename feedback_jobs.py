@@ -0,0 +1,63 @@
+# Jobs that copy the feedback of grades to the Drive of the students (see jobs.py).
+# The feedback is stored in GCS when the grade is received; its copy in Drive,
+# shared with the teachers, is done by these jobs, so that the grade callbacks
+# need not wait for Drive.
+
+import datetime
+
+from .common import db
+from .jobs import job_kind, enqueue_job
+from .models import build_drive_service, get_assignment_teachers, read_stored_notebook
+from .util import upload_to_drive
+
+
+def enqueue_feedback_upload(grade_id):
+    """Enqueues the copy to Drive of the feedback of a grade."""
+    return enqueue_job("upload_grade_feedback", dict(grade_id=grade_id),
+                       idempotency_key="grade_feedback:{}".format(grade_id))
+
+
+def enqueue_ai_feedback_upload(ai_feedback_id, version):
+    """Enqueues the copy to Drive of an AI feedback.  AI feedback can be
+    received more than once for the same grade; version distinguishes them."""
+    return enqueue_job("upload_ai_feedback", dict(ai_feedback_id=ai_feedback_id),
+                       idempotency_key="ai_feedback:{}:{}".format(ai_feedback_id, version))
+
+
+def _upload_feedback(student, assignment_id, feedback_json, feedback_name):
+    print("Building credentials for:", student)
+    drive_service = build_drive_service(user=student)
+    # We share with the teachers in write mode so that they can go back
+    # in the revision history.
+    write_share = get_assignment_teachers(assignment_id)
+    return upload_to_drive(drive_service, feedback_json,
+                           feedback_name, write_share=write_share, locked=True)
+
+
+@job_kind("upload_grade_feedback")
+def upload_grade_feedback(grade_id):
+    grade = db.grade[grade_id]
+    if grade is None or grade.drive_id is not None:
+        return
+    assignment = db.assignment[grade.assignment_id]
+    feedback_json = read_stored_notebook(grade.feedback_id_gcs).decode('utf-8')
+    feedback_name = "Feedback for {} {}, on {}".format(
+        assignment.name, grade.student, grade.grade_date.isoformat()
+    )
+    grade.update_record(drive_id=_upload_feedback(
+        grade.student, assignment.id, feedback_json, feedback_name))
+
+
+@job_kind("upload_ai_feedback")
+def upload_ai_feedback(ai_feedback_id):
+    ai_feedback = db.ai_feedback[ai_feedback_id]
+    if ai_feedback is None or ai_feedback.ai_feedback_id_drive is not None:
+        return
+    grade = db.grade[ai_feedback.grade_id]
+    assignment = db.assignment[grade.assignment_id]
+    feedback_json = read_stored_notebook(ai_feedback.ai_feedback_id_gcs).decode('utf-8')
+    feedback_name = "AI Feedback for {} {}, on {}".format(
+        assignment.name, grade.student, datetime.datetime.utcnow().isoformat()
+    )
+    ai_feedback.update_record(ai_feedback_id_drive=_upload_feedback(
+        grade.student, assignment.id, feedback_json, feedback_name))
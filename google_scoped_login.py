@@ -6,6 +6,7 @@
 # See https://developers.google.com/identity/protocols/oauth2/web-server#python
 
 import calendar
+import datetime
 import json
 import re
 import time
@@ -253,4 +254,10 @@ class GoogleScopedLogin(object):
 
     @staticmethod
     def credentials_from_dict(credentials_dict):
-        return google.oauth2.credentials.Credentials(**credentials_dict)
+        credentials_dict = dict(credentials_dict)
+        # The expiry is present only for refreshed credentials.
+        expiry = credentials_dict.pop('expiry', None)
+        credentials = google.oauth2.credentials.Credentials(**credentials_dict)
+        if expiry is not None:
+            credentials.expiry = datetime.datetime.fromisoformat(expiry)
+        return credentials
@@ -0,0 +1,634 @@
+# Local grading engine.
+# Runs matched notebooks (see run_notebook.GradingSkeleton) in a pool of
+# Jupyter kernels, and scores their test cells, as the grading function does
+# in the cloud.  It can be used in place of GRADING_URL (see USE_LOCAL_GRADER
+# in settings.py), to measure grading throughput locally, or as a fallback
+# when the cloud grader is unavailable.
+# Each worker owns a kernel process.  A new kernel is started as soon as the
+# previous one is retired, so that it is ready by the time the next notebook
+# arrives; kernels are retired after a number of runs, or when their memory
+# has grown too much.
+# In snapshot mode, the readonly setup cells that precede the first solution
+# cell (imports, data loading, ...) are run once per assignment version, and
+# each submission runs in a forked copy of the resulting process (see
+# snapshot_server.py).
+
+import concurrent.futures
+import hashlib
+import json
+import os
+import queue
+import select
+import signal
+import subprocess
+import sys
+import threading
+import time
+import traceback
+
+from collections import OrderedDict
+
+import nbformat, nbformat.v4
+import requests
+
+from jupyter_client import KernelManager
+
+from .notebook_cache import notebook_digest
+from .util import gunzip_if_needed
+
+CELL_TIMEOUT_NOTICE = "Cell execution timed out after {} seconds."
+
+
+class KernelWorker(object):
+    """A Jupyter kernel process, used to run one notebook at a time."""
+
+    def __init__(self, kernel_name="python3", startup_timeout=60):
+        self.kernel_name = kernel_name
+        self.startup_timeout = startup_timeout
+        self.km = None
+        self.kc = None
+        self.runs = 0
+        self.base_memory = None
+        self.is_broken = False
+
+    def start(self):
+        self.km = KernelManager(kernel_name=self.kernel_name)
+        self.km.start_kernel()
+        self.kc = self.km.client()
+        self.kc.start_channels()
+        self.kc.wait_for_ready(timeout=self.startup_timeout)
+        self.base_memory = self.memory()
+        return self
+
+    def shutdown(self):
+        try:
+            self.kc.stop_channels()
+            self.km.shutdown_kernel(now=True)
+        except Exception:
+            traceback.print_exc()
+
+    def memory(self):
+        """Returns the resident memory of the kernel process in bytes, or None
+        if it cannot be determined."""
+        provisioner = getattr(self.km, 'provisioner', None)
+        process = getattr(provisioner, 'process', None) or getattr(self.km, 'kernel', None)
+        pid = getattr(process, 'pid', None)
+        try:
+            with open("/proc/{}/statm".format(pid)) as f:
+                return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+        except (OSError, ValueError, IndexError):
+            return None
+
+    def execute(self, code, timeout=None):
+        """Executes code in the kernel.
+        Returns the triple (outputs, error, execution_count), where outputs is
+        the list of nbformat outputs, and error is the error output, or None if
+        the code ran without errors.  If the code runs for longer than timeout
+        seconds, the kernel is interrupted, and the error is a timeout error."""
+        msg_id = self.kc.execute(code, store_history=True, allow_stdin=False)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        outputs, error, execution_count = [], None, None
+        while True:
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                error = nbformat.v4.new_output(
+                    'error', ename="TimeoutError", evalue=CELL_TIMEOUT_NOTICE.format(timeout),
+                    traceback=[CELL_TIMEOUT_NOTICE.format(timeout)])
+                outputs.append(error)
+                self._interrupt(msg_id)
+                return outputs, error, execution_count
+            try:
+                msg = self.kc.get_iopub_msg(timeout=remaining)
+            except queue.Empty:
+                continue
+            if msg['parent_header'].get('msg_id') != msg_id:
+                continue
+            msg_type, content = msg['msg_type'], msg['content']
+            if msg_type == 'status' and content['execution_state'] == 'idle':
+                return outputs, error, execution_count
+            elif msg_type == 'execute_input':
+                execution_count = content.get('execution_count')
+            elif msg_type == 'clear_output':
+                outputs = []
+            elif msg_type in ('stream', 'display_data', 'execute_result', 'error'):
+                output = nbformat.v4.output_from_msg(msg)
+                outputs.append(output)
+                if msg_type == 'error':
+                    error = output
+
+    def _interrupt(self, msg_id, grace=10):
+        """Interrupts the execution of msg_id; if the kernel does not become
+        idle within grace seconds, it is marked as broken."""
+        self.km.interrupt_kernel()
+        deadline = time.monotonic() + grace
+        while time.monotonic() < deadline:
+            try:
+                msg = self.kc.get_iopub_msg(timeout=deadline - time.monotonic())
+            except queue.Empty:
+                break
+            if (msg['parent_header'].get('msg_id') == msg_id and msg['msg_type'] == 'status'
+                    and msg['content']['execution_state'] == 'idle'):
+                return
+        self.is_broken = True
+
+    def reset(self, timeout=30):
+        """Clears the user namespace, so the kernel can run another notebook."""
+        _, error, _ = self.execute("%reset -f", timeout=timeout)
+        if error is not None:
+            self.is_broken = True
+
+
+def grade_notebook(worker, nb, cell_timeout=None):
+    """Runs a matched notebook in a kernel, and scores its tests.
+    The notebook is modified: the code cells get their outputs and execution
+    counts, and the test cells get their points_earned: all their points if
+    they run without errors, and 0 otherwise.  Test cells marked to be
+    skipped (see run_notebook.mark_reused_tests) keep the points they have.
+    Returns the pair (points, had_errors)."""
+    points, had_errors = 0, False
+    for c in nb.cells:
+        if c.cell_type != "code":
+            continue
+        if is_skipped(c):
+            points += c.metadata.notebookgrader.get('points_earned', 0)
+            continue
+        outputs, error, execution_count = worker.execute(c.source, timeout=cell_timeout)
+        points += record_result(c, outputs, error, execution_count)
+        had_errors = had_errors or error is not None
+        if worker.is_broken:
+            break
+    return points, had_errors
+
+
+def is_skipped(c):
+    meta = c.metadata.get('notebookgrader') or {}
+    return bool(meta.get('is_tests') and meta.get('skip'))
+
+
+def record_result(c, outputs, error, execution_count):
+    """Stores in a code cell the result of running it, and scores it if it
+    is a test cell.  Returns the points earned."""
+    c.outputs = outputs
+    c.execution_count = execution_count
+    meta = c.metadata.get('notebookgrader')
+    if meta is None or not meta.get('is_tests'):
+        return 0
+    meta.points_earned = meta.get('test_points', 0) if error is None else 0
+    return meta.points_earned
+
+
+def split_setup(nb):
+    """Splits the code cells of a matched notebook into the setup prefix,
+    consisting of the readonly cells that precede the first solution cell,
+    and the rest.  Returns the pair of lists of cells."""
+    cells = [c for c in nb.cells if c.cell_type == "code"]
+    for i, c in enumerate(cells):
+        meta = c.metadata.get('notebookgrader') or {}
+        if meta.get('is_solution') or not meta.get('readonly', True):
+            return cells[:i], cells[i:]
+    return cells, []
+
+
+def setup_digest(setup_cells):
+    """Identifies an assignment version by the sources of its setup cells."""
+    return hashlib.sha256(json.dumps([c.source for c in setup_cells]).encode('utf-8')).hexdigest()
+
+
+class SnapshotError(Exception):
+    pass
+
+
+class SnapshotKernel(object):
+    """A process that has run the setup cells of an assignment, and that runs
+    each submission in a forked copy of itself (see snapshot_server.py)."""
+
+    SERVER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "snapshot_server.py")
+
+    def __init__(self, setup_sources, cell_timeout=60):
+        self.cell_timeout = cell_timeout
+        # The server is in a session of its own, so that it can be killed
+        # together with the children running the submissions.
+        self.process = subprocess.Popen(
+            [sys.executable, self.SERVER], stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+            text=True, start_new_session=True)
+        self.setup_results = self._request(
+            dict(setup=setup_sources, cell_timeout=cell_timeout), len(setup_sources))
+
+    def run(self, sources):
+        """Runs cells, starting from the state after the setup cells.
+        Returns one (outputs, error, execution_count) triple per cell."""
+        return self._request(dict(cells=sources), len(sources))
+
+    def _request(self, request, num_cells):
+        self.process.stdin.write(json.dumps(request) + "\n")
+        self.process.stdin.flush()
+        # Cells are interrupted after cell_timeout, so this is only reached
+        # if the server itself is stuck.
+        timeout = (self.cell_timeout or 600) * (num_cells + 1) + 30
+        ready, _, _ = select.select([self.process.stdout], [], [], timeout)
+        line = self.process.stdout.readline() if ready else ""
+        if not line:
+            self.close()
+            raise SnapshotError("The snapshot server did not answer.")
+        answer = json.loads(line)
+        if 'error' in answer:
+            # The submission crashed the process running it.
+            error = nbformat.v4.new_output(
+                'error', ename="SystemExit", evalue=answer['error'], traceback=[answer['error']])
+            return [([error], error, None)] * num_cells
+        return [([nbformat.from_dict(o) for o in r['outputs']],
+                 None if r['error'] is None else nbformat.from_dict(r['error']),
+                 r['execution_count']) for r in answer['results']]
+
+    def is_alive(self):
+        return self.process.poll() is None
+
+    def close(self):
+        try:
+            os.killpg(self.process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        self.process.wait()
+
+
+def grade_notebook_from_snapshot(snapshot, setup_cells, cells):
+    """Grades a matched notebook, split by split_setup, with a snapshot of
+    its setup cells.  Returns the pair (points, had_errors)."""
+    skipped = [c for c in cells if is_skipped(c)]
+    cells = [c for c in cells if not is_skipped(c)]
+    results = snapshot.setup_results + snapshot.run([c.source for c in cells])
+    points = sum(c.metadata.notebookgrader.get('points_earned', 0) for c in skipped)
+    had_errors = False
+    for c, (outputs, error, execution_count) in zip(setup_cells + cells, results):
+        points += record_result(c, outputs, error, execution_count)
+        had_errors = had_errors or error is not None
+    return points, had_errors
+
+
+class GradingPool(object):
+    """Pool of kernel workers that grade notebooks."""
+
+    def __init__(self, num_workers=2, max_runs_per_kernel=1, max_memory_growth=None,
+                 cell_timeout=60, kernel_name="python3", snapshot_setup=False,
+                 max_snapshots=2):
+        """
+        Args:
+            num_workers: number of workers, each with its own kernel process.
+            max_runs_per_kernel: number of notebooks run in a kernel before it
+                is replaced.  With 1, every notebook runs in a fresh kernel;
+                otherwise, the kernel namespace is reset between notebooks,
+                but other state (e.g., modified modules) carries over.
+            max_memory_growth: a kernel is replaced when its memory has grown by
+                more than this many bytes since it started.
+            cell_timeout: maximum time, in seconds, a cell can run.
+            kernel_name: the Jupyter kernel to use.
+            snapshot_setup: if True, notebooks with setup cells are graded from
+                snapshots of their setup (see SnapshotKernel) rather than in
+                a kernel.
+            max_snapshots: number of snapshots (i.e., assignment versions)
+                kept by each worker.
+        """
+        self.num_workers = num_workers
+        self.max_runs_per_kernel = max_runs_per_kernel
+        self.max_memory_growth = max_memory_growth
+        self.cell_timeout = cell_timeout
+        self.kernel_name = kernel_name
+        self.snapshot_setup = snapshot_setup
+        self.max_snapshots = max_snapshots
+        self._jobs = queue.Queue()
+        self._threads = [
+            threading.Thread(target=self._work, daemon=True, name="grading-{}".format(i))
+            for i in range(num_workers)]
+        for t in self._threads:
+            t.start()
+
+    def submit(self, nb):
+        """Enqueues a notebook for grading; returns a future for the pair
+        (points, had_errors).  The notebook is modified as in grade_notebook."""
+        future = concurrent.futures.Future()
+        self._jobs.put((future, nb))
+        return future
+
+    def grade(self, nb):
+        return self.submit(nb).result()
+
+    def shutdown(self):
+        for _ in self._threads:
+            self._jobs.put(None)
+        for t in self._threads:
+            t.join()
+
+    def _new_worker(self):
+        try:
+            return KernelWorker(kernel_name=self.kernel_name).start()
+        except Exception:
+            traceback.print_exc()
+            return None
+
+    def _should_retire(self, worker):
+        if worker.is_broken or worker.runs >= self.max_runs_per_kernel:
+            return True
+        if self.max_memory_growth is not None:
+            memory = worker.memory()
+            if memory is not None and worker.base_memory is not None:
+                return memory - worker.base_memory > self.max_memory_growth
+        return False
+
+    def _snapshot(self, snapshots, setup_cells):
+        """Returns the snapshot for the setup cells, among the snapshots
+        of this worker, creating it if needed."""
+        digest = setup_digest(setup_cells)
+        snapshot = snapshots.get(digest)
+        if snapshot is not None and snapshot.is_alive():
+            snapshots.move_to_end(digest)
+            return snapshot
+        snapshot = SnapshotKernel([c.source for c in setup_cells], cell_timeout=self.cell_timeout)
+        snapshots[digest] = snapshot
+        while len(snapshots) > self.max_snapshots:
+            _, evicted = snapshots.popitem(last=False)
+            evicted.close()
+        return snapshot
+
+    def _work(self):
+        # The kernel is started before the first notebook arrives.
+        worker = self._new_worker()
+        snapshots = OrderedDict()
+        while True:
+            job = self._jobs.get()
+            if job is None:
+                break
+            future, nb = job
+            if not future.set_running_or_notify_cancel():
+                continue
+            if self.snapshot_setup:
+                setup_cells, cells = split_setup(nb)
+                if setup_cells:
+                    try:
+                        snapshot = self._snapshot(snapshots, setup_cells)
+                        future.set_result(grade_notebook_from_snapshot(snapshot, setup_cells, cells))
+                    except Exception as e:
+                        future.set_exception(e)
+                    continue
+            if worker is None:
+                worker = self._new_worker()
+            if worker is None:
+                future.set_exception(RuntimeError("Could not start a kernel"))
+                continue
+            try:
+                result = grade_notebook(worker, nb, cell_timeout=self.cell_timeout)
+            except Exception as e:
+                worker.is_broken = True
+                future.set_exception(e)
+            else:
+                future.set_result(result)
+            worker.runs += 1
+            if not self._should_retire(worker):
+                worker.reset()
+            if self._should_retire(worker):
+                worker.shutdown()
+                worker = self._new_worker()
+        if worker is not None:
+            worker.shutdown()
+        for snapshot in snapshots.values():
+            snapshot.close()
+
+
+class LocalResponse(object):
+    """Result of an immediate request, with the interface of the requests
+    responses returned by send_function_request."""
+
+    def __init__(self, result):
+        self._result = result
+
+    def json(self):
+        return self._result
+
+    def raise_for_status(self):
+        pass
+
+
+class LocalGrader(object):
+    """Handles grading requests (see send_function_request) with a GradingPool,
+    returning the results as the grading function does."""
+
+    def __init__(self, pool, max_callbacks=4):
+        self.pool = pool
+        # Callbacks run apart, so that workers are not held up while the
+        # grades are processed.
+        self._callbacks = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_callbacks, thread_name_prefix="grading-callback")
+
+    def handle(self, payload, immediate=False):
+        """Grades the notebook in the payload.  If immediate, waits and returns
+        the result; otherwise, posts the result to the payload callback_url."""
+        nb = nbformat.reads(self._notebook_json(payload), as_version=4)
+        future = self.pool.submit(nb)
+        if immediate:
+            return LocalResponse(self._result(nb, *future.result()))
+        future.add_done_callback(
+            lambda f: self._callbacks.submit(self._send_callback, payload, nb, f))
+        return None
+
+    def _notebook_json(self, payload):
+        ref = payload.get('notebook_json_ref')
+        if ref is None:
+            return payload['notebook_json']
+        r = requests.get(ref['url'])
+        r.raise_for_status()
+        data = gunzip_if_needed(r.content)
+        if notebook_digest(data) != ref['sha256']:
+            raise ValueError("Payload digest mismatch: {}".format(ref['name']))
+        return data
+
+    def _result(self, nb, points, had_errors):
+        return dict(points=points, had_errors=had_errors,
+                    graded_json=nbformat.writes(nb, 4))
+
+    def _send_callback(self, payload, nb, future):
+        try:
+            points, had_errors = future.result()
+            data = self._result(nb, points, had_errors)
+            data['nonce'] = payload.get('nonce')
+            r = requests.post(payload["callback_url"], json=data)
+            r.raise_for_status()
+        except Exception:
+            traceback.print_exc()
+
+
+_local_grader = None
+_local_grader_lock = threading.Lock()
+
+def get_local_grader():
+    """Returns the local grader, starting its pool on first use."""
+    global _local_grader
+    from .settings import (LOCAL_GRADER_WORKERS, LOCAL_GRADER_MAX_RUNS_PER_KERNEL,
+                           LOCAL_GRADER_MAX_MEMORY_GROWTH, LOCAL_GRADER_CELL_TIMEOUT,
+                           LOCAL_GRADER_SNAPSHOT_SETUP, LOCAL_GRADER_MAX_SNAPSHOTS)
+    with _local_grader_lock:
+        if _local_grader is None:
+            _local_grader = LocalGrader(GradingPool(
+                num_workers=LOCAL_GRADER_WORKERS,
+                max_runs_per_kernel=LOCAL_GRADER_MAX_RUNS_PER_KERNEL,
+                max_memory_growth=LOCAL_GRADER_MAX_MEMORY_GROWTH,
+                cell_timeout=LOCAL_GRADER_CELL_TIMEOUT,
+                snapshot_setup=LOCAL_GRADER_SNAPSHOT_SETUP,
+                max_snapshots=LOCAL_GRADER_MAX_SNAPSHOTS))
+        return _local_grader
+
+
+def benchmark(pool, nb, n=20):
+    """Grades n copies of nb with the pool, and returns the number of
+    notebooks graded per second."""
+    # Warms up the workers, so kernel startup is not measured.
+    for f in [pool.submit(nbformat.from_dict(nb)) for _ in range(pool.num_workers)]:
+        f.result()
+    t = time.perf_counter()
+    futures = [pool.submit(nbformat.from_dict(nb)) for _ in range(n)]
+    for f in futures:
+        f.result()
+    return n / (time.perf_counter() - t)
+
+
+##################################
+# Tests
+
+def _test_notebook():
+    def code(source, **meta):
+        c = nbformat.v4.new_code_cell(source)
+        c.metadata.notebookgrader = nbformat.NotebookNode(meta)
+        return c
+    nb = nbformat.v4.new_notebook()
+    nb.cells = [
+        nbformat.v4.new_markdown_cell("# Test"),
+        code("x = 2\nprint(x)", is_solution=True),
+        code("assert x == 2", is_tests=True, test_points=5),
+        code("assert x == 3", is_tests=True, test_points=3),
+        code("y = 1\nassert x + y == 3", is_tests=True, test_points=2),
+    ]
+    return nb
+
+
+def test_grade_notebook():
+    worker = KernelWorker().start()
+    try:
+        nb = _test_notebook()
+        points, had_errors = grade_notebook(worker, nb, cell_timeout=30)
+        assert (points, had_errors) == (7, True)
+        assert [c.metadata.notebookgrader.get('points_earned') for c in nb.cells[2:]] == [5, 0, 2]
+        assert nb.cells[1].outputs[0].text == "2\n"
+        assert nb.cells[3].outputs[0].ename == "AssertionError"
+        # A cell that runs for too long is interrupted, and the kernel remains usable.
+        outputs, error, _ = worker.execute("import time\ntime.sleep(30)", timeout=1)
+        assert error is not None and error.ename == "TimeoutError"
+        assert not worker.is_broken
+        _, error, _ = worker.execute("assert x == 2", timeout=10)
+        assert error is None
+    finally:
+        worker.shutdown()
+
+
+def test_grading_pool():
+    pool = GradingPool(num_workers=2, max_runs_per_kernel=2, cell_timeout=30)
+    try:
+        futures = [pool.submit(_test_notebook()) for _ in range(5)]
+        assert [f.result() for f in futures] == [(7, True)] * 5
+        # State does not carry over between notebooks run in the same kernel.
+        nb = _test_notebook()
+        nb.cells[1].source = "pass"
+        assert pool.grade(nb) == (0, True)
+    finally:
+        pool.shutdown()
+
+
+def _test_notebook_with_setup(setup_time=1):
+    nb = _test_notebook()
+    setup = nbformat.v4.new_code_cell("import time\ntime.sleep({})\nbase = 40\nbase".format(setup_time))
+    setup.metadata.notebookgrader = nbformat.NotebookNode(readonly=True)
+    nb.cells.insert(1, setup)
+    nb.cells[2].metadata.notebookgrader.readonly = False
+    nb.cells.append(nbformat.v4.new_code_cell("assert base + x == 42"))
+    nb.cells[-1].metadata.notebookgrader = nbformat.NotebookNode(
+        readonly=True, is_tests=True, test_points=1)
+    return nb
+
+
+def test_split_setup():
+    setup_cells, cells = split_setup(_test_notebook_with_setup())
+    assert [c.source.splitlines()[-1] for c in setup_cells] == ["base"]
+    assert len(cells) == 5
+    assert split_setup(_test_notebook())[0] == []
+
+
+def test_snapshot_grading():
+    expected = _test_notebook_with_setup()
+    pool = GradingPool(num_workers=1, cell_timeout=30)
+    try:
+        assert pool.grade(expected) == (8, True)
+    finally:
+        pool.shutdown()
+    pool = GradingPool(num_workers=1, cell_timeout=30, snapshot_setup=True)
+    try:
+        t = time.perf_counter()
+        notebooks = [_test_notebook_with_setup() for _ in range(4)]
+        assert [pool.grade(nb) for nb in notebooks] == [(8, True)] * 4
+        # The setup cell, which takes a second, runs only once.
+        assert time.perf_counter() - t < 3
+        for nb in notebooks:
+            assert nb.cells[1].outputs[0].data['text/plain'] == "40"
+            assert ([c.metadata.notebookgrader.get('points_earned') for c in nb.cells[3:]] ==
+                    [c.metadata.notebookgrader.get('points_earned') for c in expected.cells[3:]])
+        # A submission cannot affect the following ones.
+        nb = _test_notebook_with_setup()
+        nb.cells[2].source = "x = 2\nbase = 0"
+        assert pool.grade(nb) == (7, True)
+        assert pool.grade(_test_notebook_with_setup()) == (8, True)
+    finally:
+        pool.shutdown()
+
+
+def test_snapshot_timeouts():
+    snapshot = SnapshotKernel(["x = 40"], cell_timeout=1)
+    try:
+        loop = "while True:\n    try:\n        pass\n    {}:\n        pass"
+        # Catching Exception does not catch the timeout.
+        results = snapshot.run([loop.format("except Exception"), "x"])
+        assert results[0][1].ename == "TimeoutError"
+        assert results[1][0][0].data['text/plain'] == "40"
+        # The timeout is raised again until it is not caught.
+        assert snapshot.run([loop.format("except")])[0][1].ename == "TimeoutError"
+        # A submission that ignores it is killed.
+        results = snapshot.run([
+            "import signal\nsignal.signal(signal.SIGALRM, signal.SIG_IGN)\nwhile True:\n    pass"])
+        assert results[0][1].evalue == "The submission did not stop after its cells timed out."
+        # The cells cannot write to the protocol.
+        forged = json.dumps(dict(results=[dict(outputs=[], error=None, execution_count=99)]))
+        results = snapshot.run([
+            "import os\nfor fd in range(3, 64):\n    try:\n"
+            "        os.write(fd, {!r}.encode())\n    except OSError:\n        pass".format(forged + "\n"),
+            "x + 2"])
+        assert all(r[2] != 99 for r in results)
+        assert snapshot.run(["x + 2"])[0][0][0].data['text/plain'] == "42"
+    finally:
+        snapshot.close()
+
+
+def test_benchmark_grading_pool(n=20):
+    for num_workers in (1, 2):
+        pool = GradingPool(num_workers=num_workers, max_runs_per_kernel=n)
+        try:
+            rate = benchmark(pool, _test_notebook(), n=n)
+            print("Workers: {} notebooks/s: {:.1f}".format(num_workers, rate))
+        finally:
+            pool.shutdown()
+
+
+def test_grade_reused_tests():
+    pool = GradingPool(num_workers=1, cell_timeout=30)
+    try:
+        nb = _test_notebook()
+        # The skipped test would fail if it were run.
+        nb.cells[3].metadata.notebookgrader.update(skip=True, points_earned=3)
+        assert pool.grade(nb) == (10, False)
+        assert nb.cells[3].outputs == []
+    finally:
+        pool.shutdown()
@@ -0,0 +1,402 @@
+# Scheduler of grading requests.
+# Requests are not sent (see util.send_function_request) as soon as they are
+# made; they are queued here, and sent so that:
+# - at most max_in_flight requests are being graded at any time, and at most
+#   max_per_assignment per assignment;
+# - assignments get a fair share of the grading: the assignment served next
+#   is the one that has received the least service so far, where assignments
+#   whose deadline is near are given a larger share (deadline_weight);
+# - within an assignment, the student served least recently goes first, so a
+#   student asking for many grades does not delay the others;
+# - immediate requests (instructors running their notebooks) are sent at
+#   once: they do not count towards, nor wait for, max_in_flight.
+# A request is in flight from when it is sent until its grade is received
+# (see release), or until in_flight_timeout has elapsed, in case the grade
+# never arrives.
+# The scheduler state is per process.  Requests are sent by a backend: a pool
+# of threads, or the celery workers of tasks.py.
+
+import datetime
+import threading
+import time
+import traceback
+
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+
+
+class _Job(object):
+
+    def __init__(self, payload, target_url, assignment_id, student, immediate, key):
+        self.payload = payload
+        self.target_url = target_url
+        self.assignment_id = assignment_id
+        self.student = student
+        self.immediate = immediate
+        self.key = key
+        self.future = Future()
+
+
+class _AssignmentQueue(object):
+    """The pending jobs of an assignment, by student."""
+
+    def __init__(self):
+        self.students = {} # student -> deque of jobs
+        self.last_served = {} # student -> sequence number of last job sent
+        self.served = 0
+        self.in_flight = 0
+        self.service = 0. # Weighted number of jobs sent, for fair share.
+        self.deadline = None
+
+    def push(self, job):
+        self.students.setdefault(job.student, deque()).append(job)
+
+    def pop(self):
+        """Pops the job of the student served least recently."""
+        student = min(self.students, key=lambda s: self.last_served.get(s, -1))
+        jobs = self.students[student]
+        job = jobs.popleft()
+        if not jobs:
+            del self.students[student]
+        self.served += 1
+        self.last_served[student] = self.served
+        return job
+
+    def __len__(self):
+        return sum(len(jobs) for jobs in self.students.values())
+
+
+class GradingScheduler(object):
+
+    def __init__(self, backend, max_in_flight=32, max_per_assignment=8,
+                 deadline_window=2 * 3600, deadline_weight=2, in_flight_timeout=600,
+                 tick=5):
+        """
+        Args:
+            backend: the backend that sends the requests (see ThreadBackend).
+            max_in_flight: maximum number of requests in flight.
+            max_per_assignment: maximum number of requests in flight per assignment.
+            deadline_window: time, in seconds, before the submission deadline
+                during which an assignment gets deadline_weight times the
+                share of the others.
+            in_flight_timeout: time, in seconds, after which a request that
+                has been sent no longer counts as in flight.
+            tick: interval, in seconds, at which expired requests are checked.
+        """
+        self.backend = backend
+        self.max_in_flight = max_in_flight
+        self.max_per_assignment = max_per_assignment
+        self.deadline_window = deadline_window
+        self.deadline_weight = deadline_weight
+        self.in_flight_timeout = in_flight_timeout
+        self.tick = tick
+        self._lock = threading.Lock()
+        self._immediate = deque()
+        self._assignments = {} # assignment id -> _AssignmentQueue
+        self._in_flight = {} # job -> time sent
+        self._service = 0. # Service of the last assignment served.
+        self._ticker = None
+
+    def submit(self, payload, target_url, assignment_id=None, student=None,
+               deadline=None, immediate=False, key=None):
+        """Queues a request.
+        Args:
+            payload, target_url, immediate: as in send_function_request.
+            assignment_id, student: who the request is for.
+            deadline: the submission deadline of the assignment (UTC).
+            key: the key with which release will be called once the request
+                has been completed, typically the payload nonce.  Requests
+                without key are in flight only until they are sent.
+        Returns a future, whose result is that of send_function_request."""
+        job = _Job(payload, target_url, assignment_id, student, immediate, key)
+        with self._lock:
+            if immediate:
+                self._immediate.append(job)
+            else:
+                q = self._assignments.get(assignment_id)
+                if q is None:
+                    q = self._assignments[assignment_id] = _AssignmentQueue()
+                if not q.students and not q.in_flight:
+                    # An assignment that was idle does not accumulate credit.
+                    q.service = max(q.service, self._service)
+                q.deadline = deadline
+                q.push(job)
+        self._start_ticker()
+        self._dispatch()
+        return job.future
+
+    def release(self, key):
+        """Signals that the request with the given key has been completed."""
+        with self._lock:
+            for job in [j for j in self._in_flight if j.key == key]:
+                self._end(job)
+        self._dispatch()
+
+    def pending(self):
+        """Returns the number of requests waiting to be sent."""
+        with self._lock:
+            return len(self._immediate) + sum(len(q) for q in self._assignments.values())
+
+    def in_flight(self, assignment_id=None):
+        with self._lock:
+            return sum(1 for j in self._in_flight
+                       if assignment_id is None or j.assignment_id == assignment_id)
+
+    def _dispatch(self):
+        with self._lock:
+            self._expire()
+            jobs = list(self._immediate)
+            self._immediate.clear()
+            while len(self._in_flight) < self.max_in_flight:
+                job = self._next_job()
+                if job is None:
+                    break
+                self._in_flight[job] = time.time()
+                self._assignments[job.assignment_id].in_flight += 1
+                jobs.append(job)
+        for job in jobs:
+            self.backend.run(job, self._sent)
+
+    def _next_job(self):
+        candidates = [(q.service, q.deadline or datetime.datetime.max, a)
+                      for a, q in self._assignments.items()
+                      if q.students and q.in_flight < self.max_per_assignment]
+        if not candidates:
+            return None
+        _, _, assignment_id = min(candidates, key=lambda c: c[:2])
+        q = self._assignments[assignment_id]
+        self._service = q.service
+        q.service += 1. / self._weight(q)
+        return q.pop()
+
+    def _weight(self, q):
+        if q.deadline is None:
+            return 1
+        to_deadline = (q.deadline - datetime.datetime.utcnow()).total_seconds()
+        return self.deadline_weight if 0 < to_deadline < self.deadline_window else 1
+
+    def _sent(self, job, result=None, error=None):
+        """Called by the backend when a request has been sent."""
+        if error is None:
+            job.future.set_result(result)
+        else:
+            job.future.set_exception(error)
+        if job.immediate:
+            return
+        if job.key is None or error is not None:
+            with self._lock:
+                self._end(job)
+            self._dispatch()
+
+    def _end(self, job):
+        if self._in_flight.pop(job, None) is None:
+            return
+        q = self._assignments.get(job.assignment_id)
+        if q is None:
+            return
+        q.in_flight -= 1
+        if not q.students and not q.in_flight:
+            del self._assignments[job.assignment_id]
+
+    def _expire(self):
+        limit = time.time() - self.in_flight_timeout
+        for job in [j for j, t in self._in_flight.items() if t < limit]:
+            self._end(job)
+
+    def _start_ticker(self):
+        # Requests waiting for expired ones are sent by the ticker thread.
+        with self._lock:
+            if self._ticker is not None or not self.tick:
+                return
+            self._ticker = threading.Thread(target=self._tick, daemon=True)
+        self._ticker.start()
+
+    def _tick(self):
+        while True:
+            time.sleep(self.tick)
+            try:
+                self._dispatch()
+            except Exception:
+                traceback.print_exc()
+
+
+class ThreadBackend(object):
+    """Sends requests from a pool of threads of this process.  Immediate
+    requests have threads of their own, so they do not wait for the others."""
+
+    def __init__(self, send, max_workers=8, immediate_workers=2):
+        """send is the function sending a request, with the signature of
+        util.send_function_request."""
+        self.send = send
+        self._executor = ThreadPoolExecutor(max_workers=max_workers,
+                                            thread_name_prefix="grading-scheduler")
+        self._immediate_executor = ThreadPoolExecutor(max_workers=immediate_workers,
+                                                      thread_name_prefix="grading-immediate")
+
+    def run(self, job, done):
+        executor = self._immediate_executor if job.immediate else self._executor
+        executor.submit(self._run, job, done)
+
+    def _run(self, job, done):
+        try:
+            result = self.send(job.payload, job.target_url, immediate=job.immediate)
+        except Exception as e:
+            traceback.print_exc()
+            done(job, error=e)
+        else:
+            done(job, result=result)
+
+
+class CeleryBackend(object):
+    """Sends requests from the celery workers, via the task
+    tasks.send_grading_request.  Immediate requests, whose result is
+    needed, are sent from this process."""
+
+    def __init__(self, task, send, max_workers=2):
+        self.task = task
+        self._local = ThreadBackend(send, max_workers=max_workers)
+
+    def run(self, job, done):
+        if job.immediate:
+            return self._local.run(job, done)
+        try:
+            self.task.delay(job.payload, job.target_url)
+        except Exception as e:
+            traceback.print_exc()
+            done(job, error=e)
+        else:
+            done(job)
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+def get_grading_scheduler():
+    """Returns the grading scheduler of this process, configured by settings."""
+    global _scheduler
+    from .settings import (GRADING_SCHEDULER_BACKEND, GRADING_SCHEDULER_WORKERS,
+                           GRADING_SCHEDULER_MAX_IN_FLIGHT, GRADING_SCHEDULER_MAX_PER_ASSIGNMENT,
+                           GRADING_SCHEDULER_DEADLINE_WINDOW, GRADING_SCHEDULER_DEADLINE_WEIGHT,
+                           GRADING_SCHEDULER_IN_FLIGHT_TIMEOUT)
+    from .util import send_function_request
+    with _scheduler_lock:
+        if _scheduler is None:
+            if GRADING_SCHEDULER_BACKEND == "celery":
+                from .tasks import send_grading_request
+                backend = CeleryBackend(send_grading_request, send_function_request)
+            else:
+                backend = ThreadBackend(send_function_request, max_workers=GRADING_SCHEDULER_WORKERS)
+            _scheduler = GradingScheduler(
+                backend,
+                max_in_flight=GRADING_SCHEDULER_MAX_IN_FLIGHT,
+                max_per_assignment=GRADING_SCHEDULER_MAX_PER_ASSIGNMENT,
+                deadline_window=GRADING_SCHEDULER_DEADLINE_WINDOW,
+                deadline_weight=GRADING_SCHEDULER_DEADLINE_WEIGHT,
+                in_flight_timeout=GRADING_SCHEDULER_IN_FLIGHT_TIMEOUT)
+        return _scheduler
+
+
+##################################
+# Tests
+
+class _RecordingBackend(object):
+    """Records the jobs sent, and completes the sending at once."""
+
+    def __init__(self):
+        self.sent = []
+
+    def run(self, job, done):
+        self.sent.append(job)
+        done(job, result=job.payload)
+
+
+def _scheduler_for_test(**kwargs):
+    backend = _RecordingBackend()
+    return GradingScheduler(backend, tick=0, **kwargs), backend
+
+
+def test_fair_share_between_assignments():
+    scheduler, backend = _scheduler_for_test(max_in_flight=1)
+    futures = [scheduler.submit(dict(n=i), "url", assignment_id="big", student=i, key=i)
+               for i in range(6)]
+    futures += [scheduler.submit(dict(n=i), "url", assignment_id="small", student=i, key=i + 10)
+                for i in range(2)]
+    for i in range(8):
+        scheduler.release(backend.sent[-1].key)
+    # The first request was sent right away, then the assignments alternate.
+    assert [j.assignment_id for j in backend.sent] == (
+        ["big", "small", "big", "small", "big", "big", "big", "big"])
+    assert futures[0].result() == dict(n=0)
+    assert scheduler.pending() == 0 and scheduler.in_flight() == 0
+
+
+def test_round_robin_students_and_caps():
+    scheduler, backend = _scheduler_for_test(max_in_flight=10, max_per_assignment=2)
+    for i in range(3):
+        scheduler.submit({}, "url", assignment_id="a", student="eager", key="e%d" % i)
+    scheduler.submit({}, "url", assignment_id="a", student="other", key="o")
+    assert [j.student for j in backend.sent] == ["eager", "eager"]
+    assert scheduler.in_flight("a") == 2
+    scheduler.release("e0")
+    scheduler.release("e1")
+    # The other student goes before the third request of the eager one.
+    assert [j.student for j in backend.sent[2:]] == ["other", "eager"]
+    # Immediate requests are not subject to the assignment cap.
+    scheduler.submit({}, "url", assignment_id="a", immediate=True)
+    assert len(backend.sent) == 5 and scheduler.in_flight() == 2
+
+
+def test_immediate_requests_bypass_the_cap():
+    scheduler, backend = _scheduler_for_test(max_in_flight=1)
+    scheduler.submit({}, "url", assignment_id="a", student="s", key="k")
+    scheduler.submit({}, "url", assignment_id="a", student="t", key="k2")
+    future = scheduler.submit(dict(n=1), "url", assignment_id="a", immediate=True)
+    # The immediate request is sent although the grader slot is taken.
+    assert future.result(timeout=1) == dict(n=1)
+    assert [j.immediate for j in backend.sent] == [False, True]
+    assert scheduler.in_flight() == 1 and scheduler.pending() == 1
+
+
+def test_deadline_priority():
+    scheduler, backend = _scheduler_for_test(max_in_flight=1, deadline_weight=3)
+    now = datetime.datetime.utcnow()
+    scheduler.submit({}, "url", assignment_id="blocker", key="b")
+    for i in range(8):
+        scheduler.submit({}, "url", assignment_id="due", student=i, key=i,
+                         deadline=now + datetime.timedelta(minutes=30))
+        scheduler.submit({}, "url", assignment_id="later", student=i, key=i + 10,
+                         deadline=now + datetime.timedelta(days=3))
+    for _ in range(8):
+        scheduler.release(backend.sent[-1].key)
+    order = [j.assignment_id for j in backend.sent[1:]]
+    assert order.count("due") == 6 and order.count("later") == 2
+
+
+def test_failures_and_timeouts():
+    scheduler, backend = _scheduler_for_test(max_in_flight=1, in_flight_timeout=0.1)
+    def fail(job, done):
+        done(job, error=RuntimeError("unreachable"))
+    backend.run = fail
+    future = scheduler.submit({}, "url", assignment_id="a", key="k")
+    assert isinstance(future.exception(), RuntimeError)
+    assert scheduler.in_flight() == 0
+    backend.run = _RecordingBackend().run
+    scheduler.submit({}, "url", assignment_id="a", key="k1")
+    scheduler.submit({}, "url", assignment_id="a", key="k2")
+    assert scheduler.pending() == 1
+    # The grade of k1 never arrives.
+    time.sleep(0.2)
+    scheduler._dispatch()
+    assert scheduler.pending() == 0
+
+
+def test_thread_backend():
+    sent = []
+    def send(payload, target_url, immediate=False):
+        sent.append(payload)
+        return len(sent)
+    scheduler = GradingScheduler(ThreadBackend(send, max_workers=4), max_in_flight=4, tick=0)
+    futures = [scheduler.submit(dict(n=i), "url", assignment_id=i % 3, student=i)
+               for i in range(20)]
+    assert sorted(f.result(timeout=10) for f in futures) == list(range(1, 21))
+    assert scheduler.pending() == 0
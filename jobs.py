@@ -0,0 +1,391 @@
+# Background jobs.
+# A job is a call to a function registered as a job kind (see job_kind),
+# with json arguments.  Jobs are recorded in the job table, and run outside of
+# the request that creates them by an executor: a pool of threads of the app,
+# or the celery workers (see tasks.py).
+# A job that raises an exception is retried with exponential backoff, up to
+# the max_attempts of its kind.  Jobs can have an idempotency key, unique
+# across kinds (by convention, it starts with the kind): a job with the same
+# key is created only once.
+# A job is created in the transaction of the caller, and runs once this is
+# committed; if it is rolled back, the job does not run.
+# Jobs run at least once: jobs whose run was lost (e.g., in a restart) are
+# run again by sweep, so job functions must be safe to run again.  They run
+# with a db connection of their own, which is committed if they succeed.
+
+import datetime
+import json
+import random
+import threading
+import time
+import traceback
+
+from concurrent.futures import ThreadPoolExecutor
+
+from pydal import Field
+
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+# Registered job kinds, by name.
+KINDS = {}
+
+# A job that is not yet committed when it is run is submitted again, every
+# UNCOMMITTED_RETRY_DELAY seconds, up to UNCOMMITTED_MAX_RETRIES times; after
+# that, it is left to sweep.
+UNCOMMITTED_RETRY_DELAY = 1
+UNCOMMITTED_MAX_RETRIES = 30
+
+
+class JobKind(object):
+
+    def __init__(self, name, fn, max_attempts=5, backoff=10, max_backoff=3600):
+        """
+        Args:
+            name: name of the kind.
+            fn: function called with the job arguments.
+            max_attempts: number of times the job is run before it fails.
+            backoff: delay, in seconds, before the first retry; the delay
+                doubles at each retry, up to max_backoff.
+        """
+        self.name = name
+        self.fn = fn
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+    def retry_delay(self, attempts):
+        """Delay before retrying a job that has been run attempts times."""
+        delay = min(self.max_backoff, self.backoff * 2 ** (attempts - 1))
+        return delay * (1 + random.random() / 2)
+
+
+def job_kind(name, **kwargs):
+    """Decorator registering a function as a job kind; kwargs are as in JobKind.
+    The module defining the function must be imported by the processes that
+    run jobs (see tasks.py)."""
+    def decorator(fn):
+        KINDS[name] = JobKind(name, fn, **kwargs)
+        return fn
+    return decorator
+
+
+def define_job_table(db):
+    db.define_table(
+        'job',
+        Field('kind'),
+        Field('args', 'text'), # Json dictionary of arguments.
+        Field('idempotency_key', unique=True),
+        Field('status', default=PENDING),
+        Field('attempts', 'integer', default=0),
+        Field('run_after', 'datetime'), # Jobs are not run before this time.
+        Field('created_on', 'datetime', default=datetime.datetime.utcnow),
+        Field('updated_on', 'datetime', default=datetime.datetime.utcnow),
+        Field('last_error', 'text'),
+    )
+
+
+class JobQueue(object):
+
+    def __init__(self, db, executor, running_timeout=3600, sweep_grace=60):
+        """
+        Args:
+            db: the db, with the job table.
+            executor: the executor running the jobs (see ThreadExecutor).
+            running_timeout: time, in seconds, after which a job still running
+                is considered lost, and is run again.
+            sweep_grace: time, in seconds, after which a job that is due, but
+                has not been run, is considered lost.
+        """
+        self.db = db
+        self.executor = executor
+        self.running_timeout = running_timeout
+        self.sweep_grace = sweep_grace
+        executor.bind(self)
+
+    def enqueue(self, kind, args=None, idempotency_key=None, delay=0):
+        """Creates a job, and submits it to the executor.  The job runs once
+        the caller commits the db (py4web does so at the end of requests).
+        Returns the job id; if a job with the same idempotency key exists,
+        this is the id of that job, and no job is created."""
+        db = self.db
+        if kind not in KINDS:
+            raise ValueError("Unknown job kind: {}".format(kind))
+        if idempotency_key is not None:
+            existing = self._find(idempotency_key)
+            if existing is not None:
+                return existing.id
+        now = datetime.datetime.utcnow()
+        try:
+            job_id = db.job.insert(
+                kind=kind,
+                args=json.dumps(args or {}),
+                idempotency_key=idempotency_key,
+                run_after=now + datetime.timedelta(seconds=delay),
+            )
+        except Exception:
+            # Another transaction may have created the job in the meantime,
+            # violating the uniqueness of the key.
+            existing = None if idempotency_key is None else self._find(
+                idempotency_key, for_update=True)
+            if existing is None:
+                raise
+            return existing.id
+        self.executor.submit(job_id, delay)
+        return job_id
+
+    def _find(self, idempotency_key, for_update=False):
+        """Returns the job with the key.  With for_update, the job is read
+        even if it was committed after the transaction began."""
+        db = self.db
+        return db(db.job.idempotency_key == idempotency_key).select(
+            db.job.id, for_update=for_update).first()
+
+    def run(self, job_id, retries=0):
+        """Runs a job, if it is pending.  Called by the executors; retries
+        counts the times the job was not yet committed."""
+        db = self.db
+        try:
+            db._adapter.reconnect()
+            job = self._claim(job_id)
+            if job is None:
+                if db.job[job_id] is None and retries < UNCOMMITTED_MAX_RETRIES:
+                    # The transaction that created the job has not been committed yet.
+                    self.executor.submit(job_id, UNCOMMITTED_RETRY_DELAY, retries + 1)
+                return
+            kind = KINDS.get(job.kind)
+            try:
+                if kind is None:
+                    raise ValueError("Unknown job kind: {}".format(job.kind))
+                kind.fn(**json.loads(job.args or "{}"))
+                db.commit()
+            except Exception as e:
+                traceback.print_exc()
+                db.rollback()
+                self._failed(job, kind, e)
+            else:
+                db(db.job.id == job_id).update(status=DONE, updated_on=datetime.datetime.utcnow())
+                db.commit()
+        except:
+            traceback.print_exc()
+            db.rollback()
+        finally:
+            db._adapter.close()
+
+    def _claim(self, job_id):
+        """Marks a pending job as running, and returns it, or None if the job
+        is not pending (e.g., another worker got it first)."""
+        db = self.db
+        claimed = db((db.job.id == job_id) & (db.job.status == PENDING)).update(
+            status=RUNNING, attempts=db.job.attempts + 1, updated_on=datetime.datetime.utcnow())
+        db.commit()
+        return db.job[job_id] if claimed else None
+
+    def _failed(self, job, kind, e):
+        db = self.db
+        now = datetime.datetime.utcnow()
+        error = "{}: {}".format(type(e).__name__, e)
+        if kind is not None and job.attempts < kind.max_attempts:
+            delay = kind.retry_delay(job.attempts)
+            db(db.job.id == job.id).update(
+                status=PENDING, last_error=error, updated_on=now,
+                run_after=now + datetime.timedelta(seconds=delay))
+            db.commit()
+            self.executor.submit(job.id, delay)
+        else:
+            db(db.job.id == job.id).update(status=FAILED, last_error=error, updated_on=now)
+            db.commit()
+
+    def sweep(self):
+        """Submits again the jobs whose run has been lost.  Must be called
+        with a db connection.  Returns the number of jobs submitted."""
+        db = self.db
+        now = datetime.datetime.utcnow()
+        lost_running = db((db.job.status == RUNNING) &
+                          (db.job.updated_on < now - datetime.timedelta(seconds=self.running_timeout))).select(
+            db.job.id, db.job.kind, db.job.attempts)
+        for job in lost_running:
+            kind = KINDS.get(job.kind)
+            # Jobs that have used all their attempts are not run again.
+            exhausted = kind is None or job.attempts >= kind.max_attempts
+            db((db.job.id == job.id) & (db.job.status == RUNNING)).update(
+                status=FAILED if exhausted else PENDING, updated_on=now,
+                last_error="The job was interrupted." if exhausted else None)
+        db.commit()
+        lost = db((db.job.status == PENDING) &
+                  (db.job.run_after < now - datetime.timedelta(seconds=self.sweep_grace))).select(
+            db.job.id)
+        for job in lost:
+            self.executor.submit(job.id, 0)
+        return len(lost)
+
+
+class ThreadExecutor(object):
+    """Runs jobs in a pool of threads of this process.  Jobs are retried and
+    swept only while the process runs."""
+
+    def __init__(self, max_workers=4, sweep_interval=60):
+        self.max_workers = max_workers
+        self.sweep_interval = sweep_interval
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="jobs")
+        self.queue = None
+
+    def bind(self, queue):
+        self.queue = queue
+        if self.sweep_interval:
+            threading.Thread(target=self._sweep, daemon=True).start()
+
+    def submit(self, job_id, delay=0, retries=0):
+        if delay > 0:
+            timer = threading.Timer(delay, self._executor.submit, (self.queue.run, job_id, retries))
+            timer.daemon = True
+            timer.start()
+        else:
+            self._executor.submit(self.queue.run, job_id, retries)
+
+    def _sweep(self):
+        db = self.queue.db
+        while True:
+            time.sleep(self.sweep_interval)
+            try:
+                db._adapter.reconnect()
+                self.queue.sweep()
+            except:
+                traceback.print_exc()
+                db.rollback()
+            finally:
+                db._adapter.close()
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
+
+
+class CeleryExecutor(object):
+    """Runs jobs in the celery workers, via the tasks.run_job task.
+    Sweeping is done by the celery beat schedule."""
+
+    def __init__(self, task):
+        self.task = task
+
+    def bind(self, queue):
+        self.queue = queue
+
+    def submit(self, job_id, delay=0, retries=0):
+        self.task.apply_async(args=[job_id, retries], countdown=delay)
+
+
+_job_queue = None
+_job_queue_lock = threading.Lock()
+
+def get_job_queue():
+    """Returns the job queue of the app, configured by settings."""
+    global _job_queue
+    from .common import db
+    from .settings import JOB_EXECUTOR, JOB_WORKERS, JOB_SWEEP_INTERVAL, JOB_RUNNING_TIMEOUT
+    with _job_queue_lock:
+        if _job_queue is None:
+            if JOB_EXECUTOR == "celery":
+                from .tasks import run_job
+                executor = CeleryExecutor(run_job)
+            else:
+                executor = ThreadExecutor(max_workers=JOB_WORKERS, sweep_interval=JOB_SWEEP_INTERVAL)
+            _job_queue = JobQueue(db, executor, running_timeout=JOB_RUNNING_TIMEOUT)
+        return _job_queue
+
+
+def enqueue_job(kind, args=None, idempotency_key=None, delay=0):
+    """Creates a job in the job queue of the app (see JobQueue.enqueue)."""
+    return get_job_queue().enqueue(kind, args=args, idempotency_key=idempotency_key, delay=delay)
+
+
+##################################
+# Tests
+
+def _test_queue(tmp_path, **kwargs):
+    from pydal import DAL
+    db = DAL("sqlite://jobs.sqlite", folder=str(tmp_path))
+    define_job_table(db)
+    executor = ThreadExecutor(max_workers=2, sweep_interval=0)
+    return JobQueue(db, executor, **kwargs), executor
+
+
+def _wait_for(db, job_id, timeout=10):
+    t = time.time()
+    while time.time() - t < timeout:
+        db.commit()
+        job = db.job[job_id]
+        if job.status in (DONE, FAILED):
+            return job
+        time.sleep(0.05)
+    return db.job[job_id]
+
+
+def test_jobs(tmp_path):
+    results = []
+    job_kind("test_append")(lambda value: results.append(value))
+    queue, executor = _test_queue(tmp_path)
+    job_id = queue.enqueue("test_append", dict(value=1), idempotency_key="k")
+    # A job with the same key is not created.
+    assert queue.enqueue("test_append", dict(value=2), idempotency_key="k") == job_id
+    queue.db.commit()
+    job = _wait_for(queue.db, job_id)
+    assert job.status == DONE and job.attempts == 1
+    assert results == [1]
+    executor.shutdown()
+
+
+def test_job_retries(tmp_path):
+    attempts = []
+    def flaky(n):
+        attempts.append(n)
+        if len(attempts) < n:
+            raise RuntimeError("Not yet")
+    job_kind("test_flaky", max_attempts=3, backoff=0.1)(flaky)
+    queue, executor = _test_queue(tmp_path)
+    job_id = queue.enqueue("test_flaky", dict(n=3))
+    queue.db.commit()
+    job = _wait_for(queue.db, job_id)
+    assert job.status == DONE and job.attempts == 3
+    attempts.clear()
+    job_id = queue.enqueue("test_flaky", dict(n=5))
+    queue.db.commit()
+    job = _wait_for(queue.db, job_id)
+    assert job.status == FAILED and job.attempts == 3
+    assert job.last_error == "RuntimeError: Not yet"
+    executor.shutdown()
+
+
+def test_job_sweep(tmp_path):
+    results = []
+    job_kind("test_sweep")(lambda: results.append(True))
+    queue, executor = _test_queue(tmp_path, running_timeout=5, sweep_grace=5)
+    db = queue.db
+    # A job whose run was lost while running.
+    started = datetime.datetime.utcnow() - datetime.timedelta(seconds=10)
+    job_id = db.job.insert(kind="test_sweep", args="{}", status=RUNNING,
+                           run_after=started, updated_on=started)
+    # One that has used all its attempts.
+    exhausted_id = db.job.insert(kind="test_sweep", args="{}", status=RUNNING, attempts=5,
+                                 run_after=started, updated_on=started)
+    db.commit()
+    assert queue.sweep() == 1
+    assert _wait_for(db, job_id).status == DONE
+    assert results == [True]
+    assert db.job[exhausted_id].status == FAILED
+    executor.shutdown()
+
+
+def test_job_idempotency_race(tmp_path):
+    job_kind("test_race")(lambda: None)
+    queue, executor = _test_queue(tmp_path)
+    db = queue.db
+    job_id = db.job.insert(kind="test_race", args="{}", idempotency_key="race")
+    db.commit()
+    # The job is created by another request after the key is looked up.
+    find = queue._find
+    queue._find = lambda key, for_update=False: find(key) if for_update else None
+    assert queue.enqueue("test_race", idempotency_key="race") == job_id
+    assert db(db.job.idempotency_key == "race").count() == 1
+    executor.shutdown()
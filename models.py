@@ -4,15 +4,23 @@ This file defines the database models
 
 import datetime
 import json
-from .common import db, Field, auth
+import nbformat
+import threading
+import time
+from .common import db, Field, auth, gcs, notebook_cache, master_notebook_cache, grading_skeleton_cache
+from .common import drive_service_pool
+from .notebook_cache import notebook_digest
+from .jobs import define_job_table
+from .run_notebook import GradingSkeleton
 from pydal.validators import IS_INT_IN_RANGE
 import re
-from .util import random_id
+from .util import random_id, long_random_id, gzip_bytes, gunzip_if_needed
+from .notebook_logic import compact_outputs
 from py4web import redirect, URL
 
-from googleapiclient.discovery import build
-import google.oauth2.credentials
-from .settings import ADMIN_EMAIL
+from .settings import ADMIN_EMAIL, GCS_BUCKET, GCS_SUBMISSIONS_BUCKET
+from .settings import STORED_NOTEBOOK_OUTPUTS, STORED_NOTEBOOK_MAX_OUTPUT_SIZE, STORED_NOTEBOOK_GZIP
+from .settings import PAYLOADS_BY_REFERENCE, PAYLOAD_PREFIX, PAYLOAD_URL_EXPIRATION, PAYLOAD_REWRITE_AFTER
 
 
 def get_user_email():
@@ -21,18 +29,33 @@ def get_user_email():
 def get_time():
     return datetime.datetime.utcnow()
 
-def build_drive_service(user=None):
-    # Reads the credentials.
+def build_drive_service(user=None, credentials_json=None):
+    """Returns a Drive service for the user.
+    If credentials_json (see read_drive_credentials) is given, the db is not
+    used, so the service can be built in threads without a db connection;
+    refreshed credentials are then not saved."""
     user = user or get_user_email()
+    if credentials_json is not None:
+        return drive_service_pool.get(user, credentials_json)
+    # Reads the credentials.
     user_info = db(
-        db.auth_credentials.email == user).select().first()
+        db.auth_credentials.email == user).select(
+        db.auth_credentials.id, db.auth_credentials.credentials).first()
     if not user_info:
         print("No user credentials")
         return None
-    credentials_dict = json.loads(user_info.credentials)
-    creds = google.oauth2.credentials.Credentials(**credentials_dict)
-    drive_service = build('drive', 'v3', credentials=creds)
-    return drive_service
+    def save_credentials(credentials_json):
+        # Refreshed tokens are saved, so they are not refreshed again.
+        db(db.auth_credentials.id == user_info.id).update(credentials=credentials_json)
+    return drive_service_pool.get(user, user_info.credentials,
+                                  save_credentials=save_credentials)
+
+def read_drive_credentials(user=None):
+    """Returns the stored credentials json of the user, or None."""
+    user = user or get_user_email()
+    user_info = db(db.auth_credentials.email == user).select(
+        db.auth_credentials.credentials).first()
+    return None if user_info is None else user_info.credentials
 
 ### Define your table below
 #
@@ -48,6 +71,8 @@ db.define_table(
     Field('created_on', 'datetime', default=get_time),
     Field('master_id_gcs'), # Locations of master and student notebooks
     Field('student_id_gcs'), # in gcs and drive.
+    Field('master_digest'), # Content digests of master and student notebooks,
+    Field('student_digest'), # used as keys in the notebook cache.
     Field('master_id_drive'),
     Field('student_id_drive'),
     Field('available_from', 'datetime'),
@@ -63,6 +88,37 @@ db.define_table(
 db.assignment.max_submissions_in_24h_period.requires = IS_INT_IN_RANGE(1, 100)
 db.assignment.ai_feedback.requires = IS_INT_IN_RANGE(0, 2)
 
+db.define_table(
+    'course_copy', # Progress of a copy of many assignments (see assignment_copy.py).
+    Field('owner', default=get_user_email),
+    Field('created_on', 'datetime', default=get_time),
+    Field('total', 'integer'), # Number of assignments to copy.
+    Field('completed', 'integer', default=0),
+    Field('failed', 'integer', default=0),
+    Field('is_done', 'boolean', default=False),
+    Field('new_ids', 'text'), # Json list of the ids of the new assignments.
+    Field('errors', 'text'), # Json list of error messages.
+)
+
+db.define_table(
+    'acl_sync', # Sharing of the files of an assignment with its teachers (see acl_sync.py).
+    Field('assignment_id', 'reference assignment', ondelete="CASCADE"),
+    Field('owner', default=get_user_email),
+    Field('created_on', 'datetime', default=get_time),
+    Field('updated_on', 'datetime', default=get_time),
+    Field('add_users', 'text'), # Json lists of emails.
+    Field('remove_users', 'text'),
+    Field('total', 'integer'), # Number of files.
+    Field('completed', 'integer', default=0),
+    Field('failed', 'integer', default=0),
+    Field('done_groups', 'text'), # Json list of the file owners already handled.
+    Field('errors', 'text'), # Json list of error messages.
+    Field('is_done', 'boolean', default=False),
+)
+
+# Background jobs (see jobs.py).
+define_job_table(db)
+
 db.define_table(
     'access',
     Field('user'),
@@ -91,6 +147,7 @@ db.define_table(
     Field('submission_id_gcs'), # Location in GCS of submission
     Field('is_valid', 'boolean', default=False),
     Field('cell_id_to_points', 'text'), # Json dictionary of grade breakdown.
+    Field('cell_hashes', 'text'), # Json dictionary of test cell hashes, for incremental grading.
 )
 
 db.define_table(
@@ -98,9 +155,11 @@ db.define_table(
     Field('homework_id', 'reference homework', ondelete="SET NULL"),
     Field('student', default=get_user_email),
     Field('input_id_gcs'), # Location in GCS of what was graded.
+    Field('submission_hash'), # See run_notebook.submission_hash.
     Field('created_on', 'datetime', default=get_time),
     Field('request_nonce', default=random_id),
     Field('completed', 'boolean', default=False),
+    Field('failed', 'boolean', default=False), # The request could not be enqueued.
     Field('grade', 'float'),
     Field('delay', 'float'),
 )
@@ -154,5 +213,148 @@ def can_access_assignment(assignment_id):
         not db((db.access.assignment_id == assignment_id) &
                (db.access.user == get_user_email())).isempty())
 
+def read_assignment_notebook(assignment, master=False):
+    """Returns the bytes of the student (or master) notebook of an assignment,
+    reading them from GCS only if they are not in the notebook cache.
+    Records the digest of the notebook if it was missing."""
+    id_gcs = assignment.master_id_gcs if master else assignment.student_id_gcs
+    digest_field = 'master_digest' if master else 'student_digest'
+    digest = assignment[digest_field]
+    data, new_digest = notebook_cache.get_or_load(
+        digest, lambda: gcs.read(GCS_BUCKET, id_gcs))
+    if new_digest != digest:
+        assignment.update_record(**{digest_field: new_digest})
+    return data
+
+def copy_gcs_object(bucket, source_name, dest_name):
+    """Copies an object within GCS, without its data going through the app.
+    Large objects can take more than one rewrite call."""
+    gcs_bucket = gcs.client.bucket(bucket)
+    source, dest = gcs_bucket.blob(source_name), gcs_bucket.blob(dest_name)
+    token, _, _ = dest.rewrite(source)
+    while token is not None:
+        token, _, _ = dest.rewrite(source, token=token)
+
+def read_master_notebook(assignment):
+    """Returns the parsed master notebook of an assignment, as a view that
+    the caller can modify (see notebook_view).  The parsed notebook is
+    cached, keyed by the GCS name and digest of the master."""
+    nb = master_notebook_cache.get(assignment.master_id_gcs, assignment.master_digest)
+    if nb is None:
+        master_json = read_assignment_notebook(assignment, master=True)
+        nb = master_notebook_cache.put(assignment.master_id_gcs, assignment.master_digest,
+                                       nbformat.reads(master_json, as_version=4))
+    return nb
+
+def read_grading_skeleton(assignment):
+    """Returns the grading skeleton of the master notebook of an assignment,
+    cached like the master itself."""
+    skeleton = grading_skeleton_cache.get(assignment.master_id_gcs, assignment.master_digest)
+    if skeleton is None:
+        master_nb = read_master_notebook(assignment)
+        skeleton = grading_skeleton_cache.put(assignment.master_id_gcs, assignment.master_digest,
+                                              GradingSkeleton(master_nb))
+    return skeleton
+
+def invalidate_master_caches(master_id_gcs):
+    """Removes from the caches of this process all versions of a master."""
+    master_notebook_cache.invalidate(master_id_gcs)
+    grading_skeleton_cache.invalidate(master_id_gcs)
+
+def write_stored_notebook(id_gcs, notebook_json):
+    """Writes a submission or feedback notebook to the submissions bucket,
+    compacting its outputs and compressing it as configured in the settings."""
+    if STORED_NOTEBOOK_OUTPUTS != "keep":
+        nb = json.loads(notebook_json)
+        if compact_outputs(nb, STORED_NOTEBOOK_MAX_OUTPUT_SIZE, mode=STORED_NOTEBOOK_OUTPUTS) > 0:
+            notebook_json = json.dumps(nb, ensure_ascii=False)
+    if STORED_NOTEBOOK_GZIP:
+        gcs.write(GCS_SUBMISSIONS_BUCKET, id_gcs, gzip_bytes(notebook_json),
+                  type="application/gzip")
+    else:
+        gcs.write(GCS_SUBMISSIONS_BUCKET, id_gcs, notebook_json,
+                  type="application/json")
+
+def read_stored_notebook(id_gcs):
+    """Reads a notebook written with write_stored_notebook (or before it
+    existed), returning its json bytes."""
+    return gunzip_if_needed(gcs.read(GCS_SUBMISSIONS_BUCKET, id_gcs))
+
+# Digests of the payloads written by this process, with the time they were
+# written: they need not be written again until PAYLOAD_REWRITE_AFTER.
+_written_payloads = {}
+_written_payloads_lock = threading.Lock()
+MAX_WRITTEN_PAYLOADS = 4096
+
+def _signed_url(name, method="GET", content_type=None):
+    blob = gcs.client.bucket(GCS_SUBMISSIONS_BUCKET).blob(name)
+    return blob.generate_signed_url(
+        version="v4", method=method, content_type=content_type,
+        expiration=datetime.timedelta(seconds=PAYLOAD_URL_EXPIRATION))
+
+def write_payload_notebook(notebook_json):
+    """Writes a notebook sent to the grading or feedback functions, and returns
+    a reference to it.  Payloads are named by their digest, so the same notebook
+    (e.g., the master sent with every AI feedback request) is written only once."""
+    digest = notebook_digest(notebook_json)
+    name = PAYLOAD_PREFIX + digest
+    now = time.time()
+    with _written_payloads_lock:
+        written_at = _written_payloads.get(digest)
+    # The payloads are deleted by the bucket lifecycle rule, so they are
+    # written again from time to time, which renews them.
+    if written_at is None or now - written_at > PAYLOAD_REWRITE_AFTER:
+        gcs.write(GCS_SUBMISSIONS_BUCKET, name, gzip_bytes(notebook_json),
+                  type="application/gzip")
+        with _written_payloads_lock:
+            if len(_written_payloads) >= MAX_WRITTEN_PAYLOADS:
+                _written_payloads.clear()
+            _written_payloads[digest] = now
+    return dict(bucket=GCS_SUBMISSIONS_BUCKET, name=name, sha256=digest,
+                encoding="gzip", url=_signed_url(name))
+
+def add_payload_notebooks(payload, notebooks, result_upload=False):
+    """Adds notebooks to the payload of a grading or feedback request.
+    Args:
+        payload: the payload dictionary, which is modified.
+        notebooks: dictionary mapping payload keys to notebook json.
+        result_upload: whether the function can return its result by reference.
+    If PAYLOADS_BY_REFERENCE is False, the notebooks are included in the payload.
+    Otherwise, the payload contains, for each key, a key + '_ref' entry with the
+    reference to the notebook (see write_payload_notebook), and if result_upload
+    is True, a 'result_upload' entry with a GCS name and signed url where the
+    function can upload (PUT) its result."""
+    if not PAYLOADS_BY_REFERENCE:
+        payload.update(notebooks)
+        return payload
+    for key, notebook_json in notebooks.items():
+        payload[key + '_ref'] = write_payload_notebook(notebook_json)
+    if result_upload:
+        name = PAYLOAD_PREFIX + "results/" + long_random_id()
+        payload['result_upload'] = dict(
+            bucket=GCS_SUBMISSIONS_BUCKET, name=name,
+            url=_signed_url(name, method="PUT", content_type="application/json"),
+            content_type="application/json")
+    return payload
+
+def read_payload_notebook(ref):
+    """Reads a notebook given by reference, checking its digest."""
+    name = ref.get('name') or ''
+    # The references come from the callbacks, so they can only point to payloads.
+    if ref.get('bucket', GCS_SUBMISSIONS_BUCKET) != GCS_SUBMISSIONS_BUCKET or not name.startswith(PAYLOAD_PREFIX):
+        raise ValueError("Invalid payload reference: {}".format(name))
+    data = gunzip_if_needed(gcs.read(GCS_SUBMISSIONS_BUCKET, name))
+    if ref.get('sha256') is not None and notebook_digest(data) != ref['sha256']:
+        raise ValueError("Payload digest mismatch: {}".format(name))
+    return data
+
+def read_callback_notebook(params, key):
+    """Returns the notebook json a function sent back to a callback, either
+    inline as params[key], or by reference as params[key + '_ref']."""
+    ref = params.get(key + '_ref')
+    if ref:
+        return read_payload_notebook(json.loads(ref) if isinstance(ref, str) else ref)
+    return params.get(key)
+
 def is_admin():
     return get_user_email() == ADMIN_EMAIL
\ No newline at end of file
@@ -0,0 +1,189 @@
+# Content-addressed cache for notebooks.
+# Notebooks are identified by the sha256 digest of their content, so a cached
+# entry can never be stale: if a notebook changes, so does its digest.
+# The cache keeps the most recently used notebooks in memory, and can
+# optionally keep a second tier on the local disk.
+
+import hashlib
+import os
+import threading
+
+from collections import OrderedDict
+
+
+def notebook_digest(data):
+    """Returns the hex digest of a notebook, given as string or bytes."""
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    return hashlib.sha256(data).hexdigest()
+
+
+class NotebookCache(object):
+    """LRU cache of notebook bytes, keyed by content digest."""
+
+    def __init__(self, max_bytes=64 * 2**20, folder=None, max_disk_bytes=None):
+        """
+        Args:
+            max_bytes: maximum total size of the notebooks kept in memory.
+            folder: if given, folder where notebooks are also kept on disk.
+            max_disk_bytes: maximum total size of the notebooks on disk.
+                If None, the disk tier is not limited.
+        """
+        self.max_bytes = max_bytes
+        self.folder = folder
+        self.max_disk_bytes = max_disk_bytes
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        if folder is not None:
+            os.makedirs(folder, exist_ok=True)
+
+    def get(self, digest):
+        """Returns the notebook bytes with the given digest, or None."""
+        if digest is None:
+            return None
+        with self._lock:
+            data = self._entries.get(digest)
+            if data is not None:
+                self._entries.move_to_end(digest)
+                return data
+        data = self._read_disk(digest)
+        if data is not None:
+            self._put_memory(digest, data)
+        return data
+
+    def put(self, data, digest=None):
+        """Stores a notebook, returning its digest."""
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        digest = digest or notebook_digest(data)
+        self._put_memory(digest, data)
+        self._write_disk(digest, data)
+        return digest
+
+    def get_or_load(self, digest, loader):
+        """Returns the notebook with the given digest, calling loader() to
+        obtain the notebook bytes if they are not in the cache.
+        Returns the pair (data, digest).  The digest is that of the data
+        actually returned, which differs from the one requested if the
+        stored digest was stale (or None)."""
+        data = self.get(digest)
+        if data is not None:
+            return data, digest
+        data = loader()
+        return data, self.put(data)
+
+    def _put_memory(self, digest, data):
+        if len(data) > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(digest, None)
+            if old is not None:
+                self._size -= len(old)
+            self._entries[digest] = data
+            self._size += len(data)
+            while self._size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= len(evicted)
+
+    def _path(self, digest):
+        return os.path.join(self.folder, digest)
+
+    def _read_disk(self, digest):
+        if self.folder is None:
+            return None
+        try:
+            with open(self._path(digest), 'rb') as f:
+                data = f.read()
+            # Marks the file as recently used.
+            os.utime(self._path(digest))
+            return data
+        except OSError:
+            return None
+
+    def _write_disk(self, digest, data):
+        if self.folder is None or os.path.exists(self._path(digest)):
+            return
+        tmp_path = "{}.{}.tmp".format(self._path(digest), threading.get_ident())
+        try:
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, self._path(digest))
+        except OSError:
+            return
+        if self.max_disk_bytes is not None:
+            self._evict_disk()
+
+    def _evict_disk(self):
+        """Removes the least recently used files, until the disk tier fits."""
+        files = []
+        for name in os.listdir(self.folder):
+            if name.endswith(".tmp"):
+                continue
+            try:
+                st = os.stat(os.path.join(self.folder, name))
+            except OSError:
+                continue
+            files.append((st.st_mtime, st.st_size, name))
+        total = sum(size for _, size, _ in files)
+        for _, size, name in sorted(files):
+            if total <= self.max_disk_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.folder, name))
+            except OSError:
+                pass
+            total -= size
+
+
+class ParsedNotebookCache(object):
+    """LRU cache of parsed notebooks, or of objects derived from them,
+    keyed by (gcs name, digest).
+    The cached objects must never be modified; callers work on the views
+    returned by get and put."""
+
+    def __init__(self, max_entries=64, view=None):
+        """
+        Args:
+            max_entries: maximum number of cached objects.
+            view: function used to obtain a view from a cached object.
+                By default, notebook_view is used.
+        """
+        self.max_entries = max_entries
+        self.view = view or notebook_view
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, name, digest):
+        """Returns a view of the cached notebook, or None."""
+        with self._lock:
+            nb = self._entries.get((name, digest))
+            if nb is None:
+                return None
+            self._entries.move_to_end((name, digest))
+        return self.view(nb)
+
+    def put(self, name, digest, nb):
+        """Caches a parsed notebook, and returns a view of it."""
+        with self._lock:
+            self._entries[(name, digest)] = nb
+            self._entries.move_to_end((name, digest))
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return self.view(nb)
+
+    def invalidate(self, name):
+        """Removes all versions of the notebook with the given name."""
+        with self._lock:
+            for key in [k for k in self._entries if k[0] == name]:
+                del self._entries[key]
+
+
+def notebook_view(nb):
+    """Returns a copy-on-write view of a notebook: the notebook and its cells
+    are shallow copies, so that fields of the cells (outputs, execution count,
+    ...) can be reassigned without affecting the original.  The contents of
+    the fields are shared, and must not be mutated in place."""
+    view = nb.__class__(nb)
+    view.cells = [c.__class__(c) for c in nb.cells]
+    return view
@@ -1,8 +1,14 @@
 import ast
+import bisect
+import functools
 import json
+import time
 import traceback
 
+from collections import namedtuple
+
 import nbformat
+import nbformat.reader, nbformat.v4
 import re
 from nbformat.notebooknode import NotebookNode
 from .util import random_id, short_random_id
@@ -21,89 +27,232 @@ TEST_NAME_REGEXP = r"^# *Tests? \d+ points *: *([^\n]*)"
 
 test_regexp = re.compile(IS_TEST_REGEXP)
 test_name_regexp = re.compile(TEST_NAME_REGEXP)
+# Matches both the points and the (optional) name of a test cell in one go.
+test_header_regexp = re.compile(r"^# *Tests? (\d+) points(?: *: *([^\n]*))?")
+
+# Kinds of cells, as returned by the classifier.
+KIND_MARKDOWN = "markdown"
+KIND_SOLUTION = "solution"
+KIND_TESTS = "tests"
+KIND_OTHER = "other"
+
+# Compact description of a cell, computed in a single pass over its source.
+# - kind: one of the KIND_* constants above.
+# - points: test points if the cell is a test cell, None otherwise.
+# - name: test name if the cell is a test cell, None otherwise.
+# - solution_spans, hidden_test_spans: tuples of (first_line, last_line)
+#   pairs, inclusive, of the delimited regions.
+# - line_offsets: tuple with the character offset at which each line begins.
+CellInfo = namedtuple('CellInfo', ['kind', 'points', 'name', 'solution_spans',
+                                   'hidden_test_spans', 'line_offsets'])
 
 class InvalidCell(Exception):
     pass
 
+def get_line_offsets(source):
+    """Returns a tuple with the offsets at which the lines of source begin."""
+    offsets = [0]
+    i = source.find("\n")
+    while i >= 0:
+        offsets.append(i + 1)
+        i = source.find("\n", i + 1)
+    return tuple(offsets)
+
+def find_region_spans(source, line_offsets, delimiters):
+    """Returns the (first_line, last_line) spans of the regions delimited by
+    the pair of delimiters.  A region begins on the line containing the start
+    delimiter, and ends on the first line from there that contains the end
+    delimiter (or at the end of the source, if there is no such line)."""
+    start_region, end_region = delimiters
+    i = source.find(start_region)
+    if i < 0:
+        return ()
+    spans = []
+    last_line = len(line_offsets) - 1
+    while i >= 0:
+        first = bisect.bisect_right(line_offsets, i) - 1
+        j = source.find(end_region, line_offsets[first])
+        if j < 0:
+            spans.append((first, last_line))
+            break
+        last = bisect.bisect_right(line_offsets, j) - 1
+        spans.append((first, last))
+        if last == last_line:
+            break
+        i = source.find(start_region, line_offsets[last + 1])
+    return tuple(spans)
+
+@functools.lru_cache(maxsize=4096)
+def classify_source(cell_type, source):
+    """Classifies a cell given its type and source; see CellInfo.
+    The result is cached, as the same sources are classified when building
+    the master notebook, and again when producing the student version."""
+    line_offsets = get_line_offsets(source)
+    hidden_test_spans = find_region_spans(source, line_offsets, HIDDEN_TESTS)
+    if cell_type == 'markdown':
+        return CellInfo(KIND_MARKDOWN, None, None, (), hidden_test_spans, line_offsets)
+    solution_spans = find_region_spans(source, line_offsets, SOLUTION)
+    points, name = None, None
+    g = test_header_regexp.match(source)
+    if g is not None:
+        points = int(g[1])
+        name = "Unnamed" if g[2] is None else g[2].strip().capitalize()
+    if solution_spans:
+        kind = KIND_SOLUTION
+    elif points is not None:
+        kind = KIND_TESTS
+    else:
+        kind = KIND_OTHER
+    return CellInfo(kind, points, name, solution_spans, hidden_test_spans, line_offsets)
+
+def classify_cell(cell):
+    """Returns the CellInfo of a notebook cell."""
+    return classify_source(cell.get('cell_type'), cell.source)
+
 def is_cell_solution(cell):
     """Returns whether a cell contains text to be a solution."""
-    return cell.get('cell_type') != 'markdown' and BEGIN_SOLUTION in cell.source
+    return len(classify_cell(cell).solution_spans) > 0
 
 def is_cell_tests(cell):
-    return cell.cell_type != 'markdown' and re.match(test_regexp, cell.source) is not None
+    return classify_cell(cell).points is not None
 
 def get_test_points(cell):
-    if not is_cell_tests(cell):
-        return 0
-    g = re.match(test_regexp, cell.source)
-    return int(g[1])
+    return classify_cell(cell).points or 0
 
 def get_test_name(cell):
     """Returns the name the user assigned to the tests."""
-    g = re.match(test_name_regexp, cell.source)
-    try:
-        return g[1].strip().capitalize()
-    except Exception as e:
-        return "Unnamed"
-
-def check_cell_valid(cell):
-    if is_cell_solution(cell) and is_cell_tests(cell):
+    return classify_cell(cell).name or "Unnamed"
+
+def check_cell_valid(cell, info=None):
+    """Checks that a cell is valid; info is its CellInfo, if already known."""
+    info = info or classify_cell(cell)
+    if info.solution_spans and info.points is not None:
         raise InvalidCell("Cell is invalid: you cannot have tests and solution in the same cell: {}".format(cell.source[:80]))
-    if BEGIN_HIDDEN_TESTS in cell.source and not is_cell_tests(cell):
+    if info.hidden_test_spans and info.points is None:
         raise InvalidCell("Cell is invalid: it contains hidden tests but no points: {}".format(cell.source[:80]))
 
+def strip_regions(source, regions):
+    """Removes from source the lines of all regions delimited by the given
+    pairs of delimiters, in a single scan.
+    A region spans from the line containing its start delimiter to the first
+    line, from there, containing its end delimiter (both included).
+    Args:
+        source: the string to strip.
+        regions: sequence of (delimiters, replacement) pairs.  If replacement
+            is not None, the removed lines are replaced by a single line
+            consisting of the text preceding the start delimiter, followed
+            by the replacement.
+    Returns:
+        - the stripped string;
+        - the list of removed regions, as (start_delimiter, start, end)
+          character offsets into source.
+    """
+    starts = [source.find(delimiters[0]) for delimiters, _ in regions]
+    if max(starts) < 0:
+        # Nothing to remove.
+        return source, []
+    n = len(source)
+    pieces = []
+    removed = []
+    pos = 0
+    dropped_last_line = False
+    while True:
+        # Picks the region that begins first.
+        k = min((i for i in range(len(starts)) if starts[i] >= 0), key=starts.__getitem__, default=None)
+        if k is None:
+            break
+        i = starts[k]
+        (start_region, end_region), replacement = regions[k]
+        line_start = source.rfind("\n", 0, i) + 1
+        j = source.find(end_region, line_start)
+        line_end = n if j < 0 else source.find("\n", j)
+        if line_end < 0:
+            line_end = n
+        pieces.append(source[pos:line_start])
+        if replacement is not None:
+            pieces.append(source[line_start:i] + replacement)
+            pos = line_end
+        else:
+            # The line terminator goes with the removed lines.
+            pos = min(line_end + 1, n)
+            dropped_last_line = line_end == n
+        removed.append((start_region, line_start, pos))
+        if line_end == n:
+            break
+        for h, (delimiters, _) in enumerate(regions):
+            if 0 <= starts[h] <= line_end:
+                starts[h] = source.find(delimiters[0], line_end + 1)
+    pieces.append(source[pos:])
+    out = "".join(pieces)
+    if dropped_last_line and out.endswith("\n"):
+        # The last kept line was not terminated in the original.
+        out = out[:-1]
+    return out, removed
+
 def remove_from_cell(cell, delimiters, replacement=None):
-    """Removes from the cell any portion between the delimiter strings."""
-    lines = cell.source.split("\n")
-    out_lines = []
-    outside = True
-    start_region, end_region = delimiters
-    for l in lines:
-        if start_region in l:
-            outside = False
-            # Adds replacement text if necessary.
-            if replacement is not None:
-                k = l.index(start_region)
-                out_lines.append(l[:k] + replacement)
-        if outside:
-            out_lines.append(l)
-        if end_region in l:
-            outside = True
-    cell.source = "\n".join(out_lines)
+    """Removes from the cell any portion between the delimiter strings.
+    Returns the list of removed regions; see strip_regions."""
+    cell.source, removed = strip_regions(cell.source, ((delimiters, replacement),))
+    return removed
 
 def remove_hidden_tests(cell):
-    remove_from_cell(cell, HIDDEN_TESTS)
+    return remove_from_cell(cell, HIDDEN_TESTS)
 
 def remove_all_hidden_tests(nb):
     for cell in nb.cells:
         remove_hidden_tests(cell)
 
+def read_notebook(notebook_string, validate=True):
+    """Parses a notebook string into a v4 NotebookNode.
+    If validate is False, the nbformat schema validation is skipped; use this
+    only for notebooks we have produced ourselves."""
+    if validate:
+        return nbformat.reads(notebook_string, as_version=4)
+    nb = nbformat.reader.reads(notebook_string)
+    if nb.nbformat != 4:
+        nb = nbformat.convert(nb, 4)
+    return nb
+
+def write_notebook(nb, validate=True):
+    """Serializes a v4 notebook, optionally skipping schema validation."""
+    if validate:
+        return nbformat.writes(nb, version=nbformat.NO_CONVERT)
+    return nbformat.v4.writes(nb)
+
 def ensure(st, a):
     """Ensures that a structure exists."""
     if a not in st:
         st[a] = NotebookNode()
 
-def create_master_notebook(notebook_string):
+def create_master_notebook(notebook_string, validate=True, timings=None):
     """Checks the constraints on an assignment notebook, and derives from it the
     grading master.
     The grading master looks like a normal notebook, but contains the metadata
     that can be used for grading.
     From the grading master, it is possible to derive the notebook that is
     assigned to students.
+    The notebook is parsed only once, and the cells are transformed in place.
+    Args:
+        notebook_string: the notebook uploaded by the instructor.
+        validate: whether to validate the notebook against the nbformat schema.
+            Skip it only for notebooks that we have produced ourselves.
+        timings: if a dictionary is given, it is filled with the time in seconds
+            spent in the parse, transform, and serialize phases.
     Returns:
         - Json of master notebook
         - total points
         - list of (test_id, test_name, test_points) in the notebook.
     """
-    nb = nbformat.reads(notebook_string, as_version=4)
-    new_nb = nbformat.reads(notebook_string, as_version=4)
-    new_nb.cells = []
+    t0 = time.perf_counter()
+    nb = read_notebook(notebook_string, validate=validate)
+    t1 = time.perf_counter()
     total_points = 0
     test_list = []
     for i, c in enumerate(nb.cells):
         if "outputs" in c:
             c.outputs = ""
-        check_cell_valid(c)
+        info = classify_cell(c)
+        check_cell_valid(c, info)
         ensure(c, "metadata")
         ensure(c.metadata, "notebookgrader")
         # We want to ensure that each cell has a unique id.
@@ -117,46 +266,100 @@ def create_master_notebook(notebook_string):
         if c.cell_type == "code":
             meta.is_tests = False
             meta.is_solution = False
-        if is_cell_solution(c):
+        if info.kind == KIND_SOLUTION:
             meta.readonly = False
             meta.is_solution = True
             meta.is_tests = False
         else:
             meta.readonly = True
-            if is_cell_tests(c):
+            if info.kind == KIND_TESTS:
                 meta.is_tests = True
-                points = get_test_points(c)
-                meta.test_points = points
-                total_points += points
-                test_name = get_test_name(c)
-                test_list.append((meta.id, test_name, points))
+                meta.test_points = info.points
+                total_points += info.points
+                test_list.append((meta.id, info.name, info.points))
         c.metadata.notebookgrader = meta
-        new_nb.cells.append(c)
-    ensure(new_nb, 'metadata')
+    ensure(nb, 'metadata')
     # Changes the kernel to the one used by Colab.
-    new_nb.metadata.kernelspec = NotebookNode()
-    new_nb.metadata.kernelspec.name = "python3"
-    new_nb.metadata.kernelspec.display_name = "Python 3"
-    new_nb.metadata.language_info = NotebookNode()
-    new_nb.metadata.language_info.name = "python"
+    nb.metadata.kernelspec = NotebookNode()
+    nb.metadata.kernelspec.name = "python3"
+    nb.metadata.kernelspec.display_name = "Python 3"
+    nb.metadata.language_info = NotebookNode()
+    nb.metadata.language_info.name = "python"
     # Adds total points into notebook.
-    ensure(new_nb.metadata, 'notebookgrader')
-    new_nb.metadata.notebookgrader.total_points = total_points
-    return nbformat.writes(new_nb, version=nbformat.NO_CONVERT), total_points, test_list
-
-def produce_student_version(master_notebook_string):
+    ensure(nb.metadata, 'notebookgrader')
+    nb.metadata.notebookgrader.total_points = total_points
+    t2 = time.perf_counter()
+    master_json = write_notebook(nb, validate=validate)
+    if timings is not None:
+        timings['parse'] = t1 - t0
+        timings['transform'] = t2 - t1
+        timings['serialize'] = time.perf_counter() - t2
+    return master_json, total_points, test_list
+
+def produce_student_version(master_notebook_string, validate=True):
     """Given a master notebook string, produces the student version.
     Using strings enables us to clone the notebook."""
-    nb = nbformat.reads(master_notebook_string, as_version=4)
+    nb = read_notebook(master_notebook_string, validate=validate)
     for i, c in enumerate(nb.cells):
         meta = c.metadata.notebookgrader
+        info = classify_cell(c)
         if meta.get('is_tests'):
             # We need to remove the hidden tests.
-            remove_from_cell(c, HIDDEN_TESTS)
+            if info.hidden_test_spans:
+                remove_from_cell(c, HIDDEN_TESTS)
         elif meta.get('is_solution'):
-            remove_from_cell(c, SOLUTION, SOLUTION_REPLACEMENT)
-    return nbformat.writes(nb, version=4)
-
+            if info.solution_spans:
+                remove_from_cell(c, SOLUTION, SOLUTION_REPLACEMENT)
+    return write_notebook(nb, validate=validate)
+
+
+def _output_text(value):
+    """Output text can be stored as a string, or as a list of lines."""
+    return "".join(value) if isinstance(value, list) else value
+
+def _removal_notice(n):
+    return "[Output of {} characters removed from the stored copy.]\n".format(n)
+
+def compact_outputs(nb, max_size, mode="truncate"):
+    """Reduces in place the outputs of a notebook, given as NotebookNode or
+    as plain json dictionary.  Outputs larger than max_size characters are:
+        - with mode "truncate": cut to max_size if textual, and removed
+          otherwise (images, html, ...);
+        - with mode "drop": removed.
+    Removed outputs are replaced by a short notice.
+    Returns the number of characters removed."""
+    removed = 0
+    for c in nb.get('cells', []):
+        for output in c.get('outputs') or []:
+            if not isinstance(output, dict):
+                continue
+            if output.get('output_type') == 'stream':
+                text = _output_text(output.get('text', ''))
+                if len(text) > max_size:
+                    keep = text[:max_size] if mode == "truncate" else ""
+                    output['text'] = keep + _removal_notice(len(text) - len(keep))
+                    removed += len(text) - len(keep)
+            elif isinstance(output.get('data'), dict):
+                data = output['data']
+                removed_here = 0
+                for mime in list(data.keys()):
+                    value = data[mime]
+                    if not isinstance(value, (str, list)):
+                        # json outputs.
+                        continue
+                    text = _output_text(value)
+                    if len(text) <= max_size:
+                        continue
+                    if mode == "truncate" and mime == "text/plain":
+                        data[mime] = text[:max_size] + _removal_notice(len(text) - max_size)
+                        removed_here += len(text) - max_size
+                    else:
+                        del data[mime]
+                        removed_here += len(text)
+                if not data:
+                    data['text/plain'] = _removal_notice(removed_here)
+                removed += removed_here
+    return removed
 
 def extract_awarded_points(nb):
     """Returns a dictionary mapping cell id to awarded points."""
@@ -191,16 +394,21 @@ def is_solution(c):
             and hasattr(c.metadata.notebookgrader, "is_solution")
             and c.metadata.notebookgrader.is_solution)
 
-def is_notebook_well_formed(notebook_string):
+def is_notebook_well_formed(notebook):
     """
     Checks whether the notebook is well-formed and can be graded.
     Args:
-        notebook_string:
+        notebook: notebook string, or already parsed notebook.  Only the
+            solution cells are checked, so a notebook read with just those
+            cells (see GradingSkeleton.read_submission) suffices.
 
     Returns:
-
+        (is_well_formed, source of the offending cell, reason)
     """
-    nb = nbformat.reads(notebook_string, as_version=4)
+    if isinstance(notebook, NotebookNode):
+        nb = notebook
+    else:
+        nb = nbformat.reads(notebook, as_version=4)
     for c in nb.cells:
         if is_solution(c):
             try:
@@ -231,6 +439,78 @@ def test_produce_master_twice():
     s2, _, _ = create_master_notebook(s1)
     assert s1 == s2
 
+def test_produce_master_without_validation():
+    with open("./test_files/TestoutJuly2023source.json") as f:
+        s0 = f.read()
+    s1, pts1, _ = create_master_notebook(s0)
+    timings = {}
+    s2, pts2, _ = create_master_notebook(s1, validate=False, timings=timings)
+    assert s1 == s2 and pts1 == pts2
+    assert set(timings.keys()) == {'parse', 'transform', 'serialize'}
+
+def test_strip_regions_matches_line_removal():
+    def remove_lines(source, delimiters, replacement=None):
+        # The original, line-by-line, implementation.
+        out_lines = []
+        outside = True
+        start_region, end_region = delimiters
+        for l in source.split("\n"):
+            if start_region in l:
+                outside = False
+                if replacement is not None:
+                    out_lines.append(l[:l.index(start_region)] + replacement)
+            if outside:
+                out_lines.append(l)
+            if end_region in l:
+                outside = True
+        return "\n".join(out_lines)
+    sources = [
+        "",
+        "x = 1",
+        "def f():\n    ### BEGIN SOLUTION\n    return 1\n    ### END SOLUTION\n",
+        "def f():\n    ### BEGIN SOLUTION\n    return 1\n    ### END SOLUTION",
+        "### BEGIN SOLUTION\nx = 1\n### END SOLUTION",
+        "a\n### BEGIN SOLUTION\nb\n### END SOLUTION\nc\n### BEGIN SOLUTION\nd",
+        "a\n### BEGIN SOLUTION\n### END SOLUTION\n### BEGIN SOLUTION\n### END SOLUTION",
+        "a\n### BEGIN SOLUTION ### END SOLUTION\nb",
+        "\n### BEGIN SOLUTION\nb",
+        "# Tests 5 points\nassert 1\n### BEGIN HIDDEN TESTS\nassert 2\n### END HIDDEN TESTS\n\n",
+        "# Tests 5 points\n### BEGIN HIDDEN TESTS\nassert 2\n### END HIDDEN TESTS\n### BEGIN HIDDEN TESTS\nassert 3\n### END HIDDEN TESTS",
+    ]
+    for source in sources:
+        for delimiters, replacement in [(SOLUTION, SOLUTION_REPLACEMENT), (SOLUTION, None), (HIDDEN_TESTS, None)]:
+            out, removed = strip_regions(source, ((delimiters, replacement),))
+            assert out == remove_lines(source, delimiters, replacement), (source, delimiters)
+            assert all(source[s:e].lstrip().startswith(d) for d, s, e in removed)
+    # Both kinds of regions in one pass.
+    source = "a\n### BEGIN HIDDEN TESTS\nb\n### END HIDDEN TESTS\n  ### BEGIN SOLUTION\nc\n### END SOLUTION\nd"
+    out, removed = strip_regions(source, ((SOLUTION, SOLUTION_REPLACEMENT), (HIDDEN_TESTS, None)))
+    assert out == "a\n  " + SOLUTION_REPLACEMENT + "\nd"
+    assert [d for d, _, _ in removed] == [BEGIN_HIDDEN_TESTS, BEGIN_SOLUTION]
+
+def test_compact_outputs():
+    nb = {'cells': [
+        {'cell_type': 'code', 'outputs': [
+            {'output_type': 'stream', 'name': 'stdout', 'text': ['x' * 50, 'y' * 50]},
+            {'output_type': 'display_data', 'metadata': {},
+             'data': {'image/png': 'A' * 200, 'text/plain': '<Figure>'}},
+            {'output_type': 'execute_result', 'metadata': {}, 'execution_count': 1,
+             'data': {'text/html': '<b>' * 100}},
+        ]},
+        {'cell_type': 'markdown', 'source': 'z' * 1000},
+    ]}
+    removed = compact_outputs(nb, 60)
+    stream, image, html = nb['cells'][0]['outputs']
+    assert stream['text'].startswith('x' * 50 + 'y' * 10 + '[')
+    assert image['data'] == {'text/plain': '<Figure>'}
+    assert list(html['data'].keys()) == ['text/plain']
+    assert removed == 40 + 200 + 300
+    assert nb['cells'][1]['source'] == 'z' * 1000
+    nb = {'cells': [{'cell_type': 'code', 'outputs': [
+        {'output_type': 'stream', 'name': 'stdout', 'text': 'x' * 100}]}]}
+    assert compact_outputs(nb, 60, mode="drop") == 100
+    assert 'x' not in nb['cells'][0]['outputs'][0]['text']
+
 def test_no_solution():
     with open("./test_files/TestoutJuly2023source.json") as f:
         s0 = f.read()
@@ -264,3 +544,50 @@ def test_syntax_errors():
     v, c, r = is_notebook_well_formed(s1)
     # print(r)
     assert v is False
+
+def _scaled_notebook(filename, n_copies):
+    """Returns a notebook with the cells of filename repeated n_copies times."""
+    with open(filename) as f:
+        nb = nbformat.reads(f.read(), as_version=4)
+    nb.cells = [NotebookNode(json.loads(json.dumps(c)))
+                for _ in range(n_copies) for c in nb.cells]
+    return nb
+
+def test_classifier_agrees_with_regexps():
+    nb = _scaled_notebook("./test_files/TestoutJuly2023source.json", 1)
+    for c in nb.cells:
+        info = classify_cell(c)
+        is_code = c.cell_type != 'markdown'
+        assert (info.kind == KIND_SOLUTION) == (is_code and BEGIN_SOLUTION in c.source)
+        g = re.match(test_regexp, c.source)
+        assert (info.points is not None) == (is_code and g is not None)
+        if info.points is not None:
+            assert info.points == int(g[1])
+        assert bool(info.hidden_test_spans) == (BEGIN_HIDDEN_TESTS in c.source)
+        assert len(info.line_offsets) == len(c.source.split("\n"))
+
+def test_benchmark_cell_classifier(n_copies=200):
+    """Compares the per-question regexp scans with the single-pass classifier,
+    on a notebook of a few thousand cells.  Run with pytest -s to see timings."""
+    nb = _scaled_notebook("./test_files/TestoutJuly2023source.json", n_copies)
+    def scan_repeatedly(c):
+        is_code = c.cell_type != 'markdown'
+        is_sol = is_code and BEGIN_SOLUTION in c.source
+        is_tests = is_code and re.match(test_regexp, c.source) is not None
+        points = int(re.match(test_regexp, c.source)[1]) if is_tests else 0
+        name = re.match(test_name_regexp, c.source)
+        has_hidden = BEGIN_HIDDEN_TESTS in c.source
+        return is_sol, is_tests, points, name, has_hidden
+    t0 = time.perf_counter()
+    for c in nb.cells:
+        scan_repeatedly(c)
+    t1 = time.perf_counter()
+    # We bypass the cache, as all the copies have the same sources.
+    for c in nb.cells:
+        classify_source.__wrapped__(c.cell_type, c.source)
+    t2 = time.perf_counter()
+    for c in nb.cells:
+        classify_cell(c)
+    t3 = time.perf_counter()
+    print("\nClassification of {} cells: regexps {:.4f}s, single pass {:.4f}s, cached {:.4f}s".format(
+        len(nb.cells), t1 - t0, t2 - t1, t3 - t2))
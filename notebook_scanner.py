@@ -0,0 +1,175 @@
+# Scanner that reads only some of the cells of a notebook.
+# Submissions can be tens of MB, almost all of it in cell outputs (plots,
+# widget state, ...) that grading never uses.  Rather than building the whole
+# json tree, the scanner walks the json bytes, decodes only the cell type,
+# source and metadata of each cell, and skips over everything else; long
+# strings such as images are skipped with a single find.
+
+import json
+import re
+
+import nbformat, nbformat.v4
+
+_whitespace = re.compile(rb'[ \t\n\r]*')
+_structural = re.compile(rb'[\[\]{}"]')
+_scalar = re.compile(rb'[^,\]}\s]+')
+
+# Fields of a cell that are decoded; all others (outputs, attachments, ...)
+# are skipped.
+DECODED_CELL_FIELDS = ('cell_type', 'metadata', 'source', 'id', 'execution_count')
+
+
+class ScanError(ValueError):
+    pass
+
+
+def _skip_whitespace(s, pos):
+    return _whitespace.match(s, pos).end()
+
+
+def _expect(s, pos, c):
+    pos = _skip_whitespace(s, pos)
+    if s[pos:pos + 1] != c:
+        raise ScanError("Expected {!r} at position {}".format(c, pos))
+    return pos + 1
+
+
+def _skip_string(s, pos):
+    """Returns the position just past the json string that begins at pos.
+    Uses find, as the strings we skip are mostly long base64 blobs."""
+    i = pos + 1
+    while True:
+        j = s.find(b'"', i)
+        if j < 0:
+            raise ScanError("Unterminated string at position {}".format(pos))
+        # The quote is escaped if preceded by an odd number of backslashes.
+        k = j
+        while s[k - 1] == 0x5c:
+            k -= 1
+        if (j - k) % 2 == 0:
+            return j + 1
+        i = j + 1
+
+
+def _skip_value(s, pos):
+    """Returns the position just past the json value that begins at pos."""
+    pos = _skip_whitespace(s, pos)
+    c = s[pos:pos + 1]
+    if c == b'"':
+        return _skip_string(s, pos)
+    if c in (b'[', b'{'):
+        depth = 0
+        while True:
+            m = _structural.search(s, pos)
+            if m is None:
+                raise ScanError("Unterminated value")
+            pos = m.start()
+            c = m.group()
+            if c == b'"':
+                pos = _skip_string(s, pos)
+                continue
+            depth += 1 if c in b'[{' else -1
+            pos += 1
+            if depth == 0:
+                return pos
+    m = _scalar.match(s, pos)
+    if m is None:
+        raise ScanError("Invalid value at position {}".format(pos))
+    return m.end()
+
+
+def _decode_value(s, pos):
+    """Decodes the json value at pos, returning it and the position past it."""
+    pos = _skip_whitespace(s, pos)
+    end = _skip_value(s, pos)
+    try:
+        return json.loads(s[pos:end]), end
+    except ValueError as e:
+        raise ScanError(str(e))
+
+
+def _scan_object(s, pos, handle):
+    """Scans the json object that begins at pos, calling handle(key, pos) for
+    each member, where pos is the position of the member value; handle must
+    return the position past the value.
+    Returns the position past the object."""
+    pos = _expect(s, pos, b'{')
+    pos = _skip_whitespace(s, pos)
+    if s[pos:pos + 1] == b'}':
+        return pos + 1
+    while True:
+        key, pos = _decode_value(s, pos)
+        pos = _expect(s, pos, b':')
+        pos = handle(key, pos)
+        pos = _skip_whitespace(s, pos)
+        if s[pos:pos + 1] == b'}':
+            return pos + 1
+        pos = _expect(s, pos, b',')
+
+
+def _scan_cells(s, pos, keep, cells):
+    """Scans the cells array at pos, appending the kept cells to cells."""
+    pos = _expect(s, pos, b'[')
+    pos = _skip_whitespace(s, pos)
+    if s[pos:pos + 1] == b']':
+        return pos + 1
+    while True:
+        cell = {}
+        def handle(key, pos):
+            if key in DECODED_CELL_FIELDS:
+                cell[key], pos = _decode_value(s, pos)
+                return pos
+            return _skip_value(s, pos)
+        pos = _scan_object(s, pos, handle)
+        if keep(cell):
+            if isinstance(cell.get('source'), list):
+                cell['source'] = "".join(cell['source'])
+            if cell.get('cell_type') == 'code':
+                cell['outputs'] = []
+            cells.append(nbformat.from_dict(cell))
+        pos = _skip_whitespace(s, pos)
+        if s[pos:pos + 1] == b']':
+            return pos + 1
+        pos = _expect(s, pos, b',')
+
+
+def read_cells(notebook_json, keep):
+    """Reads a notebook, keeping only some of its cells.
+    Args:
+        notebook_json: the notebook, as string or bytes.
+        keep: function that, given a cell as a dictionary containing only the
+            DECODED_CELL_FIELDS, returns whether the cell should be kept.
+    Returns:
+        A v4 NotebookNode with the notebook metadata and the kept cells.
+        The kept cells have their source joined into a string, and code cells
+        have empty outputs.
+    If the notebook is not in v4 format, or the scan fails, the notebook is
+    parsed in full with nbformat, and then filtered."""
+    # We work on the bytes, so the notebook is never decoded as a whole.
+    s = notebook_json.encode('utf-8') if isinstance(notebook_json, str) else notebook_json
+    cells = []
+    top = {}
+    def handle(key, pos):
+        if key == 'cells':
+            return _scan_cells(s, pos, keep, cells)
+        if key in ('metadata', 'nbformat', 'nbformat_minor'):
+            top[key], pos = _decode_value(s, pos)
+            return pos
+        return _skip_value(s, pos)
+    try:
+        _scan_object(s, 0, handle)
+        scanned = top.get('nbformat') == 4
+    except ScanError:
+        scanned = False
+    if not scanned:
+        nb = nbformat.reads(s, as_version=4)
+        nb.cells = [c for c in nb.cells if keep(c)]
+        for c in nb.cells:
+            if c.cell_type == 'code':
+                c.outputs = []
+        return nb
+    nb = nbformat.v4.new_notebook(
+        metadata=top.get('metadata', {}),
+        nbformat_minor=top.get('nbformat_minor', 0))
+    nb.cells = cells
+    return nb
@@ -0,0 +1,140 @@
+# Provisioning of student notebooks before an assignment opens.
+# Students who join an assignment before it is available get their Drive copy
+# of the notebook the first time they open the assignment after it becomes
+# available; when an assignment opens at a fixed time, many students do so at
+# once.  The provisioning scan, run periodically from tasks.py, or, without
+# celery, by a thread started by the student pages (see
+# start_provisioning_thread), enqueues a provision_notebook job (see jobs.py)
+# for each student of the assignments opening within PROVISIONING_LEAD, so that
+# opening them is immediate.  The jobs are keyed by homework: however many
+# processes scan, a notebook is created at most once.  The students get the
+# links to the copies only once the assignments open.  The copies are created
+# in each student's Drive, with the student's credentials, backing off on
+# Drive rate limits.
+
+import datetime
+import threading
+import time
+import traceback
+
+from .common import db
+from .jobs import job_kind, enqueue_job
+from .models import (build_drive_service, read_drive_credentials, read_assignment_notebook,
+                     get_assignment_teachers)
+from .settings import PROVISIONING_INTERVAL, PROVISIONING_LEAD, PROVISIONING_BATCH_SIZE
+from .util import upload_to_drive, retry_drive_call
+
+
+def _create_copy(student, credentials_json, name, notebook_json, teachers):
+    """Creates the Drive copy of a student."""
+    drive_service = build_drive_service(user=student, credentials_json=credentials_json)
+    return retry_drive_call(lambda: upload_to_drive(
+        drive_service, notebook_json, name, write_share=teachers))
+
+
+def _delete_copy(student, credentials_json, drive_id):
+    try:
+        drive_service = build_drive_service(user=student, credentials_json=credentials_json)
+        retry_drive_call(lambda: drive_service.files().delete(fileId=drive_id).execute())
+    except Exception as e:
+        print("Could not delete the extra notebook", drive_id, "of", student, ":", e)
+
+
+def assign_notebook(homework_id, student, drive_id, credentials_json=None):
+    """Gives the notebook drive_id to a homework, unless the homework got one
+    in the meantime, in which case drive_id is deleted.  Returns the drive id
+    of the homework."""
+    if db((db.homework.id == homework_id) & (db.homework.drive_id == None)).update(drive_id=drive_id):
+        return drive_id
+    _delete_copy(student, credentials_json, drive_id)
+    return db(db.homework.id == homework_id).select(
+        db.homework.drive_id, for_update=True).first().drive_id
+
+
+def _provision_key(homework_id):
+    return "provision:{}".format(homework_id)
+
+
+def run_provisioning():
+    """Runs provision_assignments with a connection of its own."""
+    try:
+        db._adapter.reconnect()
+        enqueued = provision_assignments()
+        if enqueued:
+            print("Enqueued the provisioning of", enqueued, "student notebooks")
+        db.commit()
+    except:
+        traceback.print_exc()
+        db.rollback()
+    finally:
+        db._adapter.close()
+
+
+_provisioning_thread = None
+_provisioning_lock = threading.Lock()
+
+def start_provisioning_thread():
+    """Starts a thread running the provisioning every PROVISIONING_INTERVAL,
+    if not started already.  Several processes can run it at once: a student
+    gets only one notebook (see provision_assignments)."""
+    global _provisioning_thread
+    def loop():
+        while True:
+            time.sleep(PROVISIONING_INTERVAL)
+            run_provisioning()
+    with _provisioning_lock:
+        if _provisioning_thread is None:
+            _provisioning_thread = threading.Thread(target=loop, daemon=True)
+            _provisioning_thread.start()
+
+
+def provision_assignments(now=None):
+    """Enqueues the creation of the missing student notebooks of the
+    assignments that are open, or that open within PROVISIONING_LEAD.  Must
+    be called with a db connection; commits as it goes.  Returns the number
+    of jobs enqueued."""
+    now = now or datetime.datetime.utcnow()
+    assignments = db((db.assignment.available_from < now + datetime.timedelta(seconds=PROVISIONING_LEAD)) &
+                     (db.assignment.available_until > now) &
+                     (db.assignment.student_id_gcs != None)).select(db.assignment.id)
+    enqueued = 0
+    for assignment in assignments:
+        homeworks = db((db.homework.assignment_id == assignment.id) &
+                       (db.homework.drive_id == None)).select(db.homework.id)
+        keys = {_provision_key(h.id): h.id for h in homeworks}
+        if not keys:
+            continue
+        # Homeworks already provisioned, or being provisioned.
+        existing = {j.idempotency_key for j in db(
+            db.job.idempotency_key.belongs(list(keys))).select(db.job.idempotency_key)}
+        for key, homework_id in keys.items():
+            if key in existing:
+                continue
+            enqueue_job("provision_notebook", dict(homework_id=homework_id), idempotency_key=key)
+            enqueued += 1
+            if enqueued >= PROVISIONING_BATCH_SIZE:
+                break
+        db.commit()
+        if enqueued >= PROVISIONING_BATCH_SIZE:
+            break
+    return enqueued
+
+
+@job_kind("provision_notebook")
+def provision_notebook(homework_id):
+    """Creates the notebook of a homework, in the Drive of the student."""
+    homework = db.homework[homework_id]
+    if homework is None or homework.drive_id is not None:
+        return
+    assignment = db.assignment[homework.assignment_id]
+    if assignment is None or assignment.available_until < datetime.datetime.utcnow():
+        return
+    credentials_json = read_drive_credentials(homework.student)
+    if credentials_json is None:
+        # The student will get the notebook when opening the assignment.
+        return
+    notebook_json = read_assignment_notebook(assignment).decode('utf-8')
+    drive_id = _create_copy(homework.student, credentials_json, assignment.name,
+                            notebook_json, get_assignment_teachers(assignment.id))
+    # The student may have obtained a notebook in the meantime.
+    assign_notebook(homework.id, homework.student, drive_id, credentials_json=credentials_json)
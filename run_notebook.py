@@ -2,12 +2,19 @@
 
 import ast
 import builtins
+import copy
+import hashlib
 import importlib
 import nbformat.v4, nbformat
 import threading
+import time
 import traceback
 import warnings
 
+from collections import namedtuple
+
+from .notebook_scanner import read_cells
+
 
 warnings.simplefilter("ignore") # Silences nasty warnings from restricted python.
 
@@ -33,6 +40,8 @@ You cannot simply insert a cell with the same content, because each cell has a u
 So if you just add text to a cell, the cell IDs will still not match.
 """
 
+REUSED_RESULT_NOTICE = "This test was not run again: its code, and all the code before it, are unchanged since your previous submission, which earned {} points on it.\n"
+
 PROBLEM_NOTICE = """
 ### Something went wrong
 
@@ -57,11 +66,275 @@ def get_original_cell_id(c):
     return c.metadata.id
 
 
+# A slot of the grading skeleton.
+# - cell: the master cell, already cleaned if it is readonly.
+# - is_solution: whether the cell must be taken from the submission.
+# - original_id, nbg_id: for solution cells, the ids with which to look up
+#   the submission cell.  The original id, if present, takes precedence.
+Slot = namedtuple('Slot', ['cell', 'is_solution', 'original_id', 'nbg_id'])
+
+
+class GradingSkeleton(object):
+    """Precomputed information on a master notebook, used to match
+    submissions against it.  The skeleton does not modify the master, and
+    matching a submission modifies neither the skeleton nor the submission,
+    so a skeleton can be built once per master version and shared."""
+
+    def __init__(self, master_nb):
+        self.slots = []
+        self.original_ids = set()
+        self.nbg_ids = set()
+        for c in master_nb.cells:
+            if c.cell_type == "markdown":
+                self.slots.append(Slot(c, False, None, None))
+            elif c.metadata.notebookgrader.readonly:
+                cell = c.__class__(c)
+                cell.execution_count = None
+                cell.outputs = []
+                self.slots.append(Slot(cell, False, None, None))
+            else:
+                original_id = get_original_cell_id(c)
+                nbg_id = get_cell_id(c) if original_id is None else None
+                self.slots.append(Slot(c, True, original_id, nbg_id))
+                if original_id is not None:
+                    self.original_ids.add(original_id)
+                elif nbg_id is not None:
+                    self.nbg_ids.add(nbg_id)
+        self._master_nb = master_nb.__class__(master_nb)
+        self._master_nb.cells = [slot.cell for slot in self.slots]
+
+    def master_notebook(self):
+        """Returns the master notebook with the readonly cells cleaned."""
+        master_nb = self._master_nb.__class__(self._master_nb)
+        master_nb.cells = [_copy_cell(c) for c in self._master_nb.cells]
+        return master_nb
+
+    def _is_needed(self, cell):
+        """Returns whether a submission cell may be needed for grading:
+        it matches a solution slot, or it claims to be a solution."""
+        metadata = cell.get('metadata')
+        if not isinstance(metadata, dict):
+            return False
+        nbg = metadata.get('notebookgrader')
+        if not isinstance(nbg, dict):
+            return metadata.get('id') in self.original_ids
+        return (metadata.get('id') in self.original_ids
+                or nbg.get('id') in self.nbg_ids
+                or bool(nbg.get('is_solution')))
+
+    def read_submission(self, submission_json):
+        """Reads a submission, keeping only the cells that may be needed for
+        grading, and without decoding their outputs (see read_cells)."""
+        return read_cells(submission_json, self._is_needed)
+
+    def match(self, submission_nb):
+        """Matches the cells of the master and of a submission, producing a
+        notebook that is a candidate for grading."""
+        # Indexes the submission cells that correspond to solution slots.
+        original_id_to_cell = {}
+        nbg_id_to_cell = {}
+        for c in submission_nb.cells:
+            original_id = get_original_cell_id(c)
+            if original_id in self.original_ids:
+                original_id_to_cell[original_id] = c
+            nbg_id = get_cell_id(c)
+            if nbg_id in self.nbg_ids:
+                nbg_id_to_cell[nbg_id] = c
+        matched_nb = nbformat.v4.new_notebook()
+        for slot in self.slots:
+            if not slot.is_solution:
+                new_cell = _copy_cell(slot.cell)
+            elif slot.original_id is not None:
+                new_cell = _solution_cell(slot, original_id_to_cell.get(slot.original_id))
+            elif slot.nbg_id is not None:
+                new_cell = _solution_cell(slot, nbg_id_to_cell.get(slot.nbg_id))
+            else:
+                new_cell = nbformat.v4.new_markdown_cell(source=PROBLEM_NOTICE)
+            matched_nb.cells.append(new_cell)
+        return matched_nb
+
+
+def _copy_cell(cell):
+    """Returns a copy of a cell that can be modified (e.g., when writing the
+    notebook adds cell ids) without modifying the cell, except for its
+    source and outputs, which must be replaced rather than modified."""
+    new_cell = cell.__class__(cell)
+    new_cell.metadata = cell.metadata.__class__(cell.metadata)
+    if 'notebookgrader' in cell.metadata:
+        new_cell.metadata.notebookgrader = cell.metadata.notebookgrader.__class__(
+            cell.metadata.notebookgrader)
+    return new_cell
+
+
+def _solution_cell(slot, submission_cell):
+    """Merges a submission cell into a solution slot, without modifying the
+    submission cell."""
+    if submission_cell is None:
+        return nbformat.v4.new_markdown_cell(source=CELL_MISSING_NOTICE)
+    new_cell = submission_cell.__class__(submission_cell)
+    new_cell.outputs = []
+    new_cell.execution_count = 0
+    new_cell.metadata = submission_cell.metadata.__class__(submission_cell.metadata)
+    new_cell.metadata.notebookgrader = slot.cell.metadata.notebookgrader.__class__(
+        slot.cell.metadata.notebookgrader)
+    return new_cell
+
+
 def match_notebooks(master_nb, submission_nb):
     """Matches the cells of master and submission, producing a notebook
-    that is a candidate for grading."""
+    that is a candidate for grading.  Neither notebook is modified.
+    To match many submissions against the same master, build a
+    GradingSkeleton once and use its match method."""
+    return GradingSkeleton(master_nb).match(submission_nb)
+
+
+def submission_hash(nb, master_version):
+    """Returns a hash identifying what is graded in a matched notebook: the
+    sources of its solution cells, and the version of the master notebook
+    from which all the other cells come."""
+    h = hashlib.sha256(master_version.encode('utf-8'))
+    for c in nb.cells:
+        meta = c.metadata.get('notebookgrader') or {}
+        if c.cell_type == "code" and meta.get('is_solution'):
+            source = c.source.encode('utf-8')
+            h.update(b"%d:" % len(source))
+            h.update(source)
+    return h.hexdigest()
+
+
+# Incremental grading.
+# A test cell runs exactly as in a previous submission if its code, and the
+# code of all the cells before it, are unchanged.  Its previous result can
+# then be reused, and the cell need not be run, provided that running it does
+# not affect the cells that follow (e.g., by defining names they use).
+
+def cell_hash_chain(nb):
+    """Returns a dictionary mapping the notebookgrader id of each test cell
+    to a hash of its source and points, chained with the sources of all the
+    code cells that precede it."""
+    h = hashlib.sha256()
+    hashes = {}
+    for c in nb.cells:
+        if c.cell_type != "code":
+            continue
+        source = c.source.encode('utf-8')
+        h.update(b"%d:" % len(source))
+        h.update(source)
+        meta = c.metadata.get('notebookgrader') or {}
+        if meta.get('is_tests') and meta.get('id') is not None:
+            h.update(b"points:%r;" % meta.get('test_points'))
+            hashes[meta.id] = h.copy().hexdigest()
+    return hashes
+
+
+# Builtins that a test can call without side effects on the following cells.
+# Those that can run code of the notebook (e.g., map, or exec), or modify
+# objects (e.g., setattr, next), are excluded.
+SAFE_BUILTINS = frozenset([
+    'abs', 'all', 'any', 'bool', 'callable', 'chr', 'complex', 'dict', 'divmod',
+    'float', 'format', 'frozenset', 'hasattr', 'hash', 'id', 'int', 'isinstance',
+    'issubclass', 'len', 'list', 'ord', 'pow', 'print', 'range', 'repr', 'round',
+    'set', 'slice', 'str', 'tuple', 'type',
+]) & set(dir(builtins))
+
+
+def _cell_names(source):
+    """Returns the pair (bound, loaded) of the sets of names a cell binds and
+    uses, or None if this cannot be determined.  Cells that may modify
+    objects (attribute or item assignments, calls of anything but the
+    SAFE_BUILTINS) are not analyzed."""
+    try:
+        tree = ast.parse(source)
+    except SyntaxError:
+        # Also covers magics and shell commands.
+        return None
+    bound, loaded = set(), set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Name):
+            (loaded if isinstance(node.ctx, ast.Load) else bound).add(node.id)
+            continue
+        if isinstance(node, (ast.Attribute, ast.Subscript)) and not isinstance(node.ctx, ast.Load):
+            return None
+        if isinstance(node, (ast.Global, ast.Nonlocal, ast.Delete)):
+            return None
+        if isinstance(node, ast.Call) and not (
+                isinstance(node.func, ast.Name) and node.func.id in SAFE_BUILTINS):
+            # The function called may have side effects.
+            return None
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            bound.add(node.name)
+        elif isinstance(node, (ast.Import, ast.ImportFrom)):
+            for alias in node.names:
+                bound.add((alias.asname or alias.name).split('.')[0])
+    return bound, loaded
+
+
+def reusable_test_results(nb, previous_hashes, previous_points):
+    """Returns a dictionary mapping the ids of the test cells of a matched
+    notebook whose previous result can be reused to the points they earned.
+    Args:
+        nb: the matched notebook to grade.
+        previous_hashes: the cell_hash_chain of the previous submission.
+        previous_points: the points of the previous submission, by cell id.
+    A test cell is reused only if its hash chain is unchanged, it calls only
+    SAFE_BUILTINS that the notebook does not redefine, and it binds no name
+    used by the following cells; if this is uncertain (e.g., a cell cannot be
+    parsed), the test is run."""
+    hashes = cell_hash_chain(nb)
+    code_cells = [c for c in nb.cells if c.cell_type == "code"]
+    # Names used by the cells following each cell, or None if unknown.
+    names_used_after = [None] * len(code_cells)
+    used = set()
+    # Names bound by the cells, to check that the builtins are not redefined.
+    redefined = set()
+    for i in range(len(code_cells) - 1, -1, -1):
+        names_used_after[i] = used
+        names = _cell_names(code_cells[i].source)
+        if names is None:
+            used = None
+        else:
+            redefined |= names[0]
+            if used is not None:
+                used = used | names[1]
+    reused = {}
+    for i, c in enumerate(code_cells):
+        meta = c.metadata.get('notebookgrader') or {}
+        cell_id = meta.get('id')
+        if not meta.get('is_tests') or cell_id not in hashes:
+            continue
+        if hashes[cell_id] != previous_hashes.get(cell_id) or previous_points.get(cell_id) is None:
+            continue
+        names = _cell_names(c.source)
+        if names is None or names[1] & redefined & SAFE_BUILTINS:
+            continue
+        if names[0] and (names_used_after[i] is None or names[0] & names_used_after[i]):
+            continue
+        reused[cell_id] = previous_points[cell_id]
+    return reused
+
+
+def mark_reused_tests(nb, reused):
+    """Marks the test cells with reused results, which graders can skip:
+    they get the notebookgrader 'skip' flag, their points_earned, and a
+    notice as output.  The marked cells are replaced by copies, as the cells
+    of a matched notebook are shared with the grading skeleton."""
+    for i, c in enumerate(nb.cells):
+        meta = c.metadata.get('notebookgrader') if c.cell_type == "code" else None
+        if meta is not None and meta.get('id') in reused:
+            c = nb.cells[i] = copy.deepcopy(c)
+            meta = c.metadata.notebookgrader
+            meta.skip = True
+            meta.points_earned = reused[meta.id]
+            c.outputs = [nbformat.v4.new_output(
+                'stream', name='stdout', text=REUSED_RESULT_NOTICE.format(reused[meta.id]))]
+
+
+##################################
+
+def _legacy_match_notebooks(master_nb, submission_nb):
+    """The previous implementation, which modifies the master; kept to test
+    and benchmark the skeleton against."""
     matched_nb = nbformat.v4.new_notebook()
-    # Builds a dictionary from ids to cells for the submission. 
     original_id_to_cell = {}
     nbg_id_to_cell = {}
     for c in submission_nb.cells:
@@ -71,9 +344,7 @@ def match_notebooks(master_nb, submission_nb):
         nbg_id = get_cell_id(c)
         if nbg_id is not None:
             nbg_id_to_cell[nbg_id] = c
-    # Goes through the master notebook, and tries to match the cells.
     for c in master_nb.cells:
-        new_cell = None
         if c.cell_type == "markdown":
             new_cell = c
         elif c.metadata.notebookgrader.readonly:
@@ -81,11 +352,9 @@ def match_notebooks(master_nb, submission_nb):
             c.outputs = []
             new_cell = c
         else:
-            # This is a solution cell, and we need to get it from the submission.
             master_id = get_original_cell_id(c)
             if master_id is not None:
                 if master_id in original_id_to_cell:
-                    # The cells match.  Merges them.
                     new_cell = original_id_to_cell[master_id]
                     new_cell.outputs = []
                     new_cell.execution_count = 0
@@ -93,19 +362,164 @@ def match_notebooks(master_nb, submission_nb):
                 else:
                     new_cell = nbformat.v4.new_markdown_cell(source=CELL_MISSING_NOTICE)
             else:
-                # We try to match by notebook id. 
                 master_nbg_id = get_cell_id(c)
-                if master_nbg_id is not None:
-                    if master_nbg_id in nbg_id_to_cell:
-                        # The cells match.  Merges them.
-                        new_cell = nbg_id_to_cell[master_nbg_id]
-                        new_cell.outputs = []
-                        new_cell.execution_count = 0
-                        new_cell.metadata.notebookgrader = c.metadata.notebookgrader
-                    else:
-                        new_cell = nbformat.v4.new_markdown_cell(source=CELL_MISSING_NOTICE)
+                if master_nbg_id is not None and master_nbg_id in nbg_id_to_cell:
+                    new_cell = nbg_id_to_cell[master_nbg_id]
+                    new_cell.outputs = []
+                    new_cell.execution_count = 0
+                    new_cell.metadata.notebookgrader = c.metadata.notebookgrader
+                elif master_nbg_id is not None:
+                    new_cell = nbformat.v4.new_markdown_cell(source=CELL_MISSING_NOTICE)
                 else:
                     new_cell = nbformat.v4.new_markdown_cell(source=PROBLEM_NOTICE)
         matched_nb.cells.append(new_cell)
     return matched_nb
 
+def _master_and_submission(n_copies=1):
+    from .notebook_logic import create_master_notebook
+    with open("./test_files/TestoutJuly2023source.json") as f:
+        nb = nbformat.reads(f.read(), as_version=4)
+    nb.cells = [copy.deepcopy(c) for _ in range(n_copies) for c in nb.cells]
+    master_json, _, _ = create_master_notebook(nbformat.writes(nb, 4))
+    # The submission is the master with one solution cell missing.
+    submission_nb = nbformat.reads(master_json, as_version=4)
+    del submission_nb.cells[2]
+    return master_json, submission_nb
+
+def _strip_ids(nb):
+    # The notice cells get random ids.
+    return [{k: v for k, v in c.items() if k != 'id'} for c in nb.cells]
+
+def test_skeleton_matches_legacy():
+    master_json, submission_nb = _master_and_submission()
+    master_nb = nbformat.reads(master_json, as_version=4)
+    skeleton = GradingSkeleton(master_nb)
+    matched = skeleton.match(submission_nb)
+    assert master_nb == nbformat.reads(master_json, as_version=4)
+    legacy = _legacy_match_notebooks(master_nb, submission_nb)
+    assert _strip_ids(matched) == _strip_ids(legacy)
+    assert skeleton.master_notebook() == master_nb
+
+def test_match_shares_no_cells():
+    master_json, submission_nb = _master_and_submission()
+    master_nb = nbformat.reads(master_json, as_version=4)
+    master_nb.nbformat_minor = 4
+    for c in master_nb.cells:
+        c.pop('id', None)
+    pristine = copy.deepcopy(master_nb)
+    skeleton = GradingSkeleton(master_nb)
+    slots = copy.deepcopy(skeleton.slots)
+    # Writing the notebooks adds ids to their cells, and graders modify them.
+    for nb in (skeleton.match(submission_nb), skeleton.master_notebook()):
+        nb.nbformat_minor = 5
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            nbformat.writes(nb, 4)
+        for c in nb.cells:
+            c.metadata['modified'] = True
+            c.metadata.get('notebookgrader', {})['modified'] = True
+    assert master_nb == pristine
+    assert skeleton.slots == slots
+
+def test_read_submission():
+    master_json, submission_nb = _master_and_submission()
+    skeleton = GradingSkeleton(nbformat.reads(master_json, as_version=4))
+    submission_json = nbformat.writes(submission_nb, 4)
+    partial_nb = skeleton.read_submission(submission_json)
+    assert 0 < len(partial_nb.cells) < len(submission_nb.cells)
+    assert _strip_ids(skeleton.match(partial_nb)) == _strip_ids(skeleton.match(submission_nb))
+
+def test_benchmark_match_notebooks(n_copies=200, n_submissions=20):
+    """Compares matching submissions against a shared skeleton with the
+    legacy matcher, on a notebook of a few thousand cells.
+    Run with pytest -s to see timings."""
+    master_json, submission_nb = _master_and_submission(n_copies)
+    master_nb = nbformat.reads(master_json, as_version=4)
+    t0 = time.perf_counter()
+    for _ in range(n_submissions):
+        # The legacy matcher modifies its inputs, so it needs fresh copies.
+        _legacy_match_notebooks(copy.deepcopy(master_nb), copy.deepcopy(submission_nb))
+    t1 = time.perf_counter()
+    skeleton = GradingSkeleton(master_nb)
+    for _ in range(n_submissions):
+        skeleton.match(submission_nb)
+    t2 = time.perf_counter()
+    print("\nMatching {} submissions of {} cells: legacy {:.4f}s, skeleton {:.4f}s".format(
+        n_submissions, len(master_nb.cells), t1 - t0, t2 - t1))
+
+def _incremental_notebook(solution="x = 2"):
+    def code(source, **meta):
+        c = nbformat.v4.new_code_cell(source)
+        c.metadata.notebookgrader = nbformat.NotebookNode(meta)
+        return c
+    nb = nbformat.v4.new_notebook()
+    nb.cells = [
+        code("import math", readonly=True),
+        code("assert math.pi > 3", is_tests=True, id="t1", test_points=1),
+        code(solution, is_solution=True),
+        code("assert x == 2", is_tests=True, id="t2", test_points=5),
+        code("z = 1\nassert x + z == 3", is_tests=True, id="t3", test_points=2),
+        code("assert z == 1", is_tests=True, id="t4", test_points=1),
+    ]
+    return nb
+
+def test_submission_hash():
+    h = submission_hash(_incremental_notebook(), "v1")
+    assert submission_hash(_incremental_notebook(), "v1") == h
+    assert submission_hash(_incremental_notebook(), "v2") != h
+    assert submission_hash(_incremental_notebook("x = 3"), "v1") != h
+    # Only the solution cells of the submission matter.
+    nb = _incremental_notebook()
+    nb.cells[3].outputs = [nbformat.v4.new_output('stream', name='stdout', text="ok")]
+    assert submission_hash(nb, "v1") == h
+
+def test_reusable_test_results():
+    previous = _incremental_notebook()
+    hashes = cell_hash_chain(previous)
+    assert sorted(hashes) == ["t1", "t2", "t3", "t4"]
+    points = dict(t1=1, t2=5, t3=2, t4=1)
+    # t3 defines a name used later, so it has to run again.
+    assert reusable_test_results(_incremental_notebook(), hashes, points) == dict(t1=1, t2=5, t4=1)
+    # Changing the solution invalidates only the tests after it.
+    nb = _incremental_notebook("x = 3")
+    assert reusable_test_results(nb, hashes, points) == dict(t1=1)
+    nb = _incremental_notebook()
+    nb.cells[3].metadata.notebookgrader.test_points = 6
+    assert reusable_test_results(nb, hashes, points) == dict(t1=1)
+    # Cells that cannot be analyzed, and the tests that define names they
+    # might use, are run.
+    nb = _incremental_notebook()
+    nb.cells[-1].source = "%time assert z == 1"
+    assert reusable_test_results(nb, cell_hash_chain(nb), points) == dict(t1=1, t2=5)
+    nb.cells[-1].source = "print(z)"
+    assert reusable_test_results(nb, cell_hash_chain(nb), points) == dict(t1=1, t2=5, t4=1)
+    nb.cells[3].source = "assert [x].pop() == 2"
+    assert reusable_test_results(nb, cell_hash_chain(nb), points) == dict(t1=1, t4=1)
+    # Tests calling functions of the notebook may have side effects.
+    nb = _incremental_notebook("items = []\ndef add(v):\n    items.append(v)\n    return len(items)\nx = 2")
+    nb.cells[3].source = "assert add(3) == 1"
+    assert reusable_test_results(nb, cell_hash_chain(nb), points) == dict(t1=1, t4=1)
+    # So do builtins that the notebook redefines.
+    nb = _incremental_notebook("def len(v):\n    return 0\nx = 2")
+    nb.cells[3].source = "assert len([x]) == 0"
+    assert reusable_test_results(nb, cell_hash_chain(nb), points) == dict(t1=1, t4=1)
+
+def test_mark_reused_tests():
+    master_json, submission_nb = _master_and_submission()
+    master_nb = nbformat.reads(master_json, as_version=4)
+    skeleton = GradingSkeleton(master_nb)
+    nb = skeleton.match(submission_nb)
+    test_ids = [c.metadata.notebookgrader.id for c in nb.cells
+                if c.cell_type == "code" and c.metadata.notebookgrader.get('is_tests')]
+    mark_reused_tests(nb, {test_ids[0]: 99})
+    marked = [c for c in nb.cells if c.metadata.get('notebookgrader', {}).get('skip')]
+    assert len(marked) == 1 and marked[0].metadata.notebookgrader.points_earned == 99
+    # Neither the skeleton nor the master are modified.
+    assert not any(c.metadata.get('notebookgrader', {}).get('skip')
+                   for c in skeleton.match(submission_nb).cells)
+    assert master_nb == nbformat.reads(master_json, as_version=4)
+    nb = _incremental_notebook()
+    mark_reused_tests(nb, dict(t2=5))
+    assert nb.cells[3].metadata.notebookgrader.skip
+    assert nb.cells[3].metadata.notebookgrader.points_earned == 5
+    assert "skip" not in nb.cells[4].metadata.notebookgrader
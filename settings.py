@@ -123,10 +123,123 @@ else:
     GRADING_URL = GRADING_FUNCTION_URL
     FEEDBACK_URL = FEEDBACK_FUNCTION_URL
 
+# Local grading engine (see grading_engine.py).  If USE_LOCAL_GRADER is True,
+# notebooks are graded in this process rather than by GRADING_URL; if
+# LOCAL_GRADER_FALLBACK is True, they are graded locally when GRADING_URL
+# cannot be reached.  Both require jupyter_client and ipykernel.
+USE_LOCAL_GRADER = False
+LOCAL_GRADER_FALLBACK = False
+LOCAL_GRADER_URL = "local:grader"
+LOCAL_GRADER_WORKERS = os.cpu_count() or 1
+# Notebooks run in a kernel before it is replaced by a fresh one.
+LOCAL_GRADER_MAX_RUNS_PER_KERNEL = 1
+LOCAL_GRADER_MAX_MEMORY_GROWTH = 512 * 2**20 # Bytes
+LOCAL_GRADER_CELL_TIMEOUT = 60 # Seconds
+# If True, the setup cells that precede the first solution cell are run once
+# per assignment version, and submissions are run in forked copies of the
+# resulting process (Linux and macOS only).
+LOCAL_GRADER_SNAPSHOT_SETUP = False
+LOCAL_GRADER_MAX_SNAPSHOTS = 2 # Assignment versions kept by each worker.
+if USE_LOCAL_GRADER:
+    GRADING_URL = LOCAL_GRADER_URL
+
+# If True, the test cells of a submission whose code, and all the code before
+# them, are unchanged since the previous grade reuse its results, and are not
+# run again by the local grader (see run_notebook.reusable_test_results).
+# Off until the remote grader (GRADING_URL) also skips them.
+INCREMENTAL_GRADING = False
+
+# Scheduler of grading requests (see grading_scheduler.py), providing fair
+# sharing of the graders between assignments and students.  Its queue is kept
+# in the memory of one process, so enable it only if the app runs as a single
+# instance: grades received by another instance do not free the slots of
+# their requests, and queued requests are lost on restart (see
+# GRADING_REQUEST_TIMEOUT).
+USE_GRADING_SCHEDULER = False
+GRADING_SCHEDULER_BACKEND = "threads" # Or "celery", which requires USE_CELERY.
+GRADING_SCHEDULER_WORKERS = 8 # Threads sending requests.
+GRADING_SCHEDULER_MAX_IN_FLIGHT = 64
+GRADING_SCHEDULER_MAX_PER_ASSIGNMENT = 32
+# Assignments due within the window get a larger share of the graders.
+GRADING_SCHEDULER_DEADLINE_WINDOW = 2 * 3600 # Seconds
+GRADING_SCHEDULER_DEADLINE_WEIGHT = 2
+# Time after which a request whose grade has not arrived no longer counts.
+GRADING_SCHEDULER_IN_FLIGHT_TIMEOUT = 10 * 60 # Seconds
+# Time an instructor waits for the run of a notebook before getting an error.
+GRADING_SCHEDULER_IMMEDIATE_TIMEOUT = 5 * 60 # Seconds
+
+# Assignments whose notebooks are copied at the same time, in course copies.
+COURSE_COPY_WORKERS = 4
+
+# Background jobs (see jobs.py), run by threads of the app ("threads"), or by
+# the celery workers ("celery", which requires USE_CELERY).  Jobs whose run
+# was lost are run again every JOB_SWEEP_INTERVAL, or, if they were running,
+# after JOB_RUNNING_TIMEOUT.
+JOB_EXECUTOR = "threads"
+JOB_WORKERS = 4 # Threads running jobs, for "threads".
+JOB_SWEEP_INTERVAL = 60 # Seconds
+JOB_RUNNING_TIMEOUT = 60 * 60 # Seconds
+
+# Threads updating the sharing of assignment files when teachers change
+# (see acl_sync.py).
+ACL_SYNC_WORKERS = 4
+
+# Provisioning of student notebooks (see provisioning.py), run every
+# PROVISIONING_INTERVAL by celery beat or, when USE_CELERY is False, by a
+# thread of the app processes serving the student pages.  The notebooks of an
+# assignment are created in the Drive of the students up to PROVISIONING_LEAD
+# before it opens, by jobs (see jobs.py), so JOB_WORKERS at a time per process.
+PROVISIONING_INTERVAL = 60 # Seconds
+PROVISIONING_LEAD = 10 * 60 # Seconds
+PROVISIONING_BATCH_SIZE = 1000 # Maximum notebooks enqueued per run.
+
 MIN_TIME_BETWEEN_GRADE_REQUESTS = 12 # Seconds
 MAX_AGE_AI_PENDING_REQUEST = 60 * 60 # Seconds
+# Grading requests still without a grade after this time are marked as
+# failed, so the student can ask again; a grade that arrives later is kept.
+GRADING_REQUEST_TIMEOUT = 30 * 60 # Seconds
 STUDENT_GRADING_USES_QUEUE = IS_CLOUD
 
+# Cache of master and student notebooks, keyed by content digest.
+NOTEBOOK_CACHE_MAX_BYTES = 128 * 2**20
+# Set to a folder to also keep the cached notebooks on local disk.
+NOTEBOOK_CACHE_FOLDER = None
+NOTEBOOK_CACHE_MAX_DISK_BYTES = 1024 * 2**20
+# Compaction of the submissions and feedback stored in GCS_SUBMISSIONS_BUCKET.
+# Outputs larger than STORED_NOTEBOOK_MAX_OUTPUT_SIZE characters are:
+# kept ("keep"), truncated if text and removed otherwise ("truncate"),
+# or removed ("drop").  See notebook_logic.compact_outputs.
+STORED_NOTEBOOK_OUTPUTS = "truncate"
+STORED_NOTEBOOK_MAX_OUTPUT_SIZE = 16 * 1024
+STORED_NOTEBOOK_GZIP = True
+
+# Number of parsed master notebooks, and of grading skeletons derived from
+# them, kept in memory for grading.
+MASTER_NOTEBOOK_CACHE_SIZE = 64
+
+# If True, the notebooks sent to the grading and feedback functions are written
+# to GCS_SUBMISSIONS_BUCKET under PAYLOAD_PREFIX, and the requests carry only
+# references to them, with signed urls valid for PAYLOAD_URL_EXPIRATION seconds;
+# the functions can also return their results by reference.
+# Set up a lifecycle rule on the bucket to delete the payloads after a few days.
+# A payload written by a process is not written again by it for
+# PAYLOAD_REWRITE_AFTER seconds; the lifecycle age must exceed
+# PAYLOAD_REWRITE_AFTER + PAYLOAD_URL_EXPIRATION, so that payloads are not
+# deleted while requests refer to them.
+PAYLOADS_BY_REFERENCE = False
+PAYLOAD_PREFIX = "payloads/"
+PAYLOAD_URL_EXPIRATION = 24 * 3600
+PAYLOAD_REWRITE_AFTER = 12 * 3600
+
+# Drive services kept in memory, and time (seconds) after which they are rebuilt.
+DRIVE_SERVICE_CACHE_SIZE = 256
+DRIVE_SERVICE_TTL = 30 * 60
+
+# Worker threads that store submissions and enqueue grading requests after
+# grade_homework has returned, and maximum number of pending jobs.
+BACKGROUND_WORKERS = 4
+BACKGROUND_MAX_PENDING = 32
+
 
 # Google Cloud Database
 CLOUD_DB_URI = "google:MySQLdb://{DB_USER}:{DB_PASSWORD}@/{DB_NAME}?unix_socket=/cloudsql/{DB_CONNECTION}".format(
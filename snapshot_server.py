@@ -0,0 +1,159 @@
+# Server that runs the setup cells of an assignment once, and then runs the
+# cells of each submission in a forked copy of itself, so that every
+# submission starts from the state left by the setup cells without running
+# them again.  See grading_engine.SnapshotKernel.
+# This is a standalone script (it does not import the app), so that it starts
+# in a clean interpreter; it requires IPython, and a system with fork.
+# The protocol consists of json lines on stdin and stdout.  The first request
+# is {"setup": [source, ...], "cell_timeout": seconds}; each following request
+# is {"cells": [source, ...]}.  Each request is answered with
+# {"results": [result, ...]}, with one result per cell:
+# {"outputs": [output, ...], "error": output or null, "execution_count": n},
+# where the outputs are in nbformat v4 form.
+
+import json
+import os
+import select
+import signal
+import sys
+import time
+
+from IPython.core.interactiveshell import InteractiveShell
+from IPython.utils.capture import capture_output
+from traitlets.config import Config
+
+CELL_TIMEOUT_NOTICE = "Cell execution timed out after {} seconds."
+HARD_TIMEOUT_NOTICE = "The submission did not stop after its cells timed out."
+# Once a cell has timed out, the timeout is raised again every ALARM_REPEAT
+# seconds, in case the cell catches it.  A forked child that is still running
+# CHILD_GRACE seconds after all its cells should have timed out is killed.
+ALARM_REPEAT = 1
+CHILD_GRACE = 5
+
+
+# Not an Exception, so that cells catching Exception do not catch it.
+class CellTimeout(BaseException):
+    pass
+
+
+def _on_alarm(signum, frame):
+    raise CellTimeout()
+
+
+def make_shell():
+    # The history is kept by a thread, which would not survive the fork.
+    config = Config()
+    config.HistoryManager.enabled = False
+    shell = InteractiveShell.instance(config=config)
+    # Errors and results are recorded, rather than printed.
+    shell._showtraceback = lambda etype, evalue, stb: shell._nbg_tracebacks.append(stb)
+    shell.displayhook.write_output_prompt = lambda: None
+    shell.displayhook.write_format_data = (
+        lambda format_dict, md_dict=None: shell._nbg_results.append((format_dict, md_dict or {})))
+    return shell
+
+
+def run_cell(shell, source, timeout):
+    shell._nbg_tracebacks = []
+    shell._nbg_results = []
+    if timeout:
+        signal.setitimer(signal.ITIMER_REAL, timeout, ALARM_REPEAT)
+    try:
+        with capture_output() as cap:
+            result = shell.run_cell(source, store_history=True)
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+    outputs = []
+    if cap.stdout:
+        outputs.append(dict(output_type="stream", name="stdout", text=cap.stdout))
+    if cap.stderr:
+        outputs.append(dict(output_type="stream", name="stderr", text=cap.stderr))
+    for o in cap.outputs:
+        outputs.append(dict(output_type="display_data", data=o.data, metadata=o.metadata or {}))
+    for data, metadata in shell._nbg_results:
+        outputs.append(dict(output_type="execute_result", data=data, metadata=metadata,
+                            execution_count=result.execution_count))
+    error = None
+    e = result.error_before_exec or result.error_in_exec
+    if e is not None:
+        if isinstance(e, CellTimeout):
+            notice = CELL_TIMEOUT_NOTICE.format(timeout)
+            error = dict(output_type="error", ename="TimeoutError", evalue=notice,
+                         traceback=[notice])
+        else:
+            error = dict(output_type="error", ename=type(e).__name__, evalue=str(e),
+                         traceback=shell._nbg_tracebacks[-1] if shell._nbg_tracebacks else [])
+        outputs.append(error)
+    return dict(outputs=outputs, error=error, execution_count=result.execution_count)
+
+
+def run_cells(shell, sources, timeout):
+    return [run_cell(shell, source, timeout) for source in sources]
+
+
+def run_forked(shell, sources, timeout, protocol_fds=()):
+    """Runs the cells in a forked child, which sends back the results.
+    The child closes the protocol_fds, so that the cells cannot use them."""
+    r, w = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(r)
+        for fd in protocol_fds:
+            os.close(fd)
+        try:
+            data = json.dumps(dict(results=run_cells(shell, sources, timeout)), default=repr)
+        except BaseException as e:
+            data = json.dumps(dict(error="{}: {}".format(type(e).__name__, e)))
+        with os.fdopen(w, 'w') as f:
+            f.write(data)
+        os._exit(0)
+    os.close(w)
+    deadline = time.monotonic() + timeout * len(sources) + CHILD_GRACE if timeout else None
+    chunks = []
+    with os.fdopen(r, 'rb') as f:
+        while True:
+            wait = None if deadline is None else max(0, deadline - time.monotonic())
+            ready, _, _ = select.select([f], [], [], wait)
+            if not ready:
+                # The cells keep catching their timeouts.
+                os.kill(pid, signal.SIGKILL)
+                os.waitpid(pid, 0)
+                return dict(error=HARD_TIMEOUT_NOTICE)
+            chunk = os.read(r, 1 << 16)
+            if not chunk:
+                break
+            chunks.append(chunk)
+    os.waitpid(pid, 0)
+    try:
+        return json.loads(b"".join(chunks).decode('utf-8'))
+    except ValueError:
+        # The child died without answering (e.g., it called os._exit), or
+        # the cells wrote to the pipe.
+        return dict(error="The grading process terminated unexpectedly.")
+
+
+def main():
+    signal.signal(signal.SIGALRM, _on_alarm)
+    # Requests and answers use copies of stdin and stdout, which are then
+    # redirected, so the cells cannot interfere with the protocol.
+    requests = os.fdopen(os.dup(0))
+    out = os.fdopen(os.dup(1), 'w')
+    devnull = os.open(os.devnull, os.O_RDWR)
+    os.dup2(devnull, 0)
+    os.dup2(devnull, 1)
+    shell = make_shell()
+    timeout = None
+    for line in requests:
+        request = json.loads(line)
+        if 'setup' in request:
+            timeout = request.get('cell_timeout')
+            answer = dict(results=run_cells(shell, request['setup'], timeout))
+        else:
+            answer = run_forked(shell, request['cells'], timeout,
+                                protocol_fds=(requests.fileno(), out.fileno()))
+        out.write(json.dumps(answer, default=repr) + "\n")
+        out.flush()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+// This will be the object that will contain the Vue attributes
+// and be used to initialize it.
+let app = {};
+
+
+// Given an empty app object, initializes it filling its attributes,
+// creates a Vue instance, and then initializes the Vue instance.
+let init = (app) => {
+
+    // This is the Vue data.
+    app.data = {
+        assignments: [],
+        select_all: false,
+        shift_days: 0,
+        starting: false,
+        error: null,
+        progress_url: null,
+        total: 0,
+        completed: 0,
+        failed: 0,
+        is_done: false,
+        errors: [],
+        new_assignments: [],
+    };
+
+    app.format_date = function (d) {
+        if (!d) {
+            return "";
+        }
+        return luxon.DateTime.fromISO(d, {zone: "UTC"}).setZone("local").toLocaleString(luxon.DateTime.DATETIME_SHORT);
+    };
+
+    app.on_error = function (err) {
+        if (err.response && err.response.status == 403) {
+            location.assign(error_url);
+        } else {
+            location.assign(internal_error_url);
+        }
+    };
+
+    app.toggle_all = function () {
+        for (let a of app.vue.assignments) {
+            a.selected = app.vue.select_all;
+        }
+    };
+
+    app.start = function () {
+        let ids = app.vue.assignments.filter((a) => a.selected).map((a) => a.id);
+        app.vue.starting = true;
+        app.vue.error = null;
+        axios.post(duplicate_course_url, {
+            assignment_ids: ids,
+            shift_days: app.vue.shift_days,
+        }).then(function (res) {
+            app.vue.starting = false;
+            if (res.data.error) {
+                app.vue.error = res.data.error;
+            } else {
+                app.vue.total = ids.length;
+                app.vue.progress_url = res.data.progress_url;
+                app.check_progress();
+            }
+        }).catch(app.on_error);
+    };
+
+    app.check_progress = function (delay=1000) {
+        setTimeout(() => {
+            axios.get(app.vue.progress_url).then(function (res) {
+                app.vue.total = res.data.total;
+                app.vue.completed = res.data.completed;
+                app.vue.failed = res.data.failed;
+                app.vue.errors = res.data.errors;
+                app.vue.new_assignments = res.data.assignments;
+                app.vue.is_done = res.data.is_done;
+                if (!res.data.is_done) {
+                    app.check_progress(Math.min(delay * 1.5, 10000));
+                }
+            }).catch(app.on_error);
+        }, delay);
+    };
+
+    // This contains all the methods.
+    app.methods = {
+        toggle_all: app.toggle_all,
+        start: app.start,
+    };
+
+    // This creates the Vue instance.
+    app.vue = new Vue({
+        el: "#vue-target",
+        data: app.data,
+        methods: app.methods
+    });
+
+    // And this initializes it.
+    app.init = () => {
+        axios.get(duplicate_course_url).then(function (res) {
+            for (let a of res.data.assignments) {
+                a.selected = false;
+                a.available_from_display = app.format_date(a.available_from);
+                a.deadline_display = app.format_date(a.submission_deadline);
+            }
+            app.vue.assignments = res.data.assignments;
+        }).catch(app.on_error);
+    };
+
+    // Call to the initializer.
+    app.init();
+};
+
+// This takes the (empty) app object, and initializes it,
+// putting all the code i
+init(app);
@@ -206,6 +206,32 @@ let init = (app) => {
         })
     }
 
+    app.check_feedback = function (delay=5000) {
+        // The feedback of a grade is copied to Drive in the background,
+        // so its link may arrive after the grade.
+        if (app.vue.grades.every((g) => g.feedback)) {
+            return;
+        }
+        setTimeout(() => {
+            axios.get(homework_grades_url).then(function (res) {
+                let feedback = {};
+                for (let g of res.data.grades) {
+                    feedback[g.id] = g.feedback;
+                }
+                for (let g of app.vue.grades) {
+                    if (g.id in feedback) {
+                        g.feedback = feedback[g.id];
+                    }
+                }
+                app.check_feedback(Math.min(delay * 1.2, 5 * 60 * 1000));
+            }).catch(function (err) {
+                if (err.response && err.response.status == 403) {
+                    location.assign(error_url);
+                }
+            });
+        }, delay);
+    };
+
     app.check_new_grade = function (delay=10000) {
         setTimeout(() => {
             // First, we compute the last grade date.
@@ -231,6 +257,7 @@ let init = (app) => {
                                 // We already had this grade.
                                 old_g = old_grades[g.id];
                                 old_g.is_valid = g.is_valid;
+                                old_g.feedback = g.feedback;
                                 new_grades.push(old_g);
                             } else {
                                 // This is a new grade.
@@ -246,6 +273,12 @@ let init = (app) => {
                         app.vue.grading_outcome = "";
                         app.vue.grading_error = "";
                         app.vue.cell_source = "";
+                        app.check_feedback();
+                    } else if (res.data.last_request_failed) {
+                        // The request could not be submitted for grading.
+                        app.vue.is_grading = false;
+                        app.vue.grading_outcome = "Your request could not be submitted for grading; please try again.";
+                        app.vue.grading_error = true;
                     } else {
                         // We have to wait a bit more.
                         app.check_new_grade(Math.min(delay * 1.2, 5 * 60 * 1000));
@@ -346,6 +379,7 @@ let init = (app) => {
             }
             app.vue.most_recent_request = luxon.DateTime.fromISO(res.data.most_recent_request, {zone: "UTC"});
             app.vue.has_pending_requests = res.data.has_pending_requests;
+            app.check_feedback();
             // If there are pending requests, tries to get the new grades.
             if (app.vue.has_pending_requests) {
                 app.check_new_grade();
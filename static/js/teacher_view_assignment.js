@@ -18,6 +18,7 @@ let init = (app) => {
         access_url: null,
         uploading: false,
         upload_error: null,
+        sharing: null,
     };
 
     app.regenerate_access_url = function () {
@@ -79,6 +80,15 @@ let init = (app) => {
         });
     };
 
+    app.check_sharing = function (delay=2000) {
+        axios.get(sharing_progress_url).then(function (res) {
+            app.vue.sharing = res.data.progress;
+            if (res.data.progress && !res.data.progress.is_done) {
+                setTimeout(() => app.check_sharing(Math.min(delay * 1.5, 30000)), delay);
+            }
+        });
+    };
+
     // This contains all the methods.
     app.methods = {
         regenerate_access_url: app.regenerate_access_url,
@@ -99,6 +109,7 @@ let init = (app) => {
             app.vue.access_url = res.data.access_url;
         });
         app.get_notebook_urls();
+        app.check_sharing();
     };
 
     // Call to the initializer.
@@ -12,14 +12,19 @@ from yatl.helpers import A, BUTTON, SPAN
 from .common import db, session, auth
 from .models import get_user_email
 from .settings import APP_FOLDER, COLAB_BASE, GCS_BUCKET, GCS_SUBMISSIONS_BUCKET
-from .settings import MIN_TIME_BETWEEN_GRADE_REQUESTS, MAX_AGE_AI_PENDING_REQUEST
-from .settings import GRADING_URL, FEEDBACK_URL
+from .settings import MIN_TIME_BETWEEN_GRADE_REQUESTS, MAX_AGE_AI_PENDING_REQUEST, GRADING_REQUEST_TIMEOUT
+from .settings import GRADING_URL, FEEDBACK_URL, INCREMENTAL_GRADING, USE_GRADING_SCHEDULER, USE_CELERY
 
-from .common import flash, url_signer, gcs
+from .common import flash, url_signer, gcs, background_pool
 from .util import upload_to_drive, read_from_drive, long_random_id, random_id, send_function_request
-from .run_notebook import match_notebooks
 from .notebook_logic import remove_all_hidden_tests, extract_awarded_points, is_notebook_well_formed
-from .models import build_drive_service, get_assignment_teachers
+from .grading_scheduler import get_grading_scheduler
+from .feedback_jobs import enqueue_feedback_upload, enqueue_ai_feedback_upload
+from .provisioning import start_provisioning_thread, assign_notebook
+from .run_notebook import cell_hash_chain, reusable_test_results, mark_reused_tests, submission_hash
+from .models import (build_drive_service, get_assignment_teachers, read_assignment_notebook,
+                     read_grading_skeleton, write_stored_notebook, read_stored_notebook,
+                     add_payload_notebooks, read_callback_notebook)
 
 from .api_homework_grid import HomeworkGrid
 from .api_grades_grid import StudentGradesGrid
@@ -30,11 +35,17 @@ from .api_grades_grid import StudentGradesGrid
 homework_grid = HomeworkGrid('homework-grid')
 student_grades_grid = StudentGradesGrid('student-grades-grid')
 
+def ensure_provisioning():
+    """Starts the provisioning of the notebooks in the processes serving the
+    students.  With celery, it is run by tasks.provision_notebooks instead."""
+    if not USE_CELERY:
+        start_provisioning_thread()
+
 
 def share_assignment_with_student(assignment):
     """Shares an assignment with a student, creating the Google Colab,
     and returning its id."""
-    notebook_json = gcs.read(GCS_BUCKET, assignment.student_id_gcs)
+    notebook_json = read_assignment_notebook(assignment)
     drive_service = build_drive_service()
     student_drive_id = upload_to_drive(drive_service, notebook_json.decode('utf-8'),
                                        assignment.name,
@@ -97,6 +108,7 @@ def invite(access_url=None):
 @action('student-home')
 @action.uses('student_home.html', db, flash, auth.user, homework_grid)
 def student_home():
+    ensure_provisioning()
     return dict(
         has_no_homework=db(db.homework.student == get_user_email()).isempty(),
         grid=homework_grid(),
@@ -107,6 +119,7 @@ def student_home():
 @action.uses('homework.html', db, auth.user, url_signer)
 def homework(id=None):
     """Displays details on a student's homework."""
+    ensure_provisioning()
     homework = db.homework[id]
     if homework is None or homework.student != get_user_email():
         redirect(URL('student-home'))
@@ -131,6 +144,8 @@ def api_homework_details(id=None):
         raise HTTP(403)
     assignment = db.assignment[homework.assignment_id]
     assert assignment is not None
+    # Provisioned notebooks are given only once the assignment opens.
+    is_open = assignment.available_from < datetime.datetime.utcnow()
     return dict(
         max_points="{:.2f}".format(assignment.max_points) if assignment.max_points is not None else "",
         submission_deadline=assignment.submission_deadline.isoformat(),
@@ -138,7 +153,7 @@ def api_homework_details(id=None):
         available_until=assignment.available_until.isoformat(),
         max_in_24h=assignment.max_submissions_in_24h_period,
         can_obtain_notebook=assignment.master_id_gcs is not None,
-        drive_url=None if homework.drive_id is None else COLAB_BASE + homework.drive_id,
+        drive_url=None if homework.drive_id is None or not is_open else COLAB_BASE + homework.drive_id,
         get_new_notebook_url=URL('obtain-new-notebook', id, signer=url_signer),
         num_ai_feedback = assignment.ai_feedback or 0,
     )
@@ -161,7 +176,7 @@ def api_homework_grades(id=None):
              ai_rate_url=URL('api-ai-rate', g.id, signer=url_signer),
         ) for g in grades]
     # I also want to know if there are any pending grades.
-     
+    expire_grading_requests(id)
     has_pending_grades = not db((db.grading_request.homework_id == id) &
                                 (db.grading_request.completed == False)).isempty()
     last_request = db(db.grading_request.homework_id == id).select(
@@ -171,9 +186,20 @@ def api_homework_grades(id=None):
         has_pending_grades=has_pending_grades,
         most_recent_request=None if last_request is None 
         else last_request.created_on.isoformat(),
+        last_request_failed=last_request is not None and bool(last_request.failed),
         )
 
 
+def expire_grading_requests(homework_id):
+    """Marks as failed the requests of a homework that have waited for their
+    grade longer than GRADING_REQUEST_TIMEOUT, e.g., as they were lost in the
+    grading scheduler queue of an instance that restarted."""
+    limit = datetime.datetime.utcnow() - datetime.timedelta(seconds=GRADING_REQUEST_TIMEOUT)
+    db((db.grading_request.homework_id == homework_id) &
+       (db.grading_request.completed == False) &
+       (db.grading_request.created_on < limit)).update(completed=True, failed=True)
+
+
 @action('grade-homework/<id>', method=["POST"])
 @action.uses(db, auth.user, url_signer.verify())
 def grade_homework(id=None):
@@ -212,8 +238,11 @@ def grade_homework(id=None):
     # Reads the student assignment.
     drive_service = build_drive_service()
     submission_json = read_from_drive(drive_service, homework.drive_id)
+    # Reads from the submission only the cells needed for grading.
+    skeleton = read_grading_skeleton(assignment)
+    submission_nb = skeleton.read_submission(submission_json)
     # Checks for the well-formedness of the notebook.
-    is_well_formed, cell_source, reason = is_notebook_well_formed(submission_json)
+    is_well_formed, cell_source, reason = is_notebook_well_formed(submission_nb)
     if not is_well_formed:
         # Gives feedback to the student immediately.
         return dict(
@@ -221,53 +250,144 @@ def grade_homework(id=None):
             outcome=reason,
             cell_source=cell_source,
         )
-    # Reads the master copy.
-    master_json = gcs.read(GCS_BUCKET, assignment.master_id_gcs)
-    # Saves the submission json, to have a record of what has been graded.
-    submission_id_gcs = long_random_id()
-    gcs.write(GCS_SUBMISSIONS_BUCKET, submission_id_gcs, submission_json,
-              type="application/json")
-    # Matches the notebooks.
-    master_nb = nbformat.reads(master_json, as_version=4)
-    submission_nb = nbformat.reads(submission_json, as_version=4)
     # Produces a clean notebook by matching the cells of master and submission.
-    test_nb = match_notebooks(master_nb, submission_nb)
+    test_nb = skeleton.match(submission_nb)
+    # If the same submission has already been graded, its grade is recorded
+    # again, without grading it anew.
+    graded_hash = submission_hash(test_nb, assignment.master_digest or assignment.master_id_gcs)
+    if regrade_from_previous(homework, assignment, student, graded_hash, now, is_valid):
+        return dict(is_error=False,
+                    watch=True,
+                    outcome="Your notebook has not changed since it was last graded; its grade has been recorded again.")
+    if INCREMENTAL_GRADING:
+        reuse_previous_results(test_nb, homework.id, student)
     # Creates the grade request.
     # The grading is via a callback.
+    submission_id_gcs = long_random_id()
     nonce = random_id()
-    db.grading_request.insert(
+    grading_request_id = db.grading_request.insert(
         homework_id=homework.id,
         request_nonce=nonce,
         input_id_gcs=submission_id_gcs,
+        submission_hash=graded_hash,
     )
-    db.commit() # So no db work pending.
-    # Enqueues the grade request.
-    payload = dict(
-        nonce=nonce,
-        notebook_json=nbformat.writes(test_nb, 4),
-        callback_url = URL('receive-grade', scheme=True)
-    )
-    send_function_request(payload, GRADING_URL)
+    db.commit() # So no db work pending, and the request is visible to the callback.
+    # Saving the submission and enqueueing the request are done in the background.
+    background_pool.submit(store_and_enqueue_submission, grading_request_id,
+                           submission_id_gcs, submission_json, test_nb,
+                           nonce, URL('receive-grade', scheme=True),
+                           assignment_id=assignment.id, student=student,
+                           deadline=assignment.submission_deadline)
     return dict(is_error=False,
                 watch=True,
                 outcome="Your request has been enqueued, and a new grade will be available soon.")
 
 
+def regrade_from_previous(homework, assignment, student, graded_hash, now, is_valid):
+    """If a submission with the same hash has already been graded, records a
+    new grade with its results and feedback, and returns True."""
+    previous_request = db((db.grading_request.submission_hash == graded_hash) &
+                          (db.grading_request.homework_id == homework.id) &
+                          (db.grading_request.student == student) &
+                          (db.grading_request.completed == True)).select(
+        orderby=~db.grading_request.created_on).first()
+    if previous_request is None:
+        return False
+    # Failed requests have no grade.
+    previous_grade = db((db.grade.homework_id == homework.id) &
+                        (db.grade.submission_id_gcs == previous_request.input_id_gcs)).select().first()
+    if previous_grade is None:
+        return False
+    grade_id = db.grade.insert(
+        student=student,
+        assignment_id=assignment.id,
+        grade_date=now,
+        homework_id=homework.id,
+        grade=previous_grade.grade,
+        submission_id_gcs=previous_grade.submission_id_gcs,
+        feedback_id_gcs=previous_grade.feedback_id_gcs,
+        drive_id=previous_grade.drive_id,
+        is_valid=is_valid,
+        cell_id_to_points=previous_grade.cell_id_to_points,
+        cell_hashes=previous_grade.cell_hashes,
+    )
+    update_homework_grade(homework, is_valid, previous_grade.grade)
+    if previous_grade.drive_id is None:
+        # The feedback of the previous grade has not been copied to Drive (yet).
+        enqueue_feedback_upload(grade_id)
+    return True
+
+
+def reuse_previous_results(test_nb, homework_id, student):
+    """Marks the tests of test_nb whose results can be taken from the
+    previous grade of the student, so that they need not be run again."""
+    previous_grade = db((db.grade.homework_id == homework_id) &
+                        (db.grade.student == student) &
+                        (db.grade.cell_hashes != None)).select(
+        db.grade.cell_hashes, db.grade.cell_id_to_points,
+        orderby=~db.grade.grade_date).first()
+    if previous_grade is None or previous_grade.cell_id_to_points is None:
+        return
+    reused = reusable_test_results(test_nb, json.loads(previous_grade.cell_hashes),
+                                   json.loads(previous_grade.cell_id_to_points))
+    mark_reused_tests(test_nb, reused)
+
+
+def store_and_enqueue_submission(grading_request_id, submission_id_gcs, submission_json,
+                                 test_nb, nonce, callback_url,
+                                 assignment_id=None, student=None, deadline=None):
+    """Runs in the background after grade_homework has returned.
+    Saves the submission json, to have a record of what has been graded,
+    then enqueues the grade request, via the grading scheduler if enabled.
+    If this fails, the request is marked as failed, so the student is not
+    left waiting for a grade."""
+    try:
+        write_stored_notebook(submission_id_gcs, submission_json)
+        payload = dict(
+            nonce=nonce,
+            callback_url=callback_url,
+        )
+        add_payload_notebooks(payload, dict(notebook_json=nbformat.writes(test_nb, 4)),
+                              result_upload=True)
+        if USE_GRADING_SCHEDULER:
+            future = get_grading_scheduler().submit(
+                payload, GRADING_URL, assignment_id=assignment_id, student=student,
+                deadline=deadline, key=nonce)
+            def on_sent(future):
+                if future.exception() is not None:
+                    mark_grading_request_failed(grading_request_id)
+            future.add_done_callback(on_sent)
+        else:
+            send_function_request(payload, GRADING_URL)
+    except Exception:
+        traceback.print_exc()
+        mark_grading_request_failed(grading_request_id)
+
+
+def mark_grading_request_failed(grading_request_id):
+    try:
+        # We are in a background thread, so we need our own connection.
+        db._adapter.reconnect()
+        db(db.grading_request.id == grading_request_id).update(
+            completed=True, failed=True)
+        db.commit()
+    except:
+        db.rollback()
+        traceback.print_exc()
+    finally:
+        db._adapter.close()
+
+
 @action('api-ai-feedback/<id>', method="GET")
 @action.uses(db, session, auth.user, url_signer.verify())
 def request_ai_feedback(id=None):
     """Requests information on the AI feedback for this grade."""
     ai_feedback = db(db.ai_feedback.grade_id == id).select().first()
     if ai_feedback is not None:
-        # Copies to drive from gcs if necessary.
         drive_id = ai_feedback.ai_feedback_id_drive
         if drive_id is None:
-            # We need to write the feedback to drive. 
-            feedback_json = gcs.read(GCS_SUBMISSIONS_BUCKET, info.grade.ai_feedback_id_gcs)
-            info = db((db.grade.id == id) & 
-                    (db.grade.homework_id == db.homework.id) &
-                    (db.homework.assignment_id == db.assignment.id)).select().first()
-            drive_id = write_ai_feedback_to_drive(info.assignment, info.grade, feedback_json)
+            # The feedback is being copied to drive from gcs.
+            return dict(state="requested")
         return dict(state="received", feedback_url=COLAB_BASE + drive_id)    
     # Checks if there is feedback pending.
     past_requests = db(db.ai_feedback_request.grade_id == id).select()
@@ -316,12 +436,11 @@ def request_ai_feedback(id=None):
     # We want to fail already here if the user cannot login. 
     build_drive_service()
     # Prepares the information for the feedback: the master notebook, and the student notebook.
-    master_json = gcs.read(GCS_BUCKET, info.assignment.master_id_gcs)
-    submission_json = gcs.read(GCS_SUBMISSIONS_BUCKET, info.grade.submission_id_gcs)
+    skeleton = read_grading_skeleton(info.assignment)
+    submission_json = read_stored_notebook(info.grade.submission_id_gcs)
     # Produces a clean notebook by matching the cells of master and submission.
-    master_nb = nbformat.reads(master_json, as_version=4)
-    submission_nb = nbformat.reads(submission_json, as_version=4)
-    test_nb = match_notebooks(master_nb, submission_nb)
+    submission_nb = skeleton.read_submission(submission_json)
+    test_nb = skeleton.match(submission_nb)
     # Creates the grade request.
     # The grading is via a callback.
     nonce = random_id()
@@ -333,14 +452,15 @@ def request_ai_feedback(id=None):
     # Enqueues the grade request.
     payload = dict(
         nonce=nonce,
-        # It seems silly to write the master notebook, since it is unchanged, but the 
-        # master_json variable contains bytes, it turns out. 
-        master_json=nbformat.writes(master_nb, 4),
-        student_json=nbformat.writes(test_nb, 4),
         provider="openai", # or openai. 
         model="gpt-4-1106-preview", # or gpt-4-1106-preview
         callback_url = URL('receive-ai-feedback', scheme=True)
     )
+    add_payload_notebooks(payload, dict(
+        # The master, with its readonly cells cleaned.
+        master_json=nbformat.writes(skeleton.master_notebook(), 4),
+        student_json=nbformat.writes(test_nb, 4),
+    ), result_upload=True)
     send_function_request(payload, FEEDBACK_URL)
     return dict(state="requested")
 
@@ -349,53 +469,52 @@ def request_ai_feedback(id=None):
 @action.uses(db, session)
 def receive_grade():
     nonce = request.params.nonce
-    graded_json = request.params.graded_json
+    # The graded notebook can be sent inline, or by reference.
+    graded_json = read_callback_notebook(request.params, 'graded_json')
     points = request.params.points
     had_errors = request.params.had_errors
+    if USE_GRADING_SCHEDULER:
+        get_grading_scheduler().release(nonce)
     grading_request = db(db.grading_request.request_nonce == nonce).select().first()
     if grading_request is None:
         return "No request"
-    if grading_request.completed:
+    if grading_request.completed and not grading_request.failed:
+        # Requests that timed out still get their grade.
         return "Already done"
     homework = db.homework[grading_request.homework_id]
     assignment = db.assignment[homework.assignment_id]
     print("Grading request for assignment id:", assignment.id)
     now = datetime.datetime.utcnow()
     is_valid = grading_request.created_on < assignment.submission_deadline
-    process_grade(homework, assignment, grading_request.created_on,
-                  grading_request.student, is_valid, points, graded_json,
-                  submission_id_gcs=grading_request.input_id_gcs)
+    grade_id = process_grade(homework, assignment, grading_request.created_on,
+                             grading_request.student, is_valid, points, graded_json,
+                             submission_id_gcs=grading_request.input_id_gcs)
     # Marks that the request has been done.
     grading_request.completed = True
+    grading_request.failed = False
     grading_request.grade = points
     grading_request.delay = (now - grading_request.created_on).total_seconds()
     grading_request.update_record()
+    enqueue_feedback_upload(grade_id)
     return "ok"
 
 
 def process_grade(homework, assignment, grade_date, student, is_valid, points, notebook_json,
                   submission_id_gcs=None):
-    """Processes a grading outcome, whether immediate or via callback."""
+    """Processes a grading outcome, whether immediate or via callback.
+    Returns the grade id; the feedback is not yet in Drive (see
+    feedback_jobs.enqueue_feedback_upload)."""
     # Removes the hidden tests from the feedback.
     feedback_nb = nbformat.reads(notebook_json, as_version=4)
+    # The hashes cover the hidden tests too, so they are computed first.
+    cell_hashes = cell_hash_chain(feedback_nb)
     remove_all_hidden_tests(feedback_nb)
     feedback_json = nbformat.writes(feedback_nb, 4)
-    # Uploads the feedback.
-    feedback_name = "Feedback for {} {}, on {}".format(
-        assignment.name, get_user_email(), grade_date.isoformat()
-    )
-    print("Building credentials for:", student)
-    drive_service = build_drive_service(user=student)
-    # We share with the teachers in write mode so that they can go back
-    # in the revision history.
-    write_share = get_assignment_teachers(assignment.id)
-    feedback_id = upload_to_drive(drive_service, feedback_json,
-                                  feedback_name, write_share=write_share, locked=True)
-    # We store the feedback in GCS.
+    # We store the feedback in GCS; it is copied to Drive by a job.
     feedback_id_gcs = long_random_id()
-    gcs.write(GCS_SUBMISSIONS_BUCKET, feedback_id_gcs, feedback_json)
+    write_stored_notebook(feedback_id_gcs, feedback_json)
     # We use the time of submission to determine validity.
-    db.grade.insert(
+    grade_id = db.grade.insert(
         student=student,
         assignment_id=assignment.id,
         grade_date=grade_date,
@@ -403,11 +522,16 @@ def process_grade(homework, assignment, grade_date, student, is_valid, points, n
         grade=points,
         submission_id_gcs=submission_id_gcs,
         feedback_id_gcs=feedback_id_gcs,
-        drive_id=feedback_id,
         is_valid=is_valid,
         cell_id_to_points=json.dumps(extract_awarded_points(feedback_nb)),
+        cell_hashes=json.dumps(cell_hashes),
     )
-    # Updates the grade in the homework.
+    update_homework_grade(homework, is_valid, points)
+    return grade_id
+
+
+def update_homework_grade(homework, is_valid, points):
+    """Updates the grade in the homework, given a new grade."""
     if is_valid:
         homework.grade = max([0] + list(filter(None, [homework.grade, points])))
     else:
@@ -419,7 +543,7 @@ def process_grade(homework, assignment, grade_date, student, is_valid, points, n
 @action.uses(db, session)
 def receive_ai_feedback():
     nonce = request.params.nonce
-    feedback_json = request.params.feedback_json
+    feedback_json = read_callback_notebook(request.params, 'feedback_json')
     ai_feedback_request = db(db.ai_feedback_request.request_nonce == nonce).select().first()
     if ai_feedback_request is None:
         return "No request"
@@ -437,7 +561,9 @@ def receive_ai_feedback():
         ai_feedback.model_used = request.params.model
         ai_feedback.cost_information = request.params.cost_information
         ai_feedback.rating = None # To over-write any previous star rating.
+        ai_feedback.ai_feedback_id_drive = None # The new feedback is copied to drive.
         ai_feedback.update_record()
+        feedback_id = ai_feedback.id
     else: 
         # We create the feedback.   
         ai_feedback_id_gcs = long_random_id()
@@ -454,50 +580,30 @@ def receive_ai_feedback():
     ai_feedback_request.completed = True
     ai_feedback_request.delay = (now - ai_feedback_request.created_on).total_seconds()
     ai_feedback_request.update_record()
-    db.commit()    
     # Writes also the AI feedback to drive.
-    try: 
-        write_ai_feedback_to_drive(feedback_id, assignment, grade, feedback_json)
-    except:
-        traceback.print_exc()
+    enqueue_ai_feedback_upload(feedback_id, ai_feedback_request.id)
     return "ok"
 
 
-def write_ai_feedback_to_drive(feedback_id, assignment, grade, feedback_json):
-    """Writes the AI feedback to drive, returning the ID."""
-    now = datetime.datetime.utcnow()
-    feedback_name = "AI Feedback for {} {}".format(
-        assignment.name, grade.student, now.isoformat()
-    )
-    print("Building credentials for:", grade.student)
-    drive_service = build_drive_service(user=grade.student)
-    # We share with the teachers in write mode so that they can go back
-    # in the revision history.
-    write_share = get_assignment_teachers(assignment.id)
-    feedback_id_drive = upload_to_drive(drive_service, feedback_json,
-                                        feedback_name, write_share=write_share, locked=True)
-    # Updates the feeback ids. 
-    ai_feedback = db.ai_feedback[feedback_id]
-    ai_feedback.ai_feedback_id_drive = feedback_id_drive
-    ai_feedback.update_record()
-    return feedback_id_drive
-
-
 @action('obtain-assignment/<id>', method=["POST"])
 @action.uses(db, auth.user, url_signer.verify())
 def obtain_assignment(id=None):
     homework = db.homework[id]
     assert homework is not None and homework.student == get_user_email()
-    # If the drive id already exists, gives it.
-    if homework.drive_id is not None:
-        return dict(drive_id=homework.drive_id)
     assignment = db.assignment[homework.assignment_id]
     assert assignment is not None
     now = datetime.datetime.utcnow()
-    if assignment.available_from < now < assignment.available_until:
-        drive_id = share_assignment_with_student(assignment)
-        homework.drive_id = drive_id
-        homework.update_record()
+    if now < assignment.available_from:
+        # The notebook may be provisioned already, but is not given yet.
+        return dict(drive_url=None)
+    # If the drive id already exists, gives it.
+    # It is usually there already (see provisioning.py).
+    if homework.drive_id is not None:
+        return dict(drive_url=COLAB_BASE + homework.drive_id)
+    if now < assignment.available_until:
+        # The notebook may be provisioned in the meantime; only one is kept.
+        drive_id = assign_notebook(homework.id, homework.student,
+                                   share_assignment_with_student(assignment))
     else:
         drive_id = None
     return dict(drive_url=None if drive_id is None else COLAB_BASE + drive_id)
@@ -9,26 +9,70 @@ To use celery tasks:
 5) Start "celery -A apps.{appname}.tasks worker --loglevel=info" for each worker
 
 """
+import traceback
+
 from .common import settings, scheduler, db, Field
+from .util import send_function_request
+from .provisioning import run_provisioning
+from .jobs import get_job_queue
+# The modules defining job kinds, so that the workers can run them.
+from . import acl_sync, assignment_copy, feedback_jobs
+
+# Runs a background job (see jobs.CeleryExecutor).
+@scheduler.task
+def run_job(job_id, retries=0):
+    get_job_queue().run(job_id, retries)
 
-# example of task that needs db access
+
+# Runs again the jobs whose run was lost.
 @scheduler.task
-def my_task():
+def sweep_jobs():
     try:
-        # this task will be executed in its own thread, connect to db
         db._adapter.reconnect()
-        # do something here
+        swept = get_job_queue().sweep()
+        if swept:
+            print("Resubmitted", swept, "jobs")
         db.commit()
     except:
-        # rollback on failure
+        traceback.print_exc()
         db.rollback()
 
 
-# run my_task very 10 seconds
+# Sends a grading request dispatched by the grading scheduler
+# (see grading_scheduler.CeleryBackend).
+@scheduler.task(bind=True, max_retries=5, default_retry_delay=10)
+def send_grading_request(self, payload, target_url):
+    try:
+        send_function_request(payload, target_url)
+    except Exception as e:
+        if self.request.retries < self.max_retries:
+            raise self.retry(exc=e)
+        traceback.print_exc()
+        # The student should not wait for a grade that will not come.
+        try:
+            db._adapter.reconnect()
+            db(db.grading_request.request_nonce == payload.get('nonce')).update(
+                completed=True, failed=True)
+            db.commit()
+        except:
+            db.rollback()
+
+
+# Creates the student notebooks of the assignments about to open.
+@scheduler.task
+def provision_notebooks():
+    run_provisioning()
+
+
 scheduler.conf.beat_schedule = {
-    "my_first_task": {
-        "task": "apps.%s.tasks.my_task" % settings.APP_NAME,
-        "schedule": 10.0,
+    "sweep_jobs": {
+        "task": "apps.%s.tasks.sweep_jobs" % settings.APP_NAME,
+        "schedule": float(settings.JOB_SWEEP_INTERVAL),
+        "args": (),
+    },
+    "provision_notebooks": {
+        "task": "apps.%s.tasks.provision_notebooks" % settings.APP_NAME,
+        "schedule": float(settings.PROVISIONING_INTERVAL),
         "args": (),
     },
 }
@@ -1,3 +1,4 @@
+import concurrent.futures
 import csv
 import datetime
 import io
@@ -11,11 +12,16 @@ from yatl.helpers import A, BUTTON, SPAN
 from .common import db, session, T, cache, auth, logger, authenticated, unauthenticated, flash
 from py4web.utils.form import Form, FormStyleBulma
 from .models import (get_user_email, build_drive_service, can_access_assignment,
-                     get_assignment_teachers, is_admin)
+                     get_assignment_teachers, is_admin, invalidate_master_caches)
+from .notebook_cache import notebook_digest
 from .settings import APP_FOLDER, COLAB_BASE, GCS_BUCKET, ADMIN_EMAIL, GRADING_URL
+from .settings import USE_GRADING_SCHEDULER, GRADING_SCHEDULER_IMMEDIATE_TIMEOUT
 
-from .common import flash, url_signer, gcs
+from .common import flash, url_signer, gcs, notebook_cache
 from .util import random_id, long_random_id, upload_to_drive, send_function_request, unshare_drive_file
+from .grading_scheduler import get_grading_scheduler
+from .assignment_copy import start_course_copy, course_copy_progress
+from .acl_sync import acl_sync_progress
 from .notebook_logic import create_master_notebook, produce_student_version, InvalidCell
 
 from .api_assignment_form import AssignmentFormCreate, AssignmentFormEdit, AssignmentFormView
@@ -53,6 +59,55 @@ def create_assignment():
     form = form_assignment_create(duplicate=duplicate, cancel_url=URL('teacher-home'))
     return dict(form=form)
 
+@action('duplicate-course')
+@action.uses('duplicate_course.html', db, auth.user)
+def duplicate_course():
+    return dict(
+        duplicate_course_url=URL('api-duplicate-course', signer=url_signer),
+        error_url=URL('credentials_error'),
+        internal_error_url=URL('internal_error'),
+    )
+
+@action('api-duplicate-course', method=["GET", "POST"])
+@action.uses(db, auth.user, url_signer.verify())
+def api_duplicate_course():
+    """GET returns the assignments the user can duplicate; POST starts
+    duplicating the given ones, shifting their dates by shift_days."""
+    owned = db(db.assignment.owner == get_user_email()).select(
+        db.assignment.id, db.assignment.name, db.assignment.available_from,
+        db.assignment.submission_deadline, orderby=~db.assignment.submission_deadline)
+    if request.method == "GET":
+        return dict(assignments=[dict(
+            id=a.id,
+            name=a.name,
+            available_from=a.available_from.isoformat() if a.available_from else None,
+            submission_deadline=a.submission_deadline.isoformat() if a.submission_deadline else None,
+        ) for a in owned])
+    owned_ids = set(a.id for a in owned)
+    try:
+        assignment_ids = [int(i) for i in request.json.get('assignment_ids') or []]
+        shift = datetime.timedelta(days=float(request.json.get('shift_days') or 0))
+    except (TypeError, ValueError):
+        return dict(error="Invalid request.")
+    if not assignment_ids:
+        return dict(error="Please select the assignments to duplicate.")
+    if not set(assignment_ids) <= owned_ids:
+        return dict(error="You can duplicate only assignments you own.")
+    copy_id = start_course_copy(assignment_ids, shift)
+    return dict(progress_url=URL('api-course-copy-progress', copy_id, signer=url_signer))
+
+@action('api-course-copy-progress/<id>', method="GET")
+@action.uses(db, auth.user, url_signer.verify())
+def api_course_copy_progress(id=None):
+    progress = course_copy_progress(id)
+    if progress is None:
+        abort(403)
+    progress['assignments'] = [
+        dict(name=a.name, url=URL('teacher-view-assignment', a.id))
+        for a in db(db.assignment.id.belongs(progress.pop('new_ids'))).select(
+            db.assignment.id, db.assignment.name)]
+    return progress
+
 @action('teacher-view-assignment/<id>')
 @action.uses('teacher_view_assignment.html', db, auth.user, form_assignment_view)
 def teacher_view_assignment(id=None):
@@ -70,6 +125,7 @@ def teacher_view_assignment(id=None):
         is_admin=is_admin(),
         change_access_url=URL('change-access-url', id, signer=url_signer),
         notebook_version_url=URL('notebook-version', id, signer=url_signer),
+        sharing_progress_url=URL('sharing-progress', id, signer=url_signer),
         upload_url=URL('upload-notebook', id, signer=url_signer) if is_owner else None,
         error_url=URL('credentials_error'),
         internal_error_url=URL('internal_error'),
@@ -99,6 +155,14 @@ def notebook_version(id=None):
         student_version=COLAB_BASE + assignment.student_id_drive if assignment.student_id_drive else None,
     )
 
+@action('sharing-progress/<id>', method=['GET'])
+@action.uses(db, auth.user, url_signer.verify())
+def sharing_progress(id=None):
+    """Progress of the sharing of the assignment files with its teachers."""
+    if not can_access_assignment(id):
+        abort(403)
+    return dict(progress=acl_sync_progress(id))
+
 @action('upload-notebook/<id>', method=['GET', 'POST'])
 @action.uses(db, auth.user, url_signer.verify())
 def upload_notebook(id=None):
@@ -109,21 +173,28 @@ def upload_notebook(id=None):
     # This is a POST for the file.
     notebook_json = request.params.notebook_content
     # Tries to process the notebook
+    timings = {}
     try:
-        master_notebook_json, total_points, test_list = create_master_notebook(notebook_json)
+        master_notebook_json, total_points, test_list = create_master_notebook(
+            notebook_json, timings=timings)
     except InvalidCell as e:
         return dict(error=str(e))
-    # Produces the student version.
-    student_notebook_json = produce_student_version(master_notebook_json)
+    logger.debug("Master notebook creation timings: %s", timings)
+    # Produces the student version.  The master is our own output, so there
+    # is no need to validate it again.
+    student_notebook_json = produce_student_version(master_notebook_json, validate=False)
     # Are there already students working on the assignment?
     # If so, we can change it only if the student version has not changed.
     not_started = db((db.homework.assignment_id == assignment.id)
                      & (db.homework.drive_id != None)).isempty()
     if not not_started:
         # There are already students that can access it.
-        # Gets previous student version.
-        previous_student_version = gcs.read(GCS_BUCKET, assignment.student_id_gcs)
-        if student_notebook_json != previous_student_version:
+        # Compares with the digest of the previous student version; we read
+        # the previous version only for assignments that predate digests.
+        previous_digest = assignment.student_digest
+        if previous_digest is None:
+            previous_digest = notebook_digest(gcs.read(GCS_BUCKET, assignment.student_id_gcs))
+        if notebook_digest(student_notebook_json) != previous_digest:
             return dict(
                 error="You cannot change the assignment in a way that modifies the student version once the students have started working on it.",
                 instructor_version=COLAB_BASE + assignment.master_id_drive,
@@ -137,7 +208,16 @@ def upload_notebook(id=None):
     payload = dict(
         notebook_json=master_notebook_json,
     )
-    r = send_function_request(payload, GRADING_URL, immediate=True)
+    if USE_GRADING_SCHEDULER:
+        # Goes ahead of the queued student requests.
+        future = get_grading_scheduler().submit(
+            payload, GRADING_URL, assignment_id=assignment.id, immediate=True)
+        try:
+            r = future.result(timeout=GRADING_SCHEDULER_IMMEDIATE_TIMEOUT)
+        except concurrent.futures.TimeoutError:
+            return dict(error="The notebook is taking too long to run; please try again later.")
+    else:
+        r = send_function_request(payload, GRADING_URL, immediate=True)
     res = r.json()
     points = res.get("points")
     has_errors = res.get("had_errors")
@@ -151,6 +231,9 @@ def upload_notebook(id=None):
               type="application/json")
     gcs.write(GCS_BUCKET, assignment.student_id_gcs, student_notebook_json,
               type="application/json")
+    assignment.master_digest = notebook_cache.put(master_notebook_json)
+    invalidate_master_caches(assignment.master_id_gcs)
+    assignment.student_digest = notebook_cache.put(student_notebook_json)
     # Now shares both notebooks to drive.
     drive_service = build_drive_service()
     master_file_name = "{}, version: {}".format(assignment.name, date_string)
@@ -201,6 +284,7 @@ def delete_assignment(id=None):
         if form.vars['confirm_deletion']:
             if assignment.master_id_gcs is not None:
                 gcs.delete(GCS_BUCKET, assignment.master_id_gcs)
+                invalidate_master_caches(assignment.master_id_gcs)
             if assignment.student_id_gcs is not None:
                 gcs.delete(GCS_BUCKET, assignment.student_id_gcs)
             db(db.assignment.id == id).delete()
@@ -1,20 +1,29 @@
 import io
 import json
+import random
 import re
+import threading
+import time
+import traceback
 
 import base64
+import concurrent.futures
+import gzip
 import hashlib
 import requests
 import uuid
 
 
+import google.auth.jwt
 import google.auth.transport.requests
 import google.oauth2.id_token
+import httplib2
 from google.cloud import tasks_v2
 
+from googleapiclient.errors import HttpError
 from googleapiclient.http import MediaIoBaseUpload, MediaIoBaseDownload
 
-from .settings import IS_CLOUD
+from .settings import IS_CLOUD, GRADING_URL, LOCAL_GRADER_URL, LOCAL_GRADER_FALLBACK
 from .settings import QUEUE_SERVICE_ACCOUNT, STUDENT_GRADING_QUEUE_LOCATION
 from .settings import STUDENT_GRADING_QUEUE_NAME, STUDENT_GRADING_QUEUE_PROJECT
 
@@ -57,6 +66,25 @@ def random_id():
 def long_random_id():
     return hashlib.sha256(uuid.uuid1().bytes).hexdigest()
 
+GZIP_MAGIC = b'\x1f\x8b'
+
+def gzip_bytes(s):
+    """Compresses a string or bytes."""
+    s_bytes = s if isinstance(s, bytes) else s.encode('utf-8')
+    return gzip.compress(s_bytes, compresslevel=6)
+
+def gunzip_if_needed(data):
+    """Decompresses data if it is gzipped, and returns it unchanged otherwise.
+    Json never begins with the gzip magic number, so blobs stored before
+    compression was introduced are read correctly."""
+    if data[:2] == GZIP_MAGIC:
+        return gzip.decompress(data)
+    return data
+
+# Notebooks larger than this are uploaded with a resumable upload; smaller ones
+# with a single request, avoiding the round trip that starts a resumable upload.
+DRIVE_RESUMABLE_UPLOAD_THRESHOLD = 5 * 2**20
+
 def upload_to_drive(drive_service, s, drive_file_name, id=None,
                     write_share=None, read_share=None, locked=False):
     """
@@ -75,8 +103,13 @@ def upload_to_drive(drive_service, s, drive_file_name, id=None,
     s_bytes = s if isinstance(s, bytes) else s.encode('utf-8')
     sio = io.BytesIO(s_bytes)
     media = MediaIoBaseUpload(sio,
-        mimetype='application/vnd.google.colaboratory', resumable=True)
+        mimetype='application/vnd.google.colaboratory',
+        resumable=len(s_bytes) > DRIVE_RESUMABLE_UPLOAD_THRESHOLD)
     meta = {'name': drive_file_name}
+    if locked:
+        # The file is locked in the same request that uploads it.
+        meta['contentRestrictions'] = [
+            {"readOnly": True, "reason": "Homework feedback."}]
     if id is None:
         # We upload a new file.
         upfile = drive_service.files().create(
@@ -90,50 +123,202 @@ def upload_to_drive(drive_service, s, drive_file_name, id=None,
             body=meta,
             media_body=media,
             fileId=id,
+            fields='id',
         ).execute()
     # Shares the file if requested.
-    for user in (write_share or []):
-        share_drive_file(drive_service, id, user, "writer")
-    for user in (read_share or []):
-        share_drive_file(drive_service, id, user, "reader")
-    # Locks the file if requested.
-    if locked:
-        drive_service.files().update(
-            fileId=id,
-            body={"contentRestrictions":
-                      [{"readOnly": "true", "reason": "Homework feedback."}]
-                  })
+    shares = ([(id, user, "writer") for user in (write_share or [])] +
+              [(id, user, "reader") for user in (read_share or [])])
+    for file_id, user, mode, e in share_drive_files(drive_service, shares):
+        print("Could not share", file_id, "with", user, ":", e)
     return id
 
 
 def share_drive_file(drive_service, file_id, user, mode):
     """Shares a drive file with a user in the requested mode."""
-    user_permission = {
-        'type': 'user',
-        'role': mode,
-        'emailAddress': user
-    }
     drive_service.permissions().create(
         fileId=file_id,
-        body=user_permission,
+        body=_user_permission(user, mode),
         fields='id',
         sendNotificationEmail=False,  # otherwise, Google throttles us
     ).execute()
 
 
+def _user_permission(user, mode):
+    return {
+        'type': 'user',
+        'role': mode,
+        'emailAddress': user
+    }
+
+
+# Maximum number of calls in a Drive batch request.
+DRIVE_BATCH_SIZE = 100
+RATE_LIMIT_REASONS = {'rateLimitExceeded', 'userRateLimitExceeded', 'sharingRateLimitExceeded'}
+
+def is_retryable_drive_error(e):
+    """Returns True if a Drive error is due to rate limits, or is transient."""
+    if isinstance(e, (OSError, httplib2.HttpLib2Error)):
+        # Connection errors and timeouts.
+        return True
+    if not isinstance(e, HttpError) or e.resp is None:
+        return False
+    status = e.resp.status
+    if status == 429 or status >= 500:
+        return True
+    if status == 403 and isinstance(e.error_details, list):
+        return any(isinstance(d, dict) and d.get('reason') in RATE_LIMIT_REASONS
+                   for d in e.error_details)
+    return False
+
+
+def retry_drive_call(fn, max_retries=5, backoff=1.0):
+    """Returns fn(), retrying it with exponential backoff if it fails due to
+    Drive rate limits or transient errors."""
+    for attempt in range(max_retries + 1):
+        try:
+            return fn()
+        except Exception as e:
+            if attempt == max_retries or not is_retryable_drive_error(e):
+                raise
+        time.sleep(backoff * 2 ** attempt * (1 + random.random()))
+
+
+def execute_drive_batch(drive_service, calls, max_retries=5, backoff=1.0):
+    """Executes Drive requests via batch http requests.
+    Args:
+        drive_service: the drive service to use.
+        calls: list of (key, make_request) pairs, where make_request() returns
+            the request to execute (requests cannot be reused across retries).
+    Returns:
+        The pair (results, failures), where results maps each key to the response,
+        and failures is a list of (key, exception) for the requests that failed.
+    Requests that fail due to rate limits are retried, with exponential backoff,
+    and so are those of batches that fail as a whole."""
+    results, failures = {}, []
+    pending = list(calls)
+    for attempt in range(max_retries + 1):
+        to_retry = []
+        for i in range(0, len(pending), DRIVE_BATCH_SIZE):
+            chunk = pending[i:i + DRIVE_BATCH_SIZE]
+            answered = set()
+            def callback(request_id, response, exception, chunk=chunk, answered=answered):
+                answered.add(int(request_id))
+                key, make_request = chunk[int(request_id)]
+                if exception is None:
+                    results[key] = response
+                elif is_retryable_drive_error(exception) and attempt < max_retries:
+                    to_retry.append((key, make_request))
+                else:
+                    failures.append((key, exception))
+            batch = drive_service.new_batch_http_request(callback=callback)
+            for j, (_, make_request) in enumerate(chunk):
+                batch.add(make_request(), request_id=str(j))
+            try:
+                batch.execute()
+            except Exception as e:
+                # The requests without an answer are retried, or fail.
+                for j, call in enumerate(chunk):
+                    if j in answered:
+                        continue
+                    if is_retryable_drive_error(e) and attempt < max_retries:
+                        to_retry.append(call)
+                    else:
+                        failures.append((call[0], e))
+        if not to_retry:
+            break
+        pending = to_retry
+        time.sleep(backoff * 2 ** attempt * (1 + random.random()))
+    return results, failures
+
+
+def share_drive_files(drive_service, shares, **kwargs):
+    """Shares drive files, via batch requests.
+    Args:
+        drive_service: the drive service to use.
+        shares: list of (file_id, user, mode) triples.
+        kwargs: passed to execute_drive_batch.
+    Returns:
+        The list of (file_id, user, mode, exception) for the shares that failed."""
+    def make_request(file_id, user, mode):
+        return lambda: drive_service.permissions().create(
+            fileId=file_id,
+            body=_user_permission(user, mode),
+            fields='id',
+            sendNotificationEmail=False,  # otherwise, Google throttles us
+        )
+    calls = [(share, make_request(*share)) for share in shares]
+    if not calls:
+        return []
+    _, failures = execute_drive_batch(drive_service, calls, **kwargs)
+    return [share + (e,) for share, e in failures]
+
+
 def unshare_drive_file(drive_service, file_id, user):
-    """Shares a drive file with a user in the requested mode."""
-    permissions = drive_service.permissions().list(fileId=file_id).execute()
-    for p in permissions['permissions']:
-        permission_id = p['id']
-        details = drive_service.permissions().get(
-            fileId=file_id, permissionId=permission_id, fields='emailAddress').execute()
-        email = details['emailAddress']
-        if email == user:
-            drive_service.permissions().delete(
-                fileId=file_id, permissionId=permission_id).execute()
-            print("Removed permission from", user)
-            
+    """Removes the permissions of a user on a drive file."""
+    failures = unshare_drive_files(drive_service, [file_id], [user])
+    if failures:
+        raise failures[0][2]
+
+
+def list_drive_permissions(drive_service, file_ids, **kwargs):
+    """Lists the permissions of drive files, via batch requests.
+    Returns the pair (permissions, failures), where permissions maps each file id
+    to its list of {'id': ..., 'emailAddress': ...} permissions, and failures is a
+    list of (file_id, exception) for the files whose permissions could not be listed."""
+    def make_request(file_id, page_token):
+        return lambda: drive_service.permissions().list(
+            fileId=file_id,
+            fields='nextPageToken, permissions(id, emailAddress)',
+            pageSize=100,
+            pageToken=page_token,
+        )
+    permissions = {file_id: [] for file_id in file_ids}
+    all_failures = []
+    pages = [(file_id, None) for file_id in permissions]
+    while pages:
+        results, failures = execute_drive_batch(
+            drive_service, [(page, make_request(*page)) for page in pages], **kwargs)
+        all_failures.extend((file_id, e) for (file_id, _), e in failures)
+        pages = []
+        for (file_id, _), response in results.items():
+            permissions[file_id].extend(response.get('permissions', []))
+            if response.get('nextPageToken'):
+                pages.append((file_id, response['nextPageToken']))
+    for file_id, _ in all_failures:
+        permissions.pop(file_id, None)
+    return permissions, all_failures
+
+
+def unshare_drive_files(drive_service, file_ids, users, **kwargs):
+    """Removes the permissions of users on drive files, via batch requests:
+    one batch lists the permissions of all files, and one deletes them.
+    Args:
+        drive_service: the drive service to use.
+        file_ids: list of file ids.
+        users: list of user emails.
+        kwargs: passed to execute_drive_batch.
+    Returns:
+        The list of (file_id, user, exception) for the removals that failed;
+        user is None if the permissions of the file could not be listed."""
+    users = {u.lower() for u in users}
+    if not file_ids or not users:
+        return []
+    permissions, list_failures = list_drive_permissions(drive_service, file_ids, **kwargs)
+    def make_request(file_id, permission_id):
+        return lambda: drive_service.permissions().delete(
+            fileId=file_id, permissionId=permission_id)
+    calls = []
+    for file_id, file_permissions in permissions.items():
+        for p in file_permissions:
+            email = (p.get('emailAddress') or '').lower()
+            if email in users:
+                calls.append(((file_id, email), make_request(file_id, p['id'])))
+    failures = [(file_id, None, e) for file_id, e in list_failures]
+    if calls:
+        _, delete_failures = execute_drive_batch(drive_service, calls, **kwargs)
+        failures.extend((file_id, email, e) for (file_id, email), e in delete_failures)
+    return failures
+
 
 def read_from_drive(drive_service, drive_id):
     """Reads a drive id into a string."""
@@ -147,13 +332,68 @@ def read_from_drive(drive_service, drive_id):
     return file.getvalue()
 
 
+_tasks_client = None
+_tasks_client_lock = threading.Lock()
+
+def get_tasks_client():
+    """Returns the Cloud Tasks client, creating it on first use.
+    The client, and its gRPC channel, are shared by all requests."""
+    global _tasks_client
+    with _tasks_client_lock:
+        if _tasks_client is None:
+            _tasks_client = tasks_v2.CloudTasksClient()
+        return _tasks_client
+
+
+# Id tokens are refreshed this many seconds before they expire.
+ID_TOKEN_EXPIRY_MARGIN = 5 * 60
+_id_tokens = {} # audience -> (id_token, expiry)
+_id_tokens_lock = threading.Lock()
+
+def get_id_token(audience):
+    """Returns an id token for the audience, fetching a new one only when
+    the cached one is about to expire."""
+    with _id_tokens_lock:
+        id_token, expiry = _id_tokens.get(audience, (None, 0))
+    if time.time() < expiry - ID_TOKEN_EXPIRY_MARGIN:
+        return id_token
+    auth_req = google.auth.transport.requests.Request()
+    id_token = google.oauth2.id_token.fetch_id_token(auth_req, audience)
+    # We just obtained the token from Google, so there is no need to verify it.
+    claims = google.auth.jwt.decode(id_token, verify=False)
+    with _id_tokens_lock:
+        _id_tokens[audience] = (id_token, claims.get('exp', 0))
+    return id_token
+
+
 def send_function_request(payload, TARGET_URL, immediate=False):
     """
     Sends a request for grading or feedback. 
     In the cloud, if immediate is True, then the request is performed
     without a queue. Otherwise, the request is enqueued.
     Locally, the request is always performed without a queue.
+    Grading requests can also be handled by the local grading engine
+    (see grading_engine.py).
     See https://cloud.google.com/tasks/docs/creating-http-target-tasks"""
+    if TARGET_URL == LOCAL_GRADER_URL:
+        return _grade_locally(payload, immediate)
+    if LOCAL_GRADER_FALLBACK and TARGET_URL == GRADING_URL:
+        try:
+            return _send_function_request(payload, TARGET_URL, immediate=immediate)
+        except Exception:
+            traceback.print_exc()
+            print("Grading locally, as the grader cannot be reached")
+            return _grade_locally(payload, immediate)
+    return _send_function_request(payload, TARGET_URL, immediate=immediate)
+
+
+def _grade_locally(payload, immediate):
+    # Imported here, as the local grader needs jupyter_client.
+    from .grading_engine import get_local_grader
+    return get_local_grader().handle(payload, immediate=immediate)
+
+
+def _send_function_request(payload, TARGET_URL, immediate=False):
     if not IS_CLOUD:
         # This request can use a callback.
         r = requests.post(TARGET_URL, json=payload)
@@ -161,15 +401,12 @@ def send_function_request(payload, TARGET_URL, immediate=False):
         return r
     elif immediate:
         # Performs the request without queue.
-        auth_req = google.auth.transport.requests.Request()
-        id_token = google.oauth2.id_token.fetch_id_token(auth_req, TARGET_URL)
-        headers = {"Authorization": "Bearer {}".format(id_token)}
+        headers = {"Authorization": "Bearer {}".format(get_id_token(TARGET_URL))}
         r = requests.post(TARGET_URL, headers=headers, json=payload)
         r.raise_for_status()
         return r        
     else:
-        # Create a client.
-        client = tasks_v2.CloudTasksClient()
+        client = get_tasks_client()
         # Construct the request body.
         task = tasks_v2.Task(
             http_request=tasks_v2.HttpRequest(
@@ -194,3 +431,61 @@ def send_function_request(payload, TARGET_URL, immediate=False):
             )
         )
 
+
+def send_function_requests(payloads, TARGET_URL, immediate=False, max_workers=8):
+    """Sends many requests for grading or feedback concurrently, as in
+    send_function_request.
+    Returns the list of results, in the order of the payloads; the entry of
+    a request that failed is the exception it raised."""
+    def send(payload):
+        try:
+            return send_function_request(payload, TARGET_URL, immediate=immediate)
+        except Exception as e:
+            return e
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(send, payloads))
+
+
+##################################
+# Tests
+
+class _FlakyBatchService(object):
+    """A Drive service whose batches answer the first request, then fail as
+    a whole the first time(s) they are executed."""
+
+    def __init__(self, errors):
+        self.errors = list(errors)
+        self.executed = []
+
+    def new_batch_http_request(self, callback):
+        service = self
+        class Batch(object):
+            def __init__(self):
+                self.requests = []
+            def add(self, request, request_id):
+                self.requests.append((request_id, request))
+            def execute(self):
+                requests = list(self.requests)
+                if service.errors:
+                    request_id, request = requests.pop(0)
+                    service.executed.append(request)
+                    callback(request_id, request, None)
+                    raise service.errors.pop(0)
+                for request_id, request in requests:
+                    service.executed.append(request)
+                    callback(request_id, request, None)
+        return Batch()
+
+
+def test_execute_drive_batch_retries_failed_batches():
+    unavailable = HttpError(httplib2.Response(dict(status=503)), b"")
+    service = _FlakyBatchService([unavailable, ConnectionResetError()])
+    calls = [(k, lambda k=k: k) for k in "abc"]
+    results, failures = execute_drive_batch(service, calls, backoff=0)
+    assert results == dict(a="a", b="b", c="c") and failures == []
+    # The answered requests are not sent again.
+    assert service.executed == ["a", "b", "c"]
+    forbidden = HttpError(httplib2.Response(dict(status=403)), b"")
+    service = _FlakyBatchService([forbidden])
+    results, failures = execute_drive_batch(service, calls, backoff=0)
+    assert results == dict(a="a") and failures == [("b", forbidden), ("c", forbidden)]